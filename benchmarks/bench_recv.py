@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the receive helpers in vern/utils.py.
+
+Sends length-prefixed frames of 1 KB, 1 MB and 50 MB over a socketpair and times reading
+them back with the old bytes-concatenation loop against receive_exact_bytes and FrameReader.
+
+    python benchmarks/bench_recv.py [--repeat N]
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vern'))
+
+from utils import FrameReader, receive_exact_bytes, receive_length
+
+SIZES = [('1KB', 1024), ('1MB', 1024 * 1024), ('50MB', 50 * 1024 * 1024)]
+
+
+def receive_exact_bytes_concat(connection, num_bytes):
+    """The previous implementation, kept here as the baseline."""
+    received_data = b""
+    while len(received_data) < num_bytes:
+        chunk = connection.recv(num_bytes - len(received_data))
+        if not chunk:
+            raise RuntimeError("Connection closed unexpectedly")
+        received_data += chunk
+    return received_data
+
+
+def read_concat(sock, frames):
+    for _ in range(frames):
+        json.loads(receive_exact_bytes_concat(sock, int.from_bytes(sock.recv(4), 'big')))
+
+
+def read_exact_bytes(sock, frames):
+    for _ in range(frames):
+        json.loads(receive_exact_bytes(sock, receive_length(sock)))
+
+
+def read_frame_reader(sock, frames):
+    reader = FrameReader(sock)
+    for _ in range(frames):
+        json.loads(str(reader.read_frame(), 'utf-8'))
+
+
+def run(reader, frame, frames):
+    a, b = socket.socketpair()
+    # Small buffers, as over TCP, so large frames arrive in many pieces
+    b.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
+    sender = threading.Thread(target=lambda: [a.sendall(frame) for _ in range(frames)])
+    sender.start()
+    start = time.perf_counter()
+    reader(b, frames)
+    elapsed = time.perf_counter() - start
+    sender.join()
+    a.close()
+    b.close()
+    return elapsed / frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the socket receive helpers')
+    parser.add_argument('--repeat', type=int, default=5, help='Frames received per measurement')
+    args = parser.parse_args()
+
+    readers = [('concat', read_concat), ('receive_exact_bytes', read_exact_bytes), ('FrameReader', read_frame_reader)]
+    print(f"{'size':>6} " + " ".join(f"{name:>20}" for name, _ in readers))
+    for label, size in SIZES:
+        payload = json.dumps({'data': 'x' * (size - 12)}).encode()
+        frame = len(payload).to_bytes(4, 'big') + payload
+        frames = args.repeat if size < 10 * 1024 * 1024 else max(1, args.repeat // 5)
+        results = [run(reader, frame, frames) * 1000 for _, reader in readers]
+        print(f"{label:>6} " + " ".join(f"{ms:>17.3f} ms" for ms in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Client start-up benchmark: wall time of a fresh interpreter importing vern_client and
+building a Client, plus the slowest imports reported by python -X importtime.
+
+    python benchmarks/bench_startup.py [--runs N] [--top N]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+VERN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vern')
+
+# No server is needed, Client() only reads its config and systems lazily
+STARTUP = "import vern_client; vern_client.Client()"
+
+
+def run_once(extra_args=()):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, *extra_args, '-c', STARTUP], cwd=VERN_DIR,
+                            capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, result.stderr
+
+
+def slowest_imports(stderr, top):
+    """(cumulative us, module) of the imports one level down, slowest first."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are already included in their parent's cumulative time
+        if name.startswith('   ') and not name.startswith('     '):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the client start-up time')
+    parser.add_argument('--runs', type=int, default=10, help='Interpreter starts to time')
+    parser.add_argument('--top', type=int, default=10, help='Slowest imports to list')
+    args = parser.parse_args()
+
+    run_once()  # Warm up the .pyc files and the config cache
+    startup = [run_once()[0] for _ in range(args.runs)]
+    bare = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        bare.append(time.perf_counter() - start)
+
+    print(f"interpreter only: {statistics.median(bare) * 1000:8.1f} ms")
+    print(f"client start-up:  {statistics.median(startup) * 1000:8.1f} ms (median of {args.runs})")
+
+    _, stderr = run_once(['-X', 'importtime'])
+    print("\nslowest imports (cumulative):")
+    for cumulative, name in slowest_imports(stderr, args.top):
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+
+if __name__ == '__main__':
+    main()
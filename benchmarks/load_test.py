@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test: starts vern_server.py as a subprocess against a local stand-in for
+the chat completions API, drives concurrent clients through query, use-s-query, oneshot
+and list-s requests, and prints a JSON report of throughput, latency percentiles and the
+server's RSS, file descriptor and thread counts.
+
+    python benchmarks/load_test.py [--clients N] [--requests N] [--latency MS] [--response-bytes N]
+                                   [--mix query,use-s-query,oneshot,list-s] [--stream] [--out report.json]
+
+The server runs with its own HOME and dpath under a temporary directory, so a vern server
+already running on this machine is not disturbed.  Resource counts are read from /proc.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+VERN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vern')
+sys.path.insert(0, VERN_DIR)
+
+from protocol import create_request, encode_request, parse_response
+from utils import find_available_port, receive_exact_bytes, receive_length
+
+OPS = ('query', 'use-s-query', 'oneshot', 'list-s')
+
+
+class FakeOpenAI(ThreadingHTTPServer):
+    """Chat completions and models endpoints answering after latency seconds with response_bytes of content."""
+
+    daemon_threads = True
+
+    def __init__(self, latency, response_bytes, chunks):
+        super().__init__(('127.0.0.1', 0), FakeOpenAIHandler)
+        self.latency = latency
+        self.content = ("lorem ipsum " * (response_bytes // 12 + 1))[:response_bytes]
+        self.chunks = chunks
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # Headers and body are separate writes, don't add delayed ACKs to the latency
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_json({"object": "list", "data": [{"id": "gpt-4o", "object": "model", "created": 0, "owned_by": "fake"}]})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        time.sleep(server.latency)
+
+        prompt_tokens = sum(len(m['content']) // 4 for m in request['messages'])
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(server.content) // 4,
+                 "total_tokens": prompt_tokens + len(server.content) // 4}
+        base = {"id": "chatcmpl-load", "created": 0, "model": request['model']}
+        if not request.get('stream'):
+            self.send_json({**base, "object": "chat.completion", "usage": usage, "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": server.content}, "finish_reason": "stop"}]})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        size = max(1, len(server.content) // server.chunks)
+        parts = [server.content[i:i + size] for i in range(0, len(server.content), size)]
+        for i, part in enumerate(parts):
+            chunk = {**base, "object": "chat.completion.chunk", "choices": [
+                {"index": 0, "delta": {"content": part}, "finish_reason": "stop" if i == len(parts) - 1 else None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        chunk = {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+        self.wfile.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode())
+        self.close_connection = True
+
+
+def write_config(tmp_dir, args, port, base_url):
+    config = {
+        'settings': {'dpath': os.path.join(tmp_dir, 'dpath'), 'model': 'gpt-4o', 'storage': 'journal',
+                     'write_behind': True, 'context_policy': 'sliding', 'context_budget': 30000},
+        'network': {'host': '127.0.0.1', 'port': port, 'server_mode': args.server_mode,
+                    'max_workers': args.max_workers, 'tcp': True, 'persistent': False},
+        'openai': {'base_url': base_url, 'keep_warm': 0, 'max_connections': args.max_workers},
+        'tracing': {'enabled': True},
+    }
+    path = os.path.join(tmp_dir, 'config.yaml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+def start_server(config_path, tmp_dir, port, timeout=30):
+    """Run vern_server.py, return the process and the seconds until it accepts connections."""
+    env = dict(os.environ, HOME=tmp_dir, OPENAI_API_KEY='load-test')
+    env.pop('OPENAI_BASE_URL', None)
+    start = time.monotonic()
+    process = subprocess.Popen([sys.executable, 'vern_server.py', '-c', config_path], cwd=VERN_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=open(os.path.join(tmp_dir, 'server.log'), 'w'))
+    while time.monotonic() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with {process.returncode}, see {tmp_dir}/server.log")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, time.monotonic() - start
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"Server did not accept connections within {timeout}s")
+
+
+def request(port, req, stream=False):
+    """Send one request, return its final response frame (the one after the stream when streaming)."""
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(encode_request(req))
+        while True:
+            response = parse_response(receive_exact_bytes(sock, receive_length(sock)))
+            if not stream or response['status'] == 'error' or response['cmd'] in ('airesponse', 'airesponseend'):
+                return response
+
+
+def proc_stats(pid):
+    """RSS in MB, open file descriptors and threads of process pid."""
+    with open(f"/proc/{pid}/status") as f:
+        status = dict(line.split(':', 1) for line in f if ':' in line)
+    return {
+        'rss_mb': int(status['VmRSS'].split()[0]) / 1024,
+        'fds': len(os.listdir(f"/proc/{pid}/fd")),
+        'threads': int(status['Threads']),
+    }
+
+
+def percentiles(latencies):
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+
+    def at(q):
+        return round(1000 * ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+
+    return {'count': len(ordered), 'mean': round(1000 * sum(ordered) / len(ordered), 3),
+            'p50': at(0.5), 'p95': at(0.95), 'p99': at(0.99), 'max': round(1000 * ordered[-1], 3)}
+
+
+def client(port, index, ops, requests, stream, results):
+    sid = f"load-{index}"
+    response = request(port, create_request(sid, 'new-s', system="You are a load test."))
+    if response['status'] == 'error':
+        results.append(('new-s', 0.0, False))
+        return
+    for i in range(requests):
+        op = ops[(index + i) % len(ops)]
+        if op == 'list-s':
+            req, op_stream = create_request(sid, 'list-s', {'limit': 20}), False
+        else:
+            cmd = 'query' if op == 'query' else 'use-s-query'
+            req, op_stream = create_request(sid, cmd, f"Request {i} from client {index}", oneshot=op == 'oneshot', stream=stream), stream
+        start = time.perf_counter()
+        try:
+            ok = request(port, req, op_stream)['status'] != 'error'
+        except (OSError, RuntimeError):
+            ok = False
+        results.append((op, time.perf_counter() - start, ok))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a vern server against a fake OpenAI endpoint')
+    parser.add_argument('--clients', type=int, default=16, help='Concurrent clients')
+    parser.add_argument('--requests', type=int, default=50, help='Requests per client')
+    parser.add_argument('--latency', type=float, default=50, help='Milliseconds the fake API takes per completion')
+    parser.add_argument('--response-bytes', type=int, default=2000, help='Size of each completion')
+    parser.add_argument('--chunks', type=int, default=20, help='Chunks of a streamed completion')
+    parser.add_argument('--mix', default=','.join(OPS), help='Comma separated requests the clients cycle through')
+    parser.add_argument('--stream', action='store_true', help='Stream the AI responses')
+    parser.add_argument('--server-mode', choices=['threaded', 'asyncio'], default='asyncio')
+    parser.add_argument('--max-workers', type=int, default=8, help='Handler threads of the server')
+    parser.add_argument('--out', help='Also write the report to this file')
+    args = parser.parse_args()
+
+    ops = args.mix.split(',')
+    if unknown := set(ops) - set(OPS):
+        parser.error(f"Unknown requests in --mix: {', '.join(sorted(unknown))}")
+
+    fake = FakeOpenAI(args.latency / 1000, args.response_bytes, args.chunks)
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory(prefix='vern-load-') as tmp_dir:
+        port = find_available_port()
+        process, startup = start_server(write_config(tmp_dir, args, port, fake.base_url), tmp_dir, port)
+        try:
+            samples = [proc_stats(process.pid)]
+            sampling = threading.Event()
+
+            def sample():
+                while not sampling.wait(0.2):
+                    samples.append(proc_stats(process.pid))
+
+            sampler = threading.Thread(target=sample, daemon=True)
+            sampler.start()
+
+            results = []
+            threads = [threading.Thread(target=client, args=(port, i, ops, args.requests, args.stream, results))
+                       for i in range(args.clients)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            duration = time.perf_counter() - start
+            sampling.set()
+            sampler.join()
+            samples.append(proc_stats(process.pid))
+            metrics = request(port, create_request(None, 'stats'))['data'].get('metrics')
+        finally:
+            try:
+                request(port, create_request(None, 'exit'))
+                process.wait(10)
+            except (OSError, RuntimeError, subprocess.TimeoutExpired):
+                process.kill()
+
+    timed = [r for r in results if r[0] != 'new-s']
+    report = {
+        'config': vars(args),
+        'startup_s': round(startup, 3),
+        'duration_s': round(duration, 3),
+        'requests': len(timed),
+        'errors': sum(1 for _, _, ok in results if not ok),
+        'throughput_rps': round(len(timed) / duration, 1),
+        'latency_ms': {'all': percentiles([latency for _, latency, _ in timed]),
+                       **{op: percentiles([latency for name, latency, _ in timed if name == op]) for op in ops}},
+        'server': {
+            'rss_mb_start': round(samples[0]['rss_mb'], 1),
+            'rss_mb_peak': round(max(s['rss_mb'] for s in samples), 1),
+            'rss_mb_end': round(samples[-1]['rss_mb'], 1),
+            'fds_peak': max(s['fds'] for s in samples),
+            'threads_peak': max(s['threads'] for s in samples),
+            'threads_end': samples[-1]['threads'],
+        },
+        'upstream_requests': fake.requests,
+        'server_metrics': metrics,
+    }
+    fake.shutdown()
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Fill a tiktoken cache directory with the BPE files of the given encodings, or of the
+encodings the given models use, so a vern server can load its tokenizers without network
+access.  Run it where the files can be downloaded and copy the directory to the server's
+tiktoken_cache_dir (<dpath>/tiktoken by default).
+
+    python scripts/seed_tiktoken_cache.py ~/.local/share/vern/tiktoken [--models gpt-4o o3-mini] [--encodings cl100k_base]
+"""
+
+import argparse
+import os
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a tiktoken cache directory for offline use')
+    parser.add_argument('cache_dir', help='Directory to fill, the server setting tiktoken_cache_dir')
+    parser.add_argument('--models', nargs='*', default=[], help='Models whose encodings to fetch')
+    parser.add_argument('--encodings', nargs='*', default=['cl100k_base', 'o200k_base'],
+                        help='Encodings to fetch (default: cl100k_base o200k_base)')
+    args = parser.parse_args()
+
+    cache_dir = os.path.abspath(os.path.expanduser(args.cache_dir))
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TIKTOKEN_CACHE_DIR'] = cache_dir  # Read by tiktoken when it loads a file
+    import tiktoken
+    import tiktoken.model
+
+    names = list(args.encodings)
+    for model in args.models:
+        try:
+            names.append(tiktoken.model.encoding_name_for_model(model))
+        except KeyError:
+            print(f"Unknown model {model}, the server falls back to cl100k_base", file=sys.stderr)
+            names.append('cl100k_base')
+
+    for name in dict.fromkeys(names):
+        tiktoken.get_encoding(name)
+        print(f"{name}: ok")
+    print(f"Cached in {cache_dir}: {', '.join(sorted(os.listdir(cache_dir)))}")
+
+
+if __name__ == '__main__':
+    main()
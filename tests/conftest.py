@@ -0,0 +1,132 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+import config as vern_config
+from utils import find_available_port
+
+
+class WordEncoder:
+    """Stand-in tokenizer counting words, so the tests don't need tiktoken's BPE files."""
+    def __init__(self, name="words"):
+        self.name = name
+        self.calls = 0
+
+    def encode(self, text):
+        self.calls += 1
+        return text.split()
+
+@pytest.fixture
+def config(tmp_path):
+    """Settings for sessions kept under tmp_path."""
+    return {'settings': {'dpath': str(tmp_path), 'model': 'gpt-4o'}}
+
+@pytest.fixture
+def fake_openai():
+    """
+    Local stand-in for the models and chat completions API.  A completion answers
+    '<number of user messages>: <last user message>', after delay seconds, and prompts
+    containing 'fail' get a 400 error.  Streamed completions come as one SSE chunk per
+    word and a usage chunk, prompts containing 'break' get an error event after the first word.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_json(self, status, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.send_json(200, {"object": "list", "data": [{"id": model, "object": "model", "created": 0, "owned_by": "test"}
+                                                            for model in ("gpt-4o", "gpt-3.5-turbo")]})
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            with server.lock:
+                server.requests += 1
+            time.sleep(server.delay)
+            user_messages = [m['content'] for m in request['messages'] if m['role'] == 'user']
+            if 'fail' in user_messages[-1]:
+                self.send_json(400, {"error": {"message": "Bad prompt", "type": "invalid_request_error"}})
+                return
+            content = f"{len(user_messages)}: {user_messages[-1]}"
+            usage = {"prompt_tokens": 5, "completion_tokens": 1, "total_tokens": 6}
+            if request.get('stream'):
+                self.send_stream(request['model'], content, usage, broken='break' in user_messages[-1])
+                return
+            self.send_json(200, {
+                "id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": request['model'],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        def send_stream(self, model, content, usage, broken):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            base = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "created": 0, "model": model}
+            words = re.findall(r"\S+\s*", content)
+            for n, word in enumerate(words):
+                if broken and n == 1:
+                    self.wfile.write(f"data: {json.dumps({'error': {'message': 'Stream broke', 'type': 'server_error'}})}\n\n".encode())
+                    return
+                choice = {"index": 0, "delta": {"content": word}, "finish_reason": "stop" if n == len(words) - 1 else None}
+                self.wfile.write(f"data: {json.dumps({**base, 'choices': [choice]})}\n\n".encode())
+            self.wfile.write(f"data: {json.dumps({**base, 'choices': [], 'usage': usage})}\n\ndata: [DONE]\n\n".encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.delay = 0
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+@pytest.fixture
+def live_server(tmp_path, monkeypatch, fake_openai):
+    """
+    Starts a CommandListener against fake_openai, start(server_mode, sections, **network)
+    returns it once it accepts connections, sections are further top-level config sections.  server_info.txt goes to tmp_path, the listener is
+    stopped after the test.
+    """
+    from vern_server import CommandListener
+
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    monkeypatch.setattr(vern_config, 'path', str(tmp_path / "config"))
+    monkeypatch.setattr(vern_config, 'server_info_file', str(tmp_path / "config" / "server_info.txt"))
+    listeners = []
+
+    def start(server_mode='asyncio', sections=None, **network):
+        server_config = {
+            'settings': {'dpath': str(tmp_path / "data"), 'model': 'gpt-4o'},
+            'network': {'host': '127.0.0.1', 'port': find_available_port(), 'server_mode': server_mode, 'max_workers': 4, **network},
+            'openai': {'base_url': fake_openai.base_url},
+            **(sections or {}),
+        }
+        listener = CommandListener(server_config)
+        listener.start()
+        listeners.append(listener)
+        deadline = time.monotonic() + 10
+        while 'accept_ready' not in listener.startup:  # Set once the listening sockets are bound
+            assert time.monotonic() < deadline, "Server did not start listening"
+            time.sleep(0.01)
+        return listener
+
+    yield start
+    for listener in listeners:
+        listener.stop()
+        listener.server_thread.join(5)
@@ -0,0 +1,52 @@
+import json
+import os
+from vern_client import Client
+
+def write_jsonl(path, entries):
+    with open(path, "w") as f:
+        f.writelines(json.dumps(entry) + "\n" for entry in entries)
+
+def read_results(path):
+    with open(path) as f:
+        return {result['index']: result for result in map(json.loads, f)}
+
+def run_batch(listener, tmp_path, entries, concurrency=4):
+    in_path, out_path = str(tmp_path / "prompts.jsonl"), str(tmp_path / "prompts.out.jsonl")
+    write_jsonl(in_path, entries)
+    Client("batch-test", config=listener.config).batch(in_path, out_path, concurrency)
+    return read_results(out_path)
+
+def test_items_of_a_sid_run_in_order(live_server, fake_openai, tmp_path):
+    """Items sharing a sid see the answers to the ones before them, whatever the concurrency."""
+    fake_openai.delay = 0.02
+    listener = live_server()
+    entries = [{'sid': sid, 'prompt': f"{sid}{n}"} for n in range(3) for sid in ("a", "b")]
+    results = run_batch(listener, tmp_path, entries)
+
+    assert [results[index]['content'] for index in range(6)] == ["1: a0", "1: b0", "2: a1", "2: b1", "3: a2", "3: b2"]
+    assert listener.session_contexts.get("a").user_and_assistant_content[-1]['content'] == "3: a2"
+
+def test_failed_items_reported_and_retried(live_server, fake_openai, tmp_path):
+    """A failing item gets an error result of its own, a rerun only sends the items that didn't succeed."""
+    listener = live_server()
+    entries = [{'prompt': "one"}, {'prompt': "please fail"}, {'prompt': "three", 'request_id': "r-3"}]
+    results = run_batch(listener, tmp_path, entries)
+
+    assert [results[index]['status'] for index in range(3)] == ["success", "error", "success"]
+    assert results[1]['code'] == "api_error"
+    assert results[2]['request_id'] == "r-3"
+    requests = fake_openai.requests
+
+    entries[1]['prompt'] = "two"
+    results = run_batch(listener, tmp_path, entries)
+    assert fake_openai.requests == requests + 1
+    assert results[1]['status'] == "success" and results[1]['content'] == "1: two"
+
+def test_throwaway_sessions_not_reused(live_server, tmp_path):
+    """Items without a sid get a fresh session each batch, removed once the item is done."""
+    listener = live_server()
+    for system in ("first", "second"):
+        results = run_batch(listener, tmp_path, [{'prompt': f"{system} prompt", 'system': system}])
+        os.remove(tmp_path / "prompts.out.jsonl")
+        assert results[0]['content'] == f"1: {system} prompt"
+        assert os.listdir(os.path.join(listener.temp_dir, "batch")) == []
@@ -0,0 +1,129 @@
+import json
+import socket
+import threading
+import pytest
+
+from connection import MuxConnection, pack_mux_frame, recv_mux_frame
+from protocol import FrameTooLargeError, create_request, create_response, recv_request
+
+
+@pytest.fixture
+def sock_pair():
+    """A connected pair of sockets, closed after the test."""
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+@pytest.fixture
+def mux_server(tmp_path):
+    """
+    A unix socket server acking one 'mux' request, then handing the connection to the
+    test's script(sock, requests) function, requests being the first n (rid, request) frames.
+    """
+    path = str(tmp_path / "mux.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+    threads = []
+
+    def serve(script, n):
+        def run():
+            sock, _ = listener.accept()
+            with sock:
+                assert recv_request(sock)['cmd'] == 'mux'
+                ack = create_response("test", 'success', 'ack', 'operation successful').encode()
+                sock.sendall(len(ack).to_bytes(4, 'big') + ack)
+                requests = [recv_mux_frame(sock) for _ in range(n)]
+                script(sock, [(rid, json.loads(payload)) for rid, payload in requests])
+
+        threads.append(threading.Thread(target=run))
+        threads[-1].start()
+        return MuxConnection([path], "test")
+
+    yield serve
+    for thread in threads:
+        thread.join(5)
+    listener.close()
+
+def response(rid, data):
+    return pack_mux_frame(rid, create_response("test", 'success', 'airesponse', data).encode())
+
+def test_mux_frame_round_trip(sock_pair):
+    client, server = sock_pair
+    client.sendall(pack_mux_frame(7, b"first") + pack_mux_frame(3, b"second"))
+    assert recv_mux_frame(server) == (7, b"first")
+    assert recv_mux_frame(server) == (3, b"second")
+
+def test_truncated_mux_frame(sock_pair):
+    """A connection closed within the header or payload of a frame raises instead of returning part of it."""
+    client, server = sock_pair
+    client.sendall(pack_mux_frame(1, b"x" * 100)[:50])
+    client.close()
+    with pytest.raises(RuntimeError):
+        recv_mux_frame(server)
+
+def test_truncated_mux_header(sock_pair):
+    client, server = sock_pair
+    client.sendall(pack_mux_frame(1, b"x")[:5])
+    client.close()
+    with pytest.raises(RuntimeError):
+        recv_mux_frame(server)
+
+def test_mux_frame_too_large(sock_pair):
+    """An oversized frame is rejected from its header, with the rid to answer on."""
+    client, server = sock_pair
+    client.sendall(pack_mux_frame(5, b"x" * 1000))
+    with pytest.raises(FrameTooLargeError) as e:
+        recv_mux_frame(server, max_frame_size=100)
+    assert e.value.rid == 5
+
+def test_out_of_order_replies(mux_server):
+    """Responses are routed by rid, whatever order they arrive in and however they interleave."""
+    def script(sock, requests):
+        rids = {req['data']: rid for rid, req in requests}
+        sock.sendall(response(rids['c'], "c") + response(rids['a'], "a1") + response(rids['b'], "b") + response(rids['a'], "a2"))
+
+    connection = mux_server(script, 3)
+    requests = {data: connection.request(create_request("test", 'query', data)) for data in "abc"}
+    assert len({request.rid for request in requests.values()}) == 3
+
+    received = {data: json.loads(request.recv_frame(timeout=5))['data'] for data, request in requests.items()}
+    assert received == {'a': "a1", 'b': "b", 'c': "c"}
+    assert json.loads(requests['a'].recv_frame(timeout=5))['data'] == "a2"
+    connection.close()
+
+def test_requests_pipelined_from_threads(mux_server):
+    """Requests sent from several threads at once get their own rids and their own answers."""
+    def script(sock, requests):
+        for rid, req in reversed(requests):
+            sock.sendall(response(rid, req['data'].upper()))
+
+    connection = mux_server(script, 8)
+    answers = {}
+
+    def query(n):
+        with connection.request(create_request("test", 'query', f"q{n}")) as request:
+            answers[n] = json.loads(request.recv_frame(timeout=5))['data']
+
+    threads = [threading.Thread(target=query, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert answers == {n: f"Q{n}" for n in range(8)}
+    connection.close()
+
+def test_truncated_frame_fails_pending_requests(mux_server):
+    """A connection cut within a frame ends every request still waiting on it."""
+    def script(sock, requests):
+        sock.sendall(response(requests[0][0], "partial")[:20])
+
+    connection = mux_server(script, 2)
+    requests = [connection.request(create_request("test", 'query', data)) for data in "ab"]
+    for request in requests:
+        with pytest.raises(RuntimeError):
+            request.recv_frame(timeout=5)
+    assert connection.closed
+    with pytest.raises(RuntimeError):
+        connection.request(create_request("test", 'query', "c"))
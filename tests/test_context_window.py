@@ -0,0 +1,53 @@
+import os
+import pytest
+from context_window import ContextWindow
+from session_context import SessionContext
+from conftest import WordEncoder
+
+@pytest.fixture
+def session(tmp_path):
+    """A session with four turns of two-word messages and a one-word system content."""
+    session = SessionContext("window", {'settings': {'dpath': str(tmp_path)}}, system_content="terse")
+    session.set_encoder(WordEncoder())
+    for n in range(4):
+        session.add_user_content(f"question {n}")
+        session.add_assistant_content(f"answer {n}")
+    return session
+
+def contents(messages):
+    return [m['content'] for m in messages]
+
+def test_sliding_window(session):
+    """The newest messages within the budget are sent, starting with a question."""
+    messages, tokens = ContextWindow('sliding', budget=8).select(session)
+    assert contents(messages) == ["question 3", "answer 3"]
+    assert tokens == 5
+
+def test_pin_window(session):
+    """The first turns are always sent, followed by the newest messages that fit."""
+    messages, tokens = ContextWindow('pin', budget=10, pin_turns=1).select(session)
+    assert contents(messages) == ["question 0", "answer 0", "question 3", "answer 3"]
+    assert tokens == 9
+
+def test_summary_window(session):
+    """Older messages are replaced by a stored summary, the conversation itself is kept."""
+    summarized = []
+    def summarize(previous, messages):
+        summarized.append(contents(messages))
+        return "earlier"
+
+    messages, tokens = ContextWindow('summary', budget=16).select(session, summarize)
+    assert tokens == 11
+    assert summarized == [["question 0", "answer 0", "question 1", "answer 1", "question 2", "answer 2"]]
+    assert contents(messages)[1:] == ["question 3", "answer 3"]
+    assert messages[0]['content'].endswith("earlier")
+    assert len(session.user_and_assistant_content) == 8
+    assert os.path.exists(session.summary_file)
+
+    # Within budget now, no new summary until more messages arrive
+    ContextWindow('summary', budget=16).select(session, summarize)
+    assert len(summarized) == 1
+
+def test_session_settings_override(session):
+    window = ContextWindow.from_settings({'context_policy': 'pin'}, {'context_policy': 'sliding', 'context_budget': 50000}, 30000)
+    assert (window.policy, window.budget) == ('pin', 30000)
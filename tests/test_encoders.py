@@ -0,0 +1,35 @@
+import threading
+from encoders import APPROX, EncoderCache
+from conftest import WordEncoder
+
+class FakeEncoderCache(EncoderCache):
+    """Loads WordEncoder once release is set, raises for models named 'offline'."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.release = threading.Event()
+
+    def load(self, model_name):
+        self.release.wait()
+        if model_name == "offline":
+            raise OSError("network unreachable")
+        return WordEncoder()
+
+def test_approx_until_loaded(tmp_path):
+    """Requests get approximate counts instead of waiting for the tokenizer."""
+    encoders = FakeEncoderCache(str(tmp_path / "tiktoken"))
+    assert encoders.get("gpt-4o") is APPROX
+    assert len(APPROX.encode("x" * 10)) == 3
+
+    encoders.release.set()
+    assert encoders.ready.wait(1)
+    assert encoders.get("gpt-4o").name == "words"
+    assert encoders.stats()['loaded'] == {"gpt-4o": "words"}
+
+def test_load_failure_retried(tmp_path):
+    encoders = FakeEncoderCache(str(tmp_path / "tiktoken"), retry_interval=0)
+    encoders.release.set()
+    encoders.warm("offline")
+    assert encoders.ready.wait(1)
+    assert encoders.get("offline") is APPROX
+    assert encoders.stats()['failed'] == ["offline"]
@@ -0,0 +1,52 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from http_client import KeepWarm, PoolStats, build_http_client
+
+@pytest.fixture
+def local_server():
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive, so connections can be reused
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/"
+    server.shutdown()
+
+def test_pool_stats_count_reuse(local_server):
+    """Requests after the first reuse the pooled connection."""
+    pool_stats = PoolStats()
+    with build_http_client({}, 2, pool_stats) as client:
+        for _ in range(4):
+            assert client.get(local_server).text == "ok"
+
+    stats = pool_stats.stats()
+    assert (stats['requests'], stats['connections'], stats['reuse_rate']) == (4, 1, 0.75)
+
+def test_keep_warm_pings_when_idle():
+    pings = []
+    keep_warm = KeepWarm(lambda: pings.append(time.monotonic()), 0.05)
+    keep_warm.start()
+    time.sleep(0.2)
+    keep_warm.stop()
+    assert len(pings) >= 2
+
+    # No pings while in use
+    pings.clear()
+    keep_warm = KeepWarm(lambda: pings.append(time.monotonic()), 0.1)
+    keep_warm.start()
+    for _ in range(10):
+        keep_warm.touch()
+        time.sleep(0.02)
+    keep_warm.stop()
+    assert not pings
@@ -0,0 +1,46 @@
+import urllib.request
+import pytest
+from metrics import Histogram, Metrics, serve_prometheus
+
+def test_histogram_quantiles():
+    """Quantiles are within a bucket (a factor sqrt(2)) of the exact value."""
+    histogram = Histogram()
+    for ms in range(1, 1001):
+        histogram.observe(ms / 1000)
+    assert histogram.count == 1000
+    assert histogram.quantile(0.5) == pytest.approx(0.5, rel=0.42)
+    assert histogram.quantile(0.99) == pytest.approx(0.99, rel=0.42)
+    assert Histogram().quantile(0.5) is None
+
+def test_snapshot_by_label():
+    registry = Metrics()
+    registry.inc('commands_total', cmd='query')
+    registry.inc('commands_total', cmd='query')
+    registry.inc('bytes_in_total', 100)
+    with registry.timer('command_seconds', cmd='list-s'):
+        pass
+    registry.gauge('threads', lambda: 3)
+
+    snapshot = registry.snapshot()
+    assert snapshot['counters'] == {'commands_total': {'query': 2}, 'bytes_in_total': 100}
+    assert snapshot['histograms']['command_seconds']['list-s']['count'] == 1
+    assert snapshot['gauges'] == {'threads': 3}
+
+def test_prometheus_endpoint():
+    registry = Metrics()
+    registry.inc('commands_total', cmd='query')
+    registry.observe('command_seconds', 0.01, cmd='query')
+    server = serve_prometheus(registry, '127.0.0.1', 0)
+    try:
+        text = urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics").read().decode()
+    finally:
+        server.shutdown()
+
+    assert 'vern_commands_total{cmd="query"} 1' in text
+    assert 'vern_command_seconds_bucket{cmd="query",le="+Inf"} 1' in text
+    assert 'vern_command_seconds_count{cmd="query"} 1' in text
+
+def test_prometheus_label_escaping():
+    registry = Metrics()
+    registry.inc('upstream_requests_total', model='a"b\\c\nd')
+    assert 'vern_upstream_requests_total{model="a\\"b\\\\c\\nd"} 1' in registry.prometheus()
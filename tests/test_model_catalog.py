@@ -0,0 +1,40 @@
+import pytest
+from model_catalog import DEFAULT_METADATA, ModelCatalog
+
+def test_refresh_persists(tmp_path):
+    """The fetched list is served from memory and survives a restart."""
+    fetches = []
+    def fetch():
+        fetches.append(1)
+        return ["gpt-4o", "o3-mini", "gpt-4o"]
+
+    path = str(tmp_path / "models.json")
+    catalog = ModelCatalog(path, fetch)
+    assert catalog.is_known("anything")  # Nothing to check against yet
+    catalog.refresh()
+    assert catalog.ids() == ["gpt-4o", "o3-mini"]
+    assert catalog.is_known("o3-mini") and not catalog.is_known("gpt-5-turbo")
+
+    restarted = ModelCatalog(path, fetch)
+    assert restarted.load()
+    assert restarted.ids() == ["gpt-4o", "o3-mini"]
+    assert restarted.age() < 60
+    assert len(fetches) == 1
+
+def test_failed_refresh_keeps_models(tmp_path):
+    catalog = ModelCatalog(str(tmp_path / "models.json"), lambda: ["gpt-4o"])
+    catalog.refresh()
+    catalog.fetch = lambda: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        catalog.refresh()
+    assert catalog.ids() == ["gpt-4o"]
+    assert catalog.stats()['errors'] == 1
+
+def test_metadata_by_prefix(tmp_path):
+    catalog = ModelCatalog(str(tmp_path / "models.json"), list, overrides={"my-model": {"context_limit": 1000}})
+    assert catalog.metadata("gpt-4o-2024-08-06")['max_completion_tokens'] == 16384
+    assert catalog.metadata("gpt-4o-mini")['tokenizer'] == "o200k_base"
+    assert catalog.metadata("gpt-4-turbo-preview")['context_limit'] == 128000
+    assert catalog.metadata("unknown") == DEFAULT_METADATA
+    assert catalog.prompt_limit("unknown") == 30000
+    assert catalog.metadata("my-model")['context_limit'] == 1000
@@ -0,0 +1,59 @@
+import os
+import pstats
+import threading
+import time
+import pytest
+from profiling import Profiler
+
+def busy(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        sum(range(1000))
+
+def test_cprofile_after_requests(tmp_path):
+    """A cProfile run stops itself after the requested number of requests."""
+    profiler = Profiler(str(tmp_path))
+    profiler.start('cprofile', requests=2)
+    for _ in range(2):
+        busy(0.01)
+        profiler.request_done('query')
+
+    result = profiler.status()['last']
+    assert not profiler.status()['active']
+    assert result['requests'] == 2
+    assert 'busy' in {func[2] for func in pstats.Stats(result['files'][0]).stats}
+
+def test_sampling_all_threads(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    profiler.start('sample', seconds=0.3)
+    worker = threading.Thread(target=busy, args=(0.2,), name='worker')
+    worker.start()
+    worker.join()
+    time.sleep(0.2)  # The run stops itself
+
+    result = profiler.status()['last']
+    with open(result['files'][0]) as f:
+        stacks = f.read().splitlines()
+    assert any(line.startswith('worker;') and 'busy (test_profiling.py' in line for line in stacks)
+
+def test_memory_report(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    profiler.start('cprofile', memory=True)
+    with profiler.measure_load('abc'):
+        data = [bytearray(1024) for _ in range(100)]
+    result = profiler.stop()
+
+    with open(result['files'][1]) as f:
+        report = f.read()
+    assert "Session loads: 1" in report and "abc:" in report
+    del data
+
+def test_invalid_and_busy(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    with pytest.raises(ValueError):
+        profiler.start('perf')
+    profiler.start('sample')
+    with pytest.raises(ValueError):
+        profiler.start('sample')
+    assert os.path.exists(profiler.stop()['files'][0])
+    assert profiler.stop() is None
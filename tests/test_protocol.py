@@ -0,0 +1,64 @@
+import json
+import socket
+import threading
+import pytest
+
+from protocol import FrameTooLargeError, create_request, encode_request, recv_request
+
+
+@pytest.fixture
+def sock_pair():
+    """A connected pair of sockets, closed after the test."""
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+def send_in_thread(sock, data):
+    """Send from a thread so large payloads don't fill the socket buffer and block the test."""
+    thread = threading.Thread(target=sock.sendall, args=(data,))
+    thread.start()
+    return thread
+
+def test_framed_request(sock_pair):
+    """A framed request is parsed from the length prefix."""
+    client, server = sock_pair
+    req = create_request("test", "query", "hello, server!")
+    client.sendall(encode_request(req))
+    assert recv_request(server) == json.loads(req)
+
+def test_large_framed_request(sock_pair):
+    """A multi-megabyte framed request arrives intact."""
+    client, server = sock_pair
+    data = "x" * (2 * 1024 * 1024)
+    thread = send_in_thread(client, encode_request(create_request("test", "query", data)))
+    assert recv_request(server)["data"] == data
+    thread.join()
+
+def test_legacy_request(sock_pair):
+    """Bare JSON requests from older clients are still accepted."""
+    client, server = sock_pair
+    req = create_request("test", "list-s")
+    client.sendall(req.encode())
+    assert recv_request(server) == json.loads(req)
+
+def test_legacy_request_multibyte(sock_pair):
+    """A multibyte character split across reads doesn't break legacy parsing."""
+    client, server = sock_pair
+    req = json.dumps({"sid": "test", "cmd": "query", "data": "é" * 2000}, ensure_ascii=False)
+    thread = send_in_thread(client, b" " + req.encode())
+    assert recv_request(server) == json.loads(req)
+    thread.join()
+
+def test_frame_too_large(sock_pair):
+    """An oversized frame is rejected from its header alone."""
+    client, server = sock_pair
+    client.sendall(encode_request(create_request("test", "query", "x" * 1000)))
+    with pytest.raises(FrameTooLargeError):
+        recv_request(server, max_frame_size=100)
+
+def test_closed_before_request(sock_pair):
+    """A connection closed without sending anything yields no request."""
+    client, server = sock_pair
+    client.close()
+    assert recv_request(server) is None
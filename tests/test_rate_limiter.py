@@ -0,0 +1,78 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import openai
+import pytest
+from rate_limiter import RateLimiter, TokenBucket, parse_duration
+
+COMPLETION = {
+    "id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": "gpt-4o",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "hi"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 5, "completion_tokens": 1, "total_tokens": 6},
+}
+
+@pytest.fixture
+def fake_endpoint():
+    """Local stand-in for the chat completions API, answers 429 to the first `rejections` requests."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            server.requests += 1
+            if server.requests <= server.rejections:
+                body = json.dumps({"error": {"message": "Rate limit reached", "type": "requests"}}).encode()
+                self.send_response(429)
+                self.send_header('retry-after-ms', '50')
+            else:
+                body = json.dumps(COMPLETION).encode()
+                self.send_response(200)
+                self.send_header('x-ratelimit-remaining-tokens', '1000')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.requests = 0
+    server.rejections = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+def request(server):
+    client = openai.OpenAI(api_key="test", base_url=f"http://127.0.0.1:{server.server_address[1]}/v1", max_retries=0)
+    return lambda: client.chat.completions.with_raw_response.create(model="gpt-4o", messages=[{"role": "user", "content": "hi"}])
+
+def test_retry_after_429(fake_endpoint):
+    """429s are retried after Retry-After, the rate limit headers update the budget."""
+    fake_endpoint.rejections = 2
+    limiter = RateLimiter(max_retries=3)
+    completion = limiter.call("gpt-4o", 5, request(fake_endpoint))
+
+    assert completion.choices[0].message.content == "hi"
+    assert fake_endpoint.requests == 3
+    assert limiter.stats()['retries'] == 2
+    assert limiter.buckets["gpt-4o"][1].level <= 1000
+
+def test_gives_up_after_max_retries(fake_endpoint):
+    fake_endpoint.rejections = 10
+    limiter = RateLimiter(max_retries=1)
+    with pytest.raises(openai.RateLimitError):
+        limiter.call("gpt-4o", 5, request(fake_endpoint))
+    assert fake_endpoint.requests == 2
+
+def test_requests_paced():
+    """Past the per-minute budget requests wait for the bucket to refill."""
+    limiter = RateLimiter(rpm=600)  # One request every 0.1s
+    limiter.buckets["m"] = (TokenBucket(1, period=0.1), TokenBucket(1000))
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.acquire("m", 1)
+    assert time.monotonic() - start >= 0.15
+
+def test_parse_duration():
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("20ms") == pytest.approx(0.02)
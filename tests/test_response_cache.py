@@ -0,0 +1,43 @@
+import time
+from response_cache import ResponseCache
+
+RESPONSE = {'content': 'cached answer', 'finish_reason': 'stop', 'model': 'gpt-4o', 'usage': None}
+
+def test_key_depends_on_request():
+    messages = [{'role': 'user', 'content': 'hi'}]
+    key = ResponseCache.key('gpt-4o', messages, {'max_completion_tokens': 10})
+    assert key == ResponseCache.key('gpt-4o', list(messages), {'max_completion_tokens': 10})
+    assert key != ResponseCache.key('o3-mini', messages, {'max_completion_tokens': 10})
+    assert key != ResponseCache.key('gpt-4o', messages, {'max_completion_tokens': 20})
+
+def test_memory_and_disk_tiers(tmp_path):
+    """Responses are served from memory, and from disk by a new cache instance."""
+    cache = ResponseCache(str(tmp_path))
+    assert cache.get('a' * 64) is None
+    cache.put('a' * 64, RESPONSE)
+    assert cache.get('a' * 64) == RESPONSE
+
+    reopened_cache = ResponseCache(str(tmp_path))
+    assert reopened_cache.get('a' * 64) == RESPONSE
+    assert reopened_cache.stats()['disk_hits'] == 1
+
+    refreshed = {**RESPONSE, 'content': 'fresh answer'}
+    reopened_cache.put('a' * 64, refreshed)
+    assert ResponseCache(str(tmp_path)).get('a' * 64) == refreshed
+
+def test_ttl(tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=-1)
+    cache.put('b' * 64, RESPONSE)
+    assert cache.get('b' * 64) is None
+
+def test_disk_eviction(tmp_path):
+    """Past the disk budget the oldest responses are removed."""
+    cache = ResponseCache(str(tmp_path), max_entries=0, max_disk_bytes=300)
+    for n in range(4):
+        cache.put(f"{n}" * 64, RESPONSE)
+        time.sleep(0.01)  # Distinct mtimes
+
+    assert cache.disk_bytes <= 300
+    assert cache.get("3" * 64) == RESPONSE
+    assert cache.get("0" * 64) is None
+    assert cache.stats()['evictions'] > 0
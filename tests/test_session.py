@@ -1,7 +1,10 @@
 import os
 import json
+import time
 import pytest
 from session_context import SessionContext  # Adjust the import if needed
+from persistence import flusher
+from conftest import WordEncoder
 
 @pytest.fixture
 def temp_session(tmp_path):
@@ -73,3 +76,153 @@ def test_change_system_content(temp_session, tmp_path):
     loaded_session = SessionContext(temp_session.sid, config)
     loaded_session_system_content = loaded_session.get_system_content()
     assert loaded_session_system_content == system_content, "System message did not persist correctly."
+
+@pytest.fixture
+def journal_config(tmp_path):
+    return {'settings': {'dpath': str(tmp_path), 'storage': 'journal', 'journal_compact_every': 3}}
+
+def test_journal_appends_messages(journal_config):
+    """In journal mode messages are appended to conversation.jsonl and replayed on load."""
+    session = SessionContext("journal-1", journal_config)
+    session.add_user_content("first")
+    session.add_assistant_content("second")
+
+    with open(session.journal_file, "r") as f:
+        assert len(f.readlines()) == 2, "Messages were not appended to the journal."
+
+    loaded_session = SessionContext("journal-1", journal_config)
+    assert [m['content'] for m in loaded_session.user_and_assistant_content] == ["first", "second"]
+
+def test_journal_compaction(journal_config):
+    """The journal is folded into conversation.json once it reaches journal_compact_every records."""
+    session = SessionContext("journal-2", journal_config)
+    for n in range(4):
+        session.add_user_content(f"message {n}")
+
+    with open(session.conversation_file, "r") as f:
+        assert len(json.load(f)) == 3, "Snapshot does not hold the compacted messages."
+    with open(session.journal_file, "r") as f:
+        assert len(f.readlines()) == 1, "Journal was not truncated on compaction."
+
+    loaded_session = SessionContext("journal-2", journal_config)
+    assert [m['content'] for m in loaded_session.user_and_assistant_content] == [f"message {n}" for n in range(4)]
+
+def test_journal_migrates_json_session(tmp_path, journal_config):
+    """A session saved as conversation.json loads in journal mode and keeps its messages."""
+    session = SessionContext("journal-3", {'settings': {'dpath': str(tmp_path)}})
+    session.add_user_content("old message")
+
+    loaded_session = SessionContext("journal-3", journal_config)
+    loaded_session.add_user_content("new message")
+    reloaded_session = SessionContext("journal-3", journal_config)
+    assert [m['content'] for m in reloaded_session.user_and_assistant_content] == ["old message", "new message"]
+
+def test_journal_torn_record_then_append(journal_config):
+    """A torn last record is cut off on load, so messages appended after it load again."""
+    journal_config['settings']['journal_compact_every'] = 100
+    session = SessionContext("journal-5", journal_config)
+    session.add_user_content("one")
+    with open(session.journal_file, "a") as f:
+        f.write('{"op": "add", "seq": 1, "mess')
+
+    loaded_session = SessionContext("journal-5", journal_config)
+    loaded_session.add_user_content("two")
+    loaded_session.add_assistant_content("three")
+
+    reloaded_session = SessionContext("journal-5", journal_config)
+    assert [m['content'] for m in reloaded_session.user_and_assistant_content] == ["one", "two", "three"]
+
+def test_journal_record_without_newline(journal_config):
+    """A complete last record missing its newline is kept and ended before the next append."""
+    journal_config['settings']['journal_compact_every'] = 100
+    session = SessionContext("journal-6", journal_config)
+    session.add_user_content("one")
+    with open(session.journal_file, "r+") as f:
+        f.truncate(len(f.read().rstrip("\n")))
+
+    loaded_session = SessionContext("journal-6", journal_config)
+    loaded_session.add_user_content("two")
+    reloaded_session = SessionContext("journal-6", journal_config)
+    assert [m['content'] for m in reloaded_session.user_and_assistant_content] == ["one", "two"]
+
+def test_journal_reset(journal_config):
+    """A reset clears the conversation and the journal."""
+    session = SessionContext("journal-4", journal_config)
+    session.add_user_content("forget me")
+    session.reset()
+
+    loaded_session = SessionContext("journal-4", journal_config)
+    assert loaded_session.user_and_assistant_content == []
+
+def test_write_behind_flush(journal_config):
+    """With write_behind, messages reach the disk when the session is flushed, in one journal append."""
+    journal_config['settings']['write_behind'] = True
+    session = SessionContext("write-behind-1", journal_config)
+    session.add_user_content("first")
+    session.add_assistant_content("second")
+
+    assert session.pending_records, "Messages were written in the request path."
+
+    flusher.flush_all()
+    assert not session.pending_records
+    loaded_session = SessionContext("write-behind-1", journal_config)
+    assert [m['content'] for m in loaded_session.user_and_assistant_content] == ["first", "second"]
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+def test_write_behind_interval(journal_config):
+    """The flusher writes a session dirtied after an earlier flush within the interval, without flush_all."""
+    journal_config['settings']['write_behind'] = True
+    interval = flusher.interval
+    flusher.configure(interval=0.05)
+
+    def on_disk():
+        return [m['content'] for m in SessionContext("write-behind-2", journal_config).user_and_assistant_content]
+
+    try:
+        session = SessionContext("write-behind-2", journal_config)
+        session.add_user_content("first")
+        assert wait_for(lambda: on_disk() == ["first"]), "First write was not flushed."
+
+        session.add_assistant_content("second")
+        assert wait_for(lambda: on_disk() == ["first", "second"]), "Write after the first flush was not flushed."
+    finally:
+        flusher.configure(interval=interval)
+
+def test_token_counts_cached(tmp_path):
+    """Messages are encoded once, the running total follows additions and resets."""
+    session = SessionContext("tokens-1", {'settings': {'dpath': str(tmp_path)}}, system_content="be terse")
+    encoder = WordEncoder("words")
+    session.set_encoder(encoder)
+    session.add_user_content("one two three")
+    session.add_assistant_content("four")
+    assert session.token_count == 6
+
+    calls = encoder.calls
+    session.set_encoder(encoder)
+    assert encoder.calls == calls, "Messages were encoded again."
+
+    loaded_session = SessionContext("tokens-1", {'settings': {'dpath': str(tmp_path)}})
+    loaded_session.set_encoder(WordEncoder("words"))
+    assert loaded_session.token_count == 6
+    assert loaded_session.encoder.calls == 0, "Persisted token counts were not used."
+
+    loaded_session.reset()
+    assert loaded_session.token_count == 2
+
+def test_token_counts_new_encoding(tmp_path):
+    """Switching to another encoding recounts the messages and strips counts from API messages."""
+    session = SessionContext("tokens-2", {'settings': {'dpath': str(tmp_path)}}, system_content="be terse")
+    session.set_encoder(WordEncoder("words"))
+    session.add_user_content("one two three")
+
+    chars = WordEncoder("chars")
+    chars.encode = lambda text: list(text)
+    session.set_encoder(chars)
+    assert session.token_count == len("be terse") + len("one two three")
+    assert session.user_and_assistant_content[0]['tokens'] == {'words': 3, 'chars': 13}
+    assert session.api_messages(session.user_and_assistant_content) == [{'role': 'user', 'content': 'one two three'}]
@@ -0,0 +1,35 @@
+from session_cache import SessionCache
+from session_context import SessionContext
+
+def test_lru_eviction(config):
+    """Past max_sessions the least recently used session is dropped."""
+    cache = SessionCache(max_sessions=2)
+    for sid in ("a", "b"):
+        cache.add(sid, SessionContext(sid, config))
+    cache.get("a")
+    cache.add("c", SessionContext("c", config))
+
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+    assert cache.stats()['evictions'] == 1
+
+def test_eviction_flushes_session(config):
+    """An evicted session is saved first, so reloading it keeps its messages."""
+    config['settings']['write_behind'] = True
+    cache = SessionCache(max_bytes=0)
+    with cache.pinned("a"):
+        session = cache.add("a", SessionContext("a", config))
+        session.add_user_content("keep me")
+    assert "a" not in cache
+
+    loaded_session = SessionContext("a", config)
+    assert [m['content'] for m in loaded_session.user_and_assistant_content] == ["keep me"]
+
+def test_pinned_session_not_evicted(config):
+    """A session in use by a request stays resident even over budget."""
+    cache = SessionCache(max_sessions=1)
+    with cache.pinned("a"):
+        cache.add("a", SessionContext("a", config))
+        cache.add("b", SessionContext("b", config))
+        assert "a" in cache
+    assert len(cache) == 1
@@ -0,0 +1,58 @@
+import os
+from persistence import flusher
+from session_catalog import SessionCatalog
+from session_context import SessionContext
+
+def test_list_sorted_and_paged(tmp_path, config):
+    """Sessions are listed numbers first, then by name, and can be filtered and paged."""
+    catalog = SessionCatalog(str(tmp_path))
+    for sid in ("beta", "2", "Alpha", "1"):
+        catalog.update(SessionContext(sid, config, system_content=f"system of {sid}"))
+
+    entries, total = catalog.list()
+    assert [entry['sid'] for entry in entries] == ["1", "2", "Alpha", "beta"]
+    assert total == 4
+
+    entries, total = catalog.list(offset=1, limit=2)
+    assert [entry['sid'] for entry in entries] == ["2", "Alpha"]
+
+    entries, total = catalog.list(filter="of b")
+    assert [entry['sid'] for entry in entries] == ["beta"] and total == 1
+
+def test_catalog_persists_updates(tmp_path, config):
+    """Updates and removals are saved to catalog.json."""
+    catalog = SessionCatalog(str(tmp_path))
+    session = SessionContext("a", config)
+    catalog.update(session)
+    session.add_user_content("hello")
+    catalog.update(session)
+    catalog.update(SessionContext("b", config))
+    catalog.remove("b")
+    flusher.flush_all()
+
+    loaded_catalog = SessionCatalog(str(tmp_path))
+    assert loaded_catalog.load()
+    entries, _ = loaded_catalog.list()
+    assert [(entry['sid'], entry['messages'], entry['model']) for entry in entries] == [("a", 1, "gpt-4o")]
+
+def test_rebuild(tmp_path, config):
+    """A catalog rebuilt from the session directories lists every session."""
+    for sid in ("x", "y"):
+        SessionContext(sid, config)
+
+    catalog = SessionCatalog(str(tmp_path))
+    assert not catalog.load()
+    assert catalog.rebuild(lambda sid: SessionContext(sid, config)) == 2
+    assert [entry['sid'] for entry in catalog.list()[0]] == ["x", "y"]
+
+def test_updates_written_behind(tmp_path, config):
+    """Updates only mark the catalog dirty, the flusher writes catalog.json once for all of them."""
+    catalog = SessionCatalog(str(tmp_path))
+    with flusher.flush_lock:  # Keep the flusher thread from writing in between
+        for sid in ("a", "b", "c"):
+            catalog.update(SessionContext(sid, config))
+        assert not os.path.exists(catalog.path)
+
+    flusher.flush_all()
+    loaded_catalog = SessionCatalog(str(tmp_path))
+    assert loaded_catalog.load() and loaded_catalog.list()[1] == 3
@@ -0,0 +1,60 @@
+import threading
+import time
+import pytest
+from singleflight import SingleFlight, SingleFlightTimeout
+
+def run_concurrently(n, target):
+    results = [None] * n
+    def worker(i):
+        try:
+            results[i] = target()
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_identical_calls_coalesced():
+    """Concurrent calls with the same key share one execution."""
+    flight = SingleFlight()
+    calls = []
+    def fn():
+        calls.append(1)
+        time.sleep(0.2)
+        return "response"
+
+    results = run_concurrently(4, lambda: flight.do("key", fn))
+    assert results == ["response"] * 4
+    assert len(calls) == 1
+    assert flight.stats() == {'in_flight': 0, 'calls': 1, 'coalesced': 3}
+
+def test_error_propagated():
+    """Waiting calls get the exception of the call they waited for."""
+    flight = SingleFlight()
+    def fn():
+        time.sleep(0.2)
+        raise ValueError("upstream failed")
+
+    results = run_concurrently(3, lambda: flight.do("key", fn))
+    assert all(isinstance(result, ValueError) for result in results)
+
+    # The failed call is not remembered
+    assert flight.do("key", lambda: "retried") == "retried"
+
+def test_timeout():
+    flight = SingleFlight()
+    started = threading.Event()
+    def fn():
+        started.set()
+        time.sleep(0.5)
+        return "late"
+
+    thread = threading.Thread(target=flight.do, args=("key", fn))
+    thread.start()
+    started.wait()
+    with pytest.raises(SingleFlightTimeout):
+        flight.do("key", fn, timeout=0.05)
+    thread.join()
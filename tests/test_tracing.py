@@ -0,0 +1,60 @@
+import logging
+import threading
+import time
+from tracing import Tracer
+
+def test_spans_tagged_and_exported():
+    """Spans within a request carry its sid and cmd and come out as complete events."""
+    tracer = Tracer()
+    with tracer.request("abc", "query"):
+        with tracer.span("upstream", model="gpt-4o"):
+            time.sleep(0.01)
+    with tracer.span("session_flush"):
+        pass
+
+    events = [e for e in tracer.chrome_trace()['traceEvents'] if e['ph'] == 'X']
+    assert [e['name'] for e in events] == ["upstream", "request", "session_flush"]
+    assert events[0]['args'] == {'sid': "abc", 'cmd': "query", 'model': "gpt-4o"}
+    assert events[0]['dur'] >= 10000  # Microseconds
+    assert events[2]['args'] == {}
+
+def test_ring_buffer_and_clear():
+    tracer = Tracer(capacity=3)
+    for i in range(5):
+        with tracer.span(f"span{i}"):
+            pass
+    assert [e['name'] for e in tracer.chrome_trace(clear=True)['traceEvents'] if e['ph'] == 'X'] == ["span2", "span3", "span4"]
+    assert not tracer.spans
+
+def test_slow_request_logged(caplog):
+    tracer = Tracer(slow_ms=5)
+    with caplog.at_level(logging.WARNING):
+        with tracer.request("abc", "query"):
+            with tracer.span("upstream"):
+                time.sleep(0.01)
+        with tracer.request("abc", "list-s"):
+            pass
+    assert len(caplog.records) == 1
+    assert "Slow request query for abc" in caplog.text and "upstream" in caplog.text
+
+def test_disabled():
+    tracer = Tracer(enabled=False)
+    with tracer.request("abc", "query"), tracer.span("upstream"):
+        pass
+    assert not tracer.spans
+
+def test_span_added_within_request():
+    """A phase timed before the request was known is tagged once recorded within it, on the thread it ran on."""
+    tracer = Tracer()
+    loop_thread = threading.Thread(target=lambda: None, name='loop')
+    loop_thread.start()
+    loop_thread.join()
+    start = time.perf_counter_ns()
+    with tracer.request("abc", "query"):
+        tracer.add("recv_request", start, 1000, loop_thread)
+
+    events = tracer.chrome_trace()['traceEvents']
+    event = next(e for e in events if e['name'] == "recv_request")
+    assert event['args'] == {'sid': "abc", 'cmd': "query"}
+    assert event['ts'] == start / 1000 and event['tid'] == loop_thread.ident
+    assert {'name': 'loop'} in [e['args'] for e in events if e['ph'] == 'M']
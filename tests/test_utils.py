@@ -0,0 +1,35 @@
+import os
+import sys
+import threading
+
+from utils import atomic_write, load_config_cached
+
+
+def test_load_config_cached(tmp_path):
+    """The cached copy is used until the YAML file changes."""
+    config_path = tmp_path / "config.yaml"
+    cache_path = str(tmp_path / "cache" / "config.json")
+    config_path.write_text("settings:\n  model: a\n")
+
+    assert load_config_cached(str(config_path), cache_path)['settings']['model'] == "a"
+    sys.modules.pop('yaml', None)
+    assert load_config_cached(str(config_path), cache_path)['settings']['model'] == "a"
+    assert 'yaml' not in sys.modules
+
+    config_path.write_text("settings:\n  model: bb\n")
+    assert load_config_cached(str(config_path), cache_path)['settings']['model'] == "bb"
+
+
+def test_atomic_write_concurrent(tmp_path):
+    """Concurrent writers of one file each replace it whole and leave no temp files behind."""
+    path = str(tmp_path / "catalog.json")
+    payloads = [str(n) * 100000 for n in range(8)]
+    threads = [threading.Thread(target=atomic_write, args=(path, data)) for data in payloads]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with open(path) as f:
+        assert f.read() in payloads
+    assert os.listdir(tmp_path) == ["catalog.json"]
@@ -0,0 +1,243 @@
+import json
+import os
+import socket
+import threading
+import uuid
+import pytest
+from connection import MuxConnection, SocketRequest
+from protocol import create_request, parse_response
+from session_context import SessionContext
+from vern_client import Client
+
+def send(listener, req, address=None):
+    """Send req on a connection of its own, returns the response."""
+    address = address or (listener.config['network']['host'], listener.config['network']['port'])
+    with SocketRequest([address], req) as request:
+        return parse_response(request.recv_frame())
+
+@pytest.mark.parametrize('server_mode', ['asyncio', 'threaded'])
+def test_session_round_trip(live_server, server_mode):
+    """A session is created, queried and listed in both serving modes."""
+    listener = live_server(server_mode)
+    assert send(listener, create_request("s1", 'new-s', system="be terse"))['status'] == 'success'
+
+    response = send(listener, create_request("s1", 'query', "hello"))
+    assert response['cmd'] == 'airesponse' and response['data']['content'] == "1: hello"
+    response = send(listener, create_request("s1", 'query', "again"))
+    assert response['data']['content'] == "2: again"
+
+    assert send(listener, create_request(None, 'list-s'))['data'] == "session-s1 be terse"
+
+def test_session_settings_stay_per_session(live_server):
+    """use-model and context-policy on one session leave the server config and other sessions alone."""
+    listener = live_server()
+    for sid in ("a", "b"):
+        send(listener, create_request(sid, 'new-s', system="be terse"))
+    assert send(listener, create_request("a", 'use-model', "gpt-3.5-turbo"))['status'] == 'success'
+    assert send(listener, create_request("a", 'context-policy', {'policy': 'sliding', 'budget': 100}))['status'] == 'success'
+
+    assert listener.config['settings']['model'] == 'gpt-4o'
+    assert 'context_policy' not in listener.config['settings']
+    send(listener, create_request("c", 'new-s', system="be terse"))
+    assert send(listener, create_request("a", 'query', "hello"))['data']['model'] == 'gpt-3.5-turbo'
+    for sid in ("b", "c"):
+        assert send(listener, create_request(sid, 'query', "hello"))['data']['model'] == 'gpt-4o'
+        assert listener.session_contexts.get(sid).config['settings'].get('context_policy') is None
+
+@pytest.mark.parametrize('server_mode', ['asyncio', 'threaded'])
+def test_concurrent_requests(live_server, fake_openai, server_mode):
+    """More clients than handler threads are all answered, in asyncio mode on the bounded pool."""
+    fake_openai.delay = 0.05
+    listener = live_server(server_mode, max_workers=2)
+    send(listener, create_request(None, 'trace', {'clear': True}))
+    for n in range(6):
+        send(listener, create_request(f"c{n}", 'new-s', system="be terse"))
+
+    responses = {}
+
+    def query(n):
+        responses[n] = send(listener, create_request(f"c{n}", 'query', f"question {n}"))
+
+    threads = [threading.Thread(target=query, args=(n,)) for n in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [responses[n]['data']['content'] for n in range(6)] == [f"1: question {n}" for n in range(6)]
+    trace = send(listener, create_request(None, 'trace', {'clear': True}))['data']
+    thread_names = {event['tid']: event['args']['name'] for event in trace['traceEvents'] if event['ph'] == 'M'}
+    query_threads = {thread_names[event['tid']] for event in trace['traceEvents']
+                     if event['name'] == 'request' and event['args']['cmd'] == 'query' and event['args']['sid'].startswith('c')}
+    if server_mode == 'asyncio':
+        assert len(query_threads) <= 2 and all(name.startswith('vern-handler') for name in query_threads)
+    else:
+        assert query_threads and all(name.endswith('(handle_client)') for name in query_threads)
+
+@pytest.mark.parametrize('server_mode', ['asyncio', 'threaded'])
+def test_receive_traced(live_server, server_mode):
+    """Receiving a request is traced in both modes and tagged with its sid and cmd."""
+    listener = live_server(server_mode)
+    send(listener, create_request(None, 'trace', {'clear': True}))
+    send(listener, create_request("r", 'new-s', system="be terse"))
+
+    events = send(listener, create_request(None, 'trace'))['data']['traceEvents']
+    assert {'sid': "r", 'cmd': "new-s"} in [e['args'] for e in events if e['name'] == 'recv_request']
+
+def test_unknown_commands_share_a_label(live_server):
+    """Commands the server doesn't know are counted under one 'invalid' label, whatever the client sends."""
+    listener = live_server()
+    invalid = send(listener, create_request(None, 'stats'))['data']['metrics']['counters']['commands_total'].get('invalid', 0)
+    for n in range(3):
+        send(listener, create_request(None, f'bogus-{n}'))
+    send(listener, create_request(None, ['not', 'a', 'string']))
+    metrics = send(listener, create_request(None, 'stats'))['data']['metrics']
+
+    assert metrics['counters']['commands_total']['invalid'] == invalid + 4
+    assert not any(label.startswith('bogus') for label in metrics['histograms']['command_seconds'])
+
+@pytest.mark.parametrize('server_mode', ['asyncio', 'threaded'])
+def test_persistent_connection(live_server, fake_openai, server_mode):
+    """One multiplexed connection carries several commands, queries pipelined on it are answered by rid."""
+    fake_openai.delay = 0.02
+    listener = live_server(server_mode)
+    connection = MuxConnection([(listener.config['network']['host'], listener.config['network']['port'])], "m")
+
+    def command(req):
+        with connection.request(req) as request:
+            return parse_response(request.recv_frame(timeout=5))
+
+    for n in range(3):
+        assert command(create_request(f"m{n}", 'new-s', system=f"system {n}"))['status'] == 'success'
+    requests = [connection.request(create_request(f"m{n}", 'query', f"question {n}")) for n in range(3)]
+    assert [parse_response(request.recv_frame(timeout=5))['data']['content'] for request in requests] == \
+        [f"1: question {n}" for n in range(3)]
+    for request in requests:
+        request.close()
+    assert command(create_request(None, 'list-s'))['data'].splitlines() == [f"session-m{n} system {n}" for n in range(3)]
+    connection.close()
+
+@pytest.mark.parametrize('server_mode', ['asyncio', 'threaded'])
+def test_persistent_connection_frame_too_large(live_server, server_mode):
+    """An oversized multiplexed request is answered with an error on its rid and the connection is closed."""
+    listener = live_server(server_mode, max_frame_size=1000)
+    connection = MuxConnection([(listener.config['network']['host'], listener.config['network']['port'])], "m")
+    request = connection.request(create_request("m", 'query', "x" * 2000))
+    assert parse_response(request.recv_frame(timeout=5))['cmd'] == 'frame_too_large'
+    with pytest.raises(RuntimeError):
+        request.recv_frame(timeout=5)
+
+def test_unix_socket(live_server, tmp_path):
+    """With tcp off the server answers on its unix socket, a stale socket file from an earlier run is replaced."""
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    (tmp_path / "data").mkdir()
+    stale.bind(str(tmp_path / "data" / "vern.sock"))
+    stale.close()
+
+    listener = live_server(tcp=False, unix_socket="vern.sock")
+    assert listener.unix_address == str(tmp_path / "data" / "vern.sock")
+    assert send(listener, create_request("u", 'new-s', system="be terse"), listener.unix_address)['status'] == 'success'
+
+    client = Client("u", config=listener.config)
+    assert client.server_addresses()[0] == listener.unix_address
+    assert client.send_command(create_request("u", 'query', "hello"))['data']['content'] == "1: hello"
+
+def test_abstract_unix_socket(live_server):
+    listener = live_server(tcp=False, unix_socket=f"@vern-test-{uuid.uuid4().hex}")
+    assert listener.unix_address.startswith('\0')
+    assert send(listener, create_request(None, 'list-s'), listener.unix_address)['data'] == "No valid sessions found."
+
+@pytest.mark.parametrize('socket_state', ['missing', 'stale'])
+def test_unix_socket_falls_back_to_tcp(live_server, socket_state):
+    """A client finding the advertised socket missing or not listening uses TCP instead."""
+    listener = live_server(unix_socket="vern.sock")
+    client = Client("f", config=listener.config)
+    assert client.server_addresses() == [listener.unix_address, ('127.0.0.1', listener.config['network']['port'])]
+
+    os.unlink(listener.unix_address)
+    if socket_state == 'stale':
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(listener.unix_address)
+        stale.close()
+    assert client.send_command(create_request(None, 'list-s'))['data'] == "No valid sessions found."
+
+def send_stream(listener, req):
+    """Send a streamed request, returns every response frame up to the closing one."""
+    address = (listener.config['network']['host'], listener.config['network']['port'])
+    frames = []
+    with SocketRequest([address], req) as request:
+        while not frames or frames[-1]['cmd'] in ('airesponsestream', 'airesponsechunk'):
+            frames.append(parse_response(request.recv_frame()))
+    return frames
+
+@pytest.mark.parametrize('server_mode', ['asyncio', 'threaded'])
+def test_stream_frames(live_server, monkeypatch, server_mode):
+    """A streamed answer comes as airesponsestream, a chunk per delta and airesponseend, sent once the text is saved."""
+    listener = live_server(server_mode)
+    send(listener, create_request("st", 'new-s', system="be terse"))
+
+    events = []
+    send_response = listener.send_response
+    monkeypatch.setattr(listener, 'send_response', lambda sock, response: events.append(json.loads(response)['cmd']) or send_response(sock, response))
+    add_assistant_content = SessionContext.add_assistant_content
+    monkeypatch.setattr(SessionContext, 'add_assistant_content', lambda self, content: events.append('saved') or add_assistant_content(self, content))
+
+    frames = send_stream(listener, create_request("st", 'query', "hello streaming world", stream=True))
+    assert [frame['cmd'] for frame in frames] == ['airesponsestream'] + ['airesponsechunk'] * 4 + ['airesponseend']
+    assert "".join(frame['data'] for frame in frames[1:-1]) == "1: hello streaming world"
+    assert frames[-1]['data']['finish_reason'] == 'stop' and frames[-1]['data']['usage']['total_tokens'] == 6
+    assert events[-2:] == ['saved', 'airesponseend']
+    assert listener.session_contexts.get("st").user_and_assistant_content[-1]['content'] == "1: hello streaming world"
+
+def test_stream_cache_hit(live_server, fake_openai):
+    """A cached answer is streamed as a single chunk without asking the API again."""
+    listener = live_server(sections={'cache': {'enabled': True}})
+    send(listener, create_request("sc", 'new-s', system="be terse"))
+    first = send_stream(listener, create_request("sc", 'query', "cache me", oneshot=True, stream=True))
+    requests = fake_openai.requests
+
+    second = send_stream(listener, create_request("sc", 'query', "cache me", oneshot=True, stream=True))
+    assert fake_openai.requests == requests
+    assert [frame['cmd'] for frame in second] == ['airesponsestream', 'airesponsechunk', 'airesponseend']
+    assert second[1]['data'] == "".join(frame['data'] for frame in first[1:-1]) == "1: cache me"
+    assert second[-1]['data']['usage'] == first[-1]['data']['usage']
+
+def test_stream_error(live_server):
+    """An error in the middle of a stream ends it with an error frame and nothing is saved as the answer."""
+    listener = live_server()
+    send(listener, create_request("se", 'new-s', system="be terse"))
+    frames = send_stream(listener, create_request("se", 'query', "please break", stream=True))
+
+    assert [frame['cmd'] for frame in frames] == ['airesponsestream', 'airesponsechunk', 'api_error']
+    assert frames[-1]['status'] == 'error' and "Stream broke" in frames[-1]['data']
+    assert [m['role'] for m in listener.session_contexts.get("se").user_and_assistant_content] == ['user']
+
+def test_client_renders_stream(live_server, capsys):
+    """Client.render_stream prints the chunks as they come and returns the closing frame."""
+    listener = live_server()
+    client = Client("cr", config=listener.config, no_markdown=True, stream=True)
+    send(listener, create_request("cr", 'new-s', system="be terse"))
+    capsys.readouterr()  # The in-process server's output
+
+    client.do_user_content("hello there")
+    assert capsys.readouterr().out == "1: hello there\n"
+
+    response = client.send_command(create_request("cr", 'query', "now break", stream=True))
+    assert response['status'] == 'error' and response['cmd'] == 'api_error'
+    assert capsys.readouterr().out == "2: \n"
+
+@pytest.mark.parametrize('server_mode', ['asyncio', 'threaded'])
+def test_persistent_connection_malformed_request(live_server, server_mode):
+    """A malformed multiplexed request gets an error on its rid, the connection keeps serving the others."""
+    listener = live_server(server_mode)
+    connection = MuxConnection([(listener.config['network']['host'], listener.config['network']['port'])], "m")
+    pipelined = connection.request(create_request(None, 'list-s'))
+    for req in ('{"cmd": "list-s"', '["list-s"]', 'not json'):
+        with connection.request(req) as request:
+            response = parse_response(request.recv_frame(timeout=5))
+            assert response['status'] == 'error' and response['cmd'] == 'invalid_request'
+
+    assert parse_response(pipelined.recv_frame(timeout=5))['data'] == "No valid sessions found."
+    with connection.request(create_request(None, 'list-s')) as request:
+        assert parse_response(request.recv_frame(timeout=5))['status'] == 'success'
+    connection.close()
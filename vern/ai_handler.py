@@ -2,26 +2,105 @@ import logging
 import openai
 import os
 import sys
-import tiktoken
+import time
+from functools import partial
+
+from context_window import ContextWindow
+from encoders import EncoderCache
+from http_client import KeepWarm, PoolStats, build_http_client
+from metrics import metrics
+from model_catalog import ModelCatalog
+from rate_limiter import RateLimiter
+from response_cache import ResponseCache
+from singleflight import SingleFlight, SingleFlightTimeout
+from tracing import tracer
+
+SUMMARY_SYSTEM_CONTENT = (
+    "Summarize the conversation below for use as context in its continuation. "
+    "Keep facts, decisions, code identifiers and open questions, drop pleasantries. "
+    "Answer with the summary only."
+)
+
+def compact_usage(usage):
+    """Token usage of a completion as a plain dict"""
+    if usage is None:
+        return None
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.total_tokens,
+    }
+
+def compact_response(completion):
+    """
+    Reduce a ChatCompletion to the response frame sent to clients:
+    content, finish_reason, model, usage, and choices when there is more than one.
+    """
+    response = {
+        "content": completion.choices[0].message.content,
+        "finish_reason": completion.choices[0].finish_reason,
+        "model": completion.model,
+        "usage": compact_usage(completion.usage),
+    }
+    if len(completion.choices) > 1:
+        response["choices"] = [
+            {"content": choice.message.content, "finish_reason": choice.finish_reason}
+            for choice in completion.choices
+        ]
+    return response
 
 class AIHandler:
     def __init__(self, config):
+        self.config = config
         self.client = None
+        self.keep_warm = None
+        self.pool_stats = PoolStats()
         self.init_ai()
 
-        # Define the model's token limit
-        self.TOKEN_LIMIT = 30000
-        if config['settings']['model'] in ['gpt-4o-mini', 'gpt-3.5-turbo']:
-            self.TOKEN_LIMIT = 200000
+        # Models the API offers, persisted in dpath/models.json and refreshed every ttl seconds
+        # once the server is up (start_background), with context limits and tokenizers per model
+        catalog_config = self.config.get('model_catalog', {})
+        self.models = ModelCatalog(os.path.join(self.config['settings']['dpath'], 'models.json'),
+                                   lambda: [model.id for model in self.client.models.list()],
+                                   ttl=catalog_config.get('ttl', 86400), overrides=catalog_config.get('models'))
 
-        self.config = config
-        # Initialize tokenizer for GPT-4o
-        model_name = self.config['settings']['model']
-        try:
-            self.ENCODER = tiktoken.encoding_for_model(model_name)
-        except KeyError:
-            print(f"Unknown model '{model_name}', falling back to cl100k_base tokenizer.")
-            self.ENCODER = tiktoken.get_encoding("cl100k_base")
+        # Opt-in cache of responses by model, messages and parameters, in memory and under dpath/cache
+        self.response_cache = None
+        cache_config = self.config.get('cache', {})
+        if cache_config.get('enabled', False):
+            self.response_cache = ResponseCache(os.path.join(self.config['settings']['dpath'], 'cache'),
+                                                max_entries=cache_config.get('memory_entries', 256),
+                                                ttl=cache_config.get('ttl', 86400),
+                                                max_disk_bytes=cache_config.get('disk_bytes', 100 * 1024 * 1024))
+
+        # Identical requests arriving while one is in flight wait for its response instead of
+        # calling the API again, for at most inflight_timeout seconds
+        self.inflight = SingleFlight()
+        self.inflight_timeout = self.config['settings'].get('inflight_timeout', 600)
+
+        # Optional pacing of upstream requests within per-model RPM/TPM budgets
+        self.rate_limiter = None
+        if self.config.get('rate_limits', {}).get('enabled', False):
+            self.rate_limiter = RateLimiter.from_config(self.config['rate_limits'])
+
+        # Tokenizers by model, sessions can use another model than the server default.  They are
+        # loaded in the background once the server accepts connections (warm_encoders), with
+        # the BPE files cached under dpath so that no download is needed after the first start
+        cache_dir = self.config['settings'].get('tiktoken_cache_dir') or os.path.join(self.config['settings']['dpath'], 'tiktoken')
+        self.encoders = EncoderCache(cache_dir, tokenizer_for=lambda model_name: self.models.metadata(model_name)['tokenizer'])
+
+    @property
+    def ENCODER(self):
+        return self.encoder_for(self.config['settings']['model'])
+
+    def encoder_for(self, model_name):
+        """Tokenizer for model_name, approximate counts while it is loading."""
+        return self.encoders.get(model_name)
+
+    def start_background(self):
+        """Load the tokenizers and the model catalog, called once the server accepts connections."""
+        self.encoders.warm(self.config['settings']['model'])
+        self.models.start()
 
     def init_ai(self):
         """ Initialize AI client """
@@ -30,15 +109,34 @@ class AIHandler:
             logging.error("OPENAI_API_KEY is not set")
             sys.exit(1)
 
-        self.client = openai.OpenAI(api_key=api_key)
+        # HTTP client tuned from the 'openai' section: pool size (defaults to the number of
+        # handler threads), keep-alive expiry, timeouts, HTTP/2 and the API base_url
+        openai_config = self.config.get('openai', {})
+        http_client = build_http_client(openai_config, self.config.get('network', {}).get('max_workers', 8), self.pool_stats)
+        self.client = openai.OpenAI(api_key=api_key, base_url=openai_config.get('base_url'), http_client=http_client)
+
+        # Keep a pooled connection open while idle, so the next query skips DNS, TCP and TLS
+        if openai_config.get('keep_warm'):
+            self.keep_warm = KeepWarm(lambda: self.client.with_options(max_retries=0).models.list(), openai_config['keep_warm'])
+            self.keep_warm.start()
 
-    def count_tokens(self, messages):
-        """Returns the number of tokens in a given text"""
-        text = " ".join(msg["content"] for msg in messages if "content" in msg)
-        return len(self.ENCODER.encode(text))
+    def stop(self):
+        self.models.stop()
+        if self.keep_warm is not None:
+            self.keep_warm.stop()
 
-    def get_airesponse(self, session_context, oneshot_user_content=None):
-        """ Generate AI response for given context """
+    def count_tokens(self, messages, encoder=None):
+        """Returns the number of tokens in the given messages"""
+        encoder = encoder or self.ENCODER
+        return sum(len(encoder.encode(msg["content"])) for msg in messages if "content" in msg)
+
+    def get_airesponse(self, session_context, oneshot_user_content=None, stream=False, cache=None):
+        """
+        Generate AI response for given context, as a chunk iterator if stream is set.
+        With the response cache enabled a hit is returned as a compact response with "cached" set
+        (also when streaming), a streamed miss carries the "cache_key" to store the assembled
+        response under.  cache is None, 'bypass' (don't use the cache) or 'refresh' (don't look up, store).
+        """
         if not self.client:
             err_msg = "AI Client not initialized"
             logging.error(err_msg)
@@ -48,14 +146,29 @@ class AIHandler:
         logging.debug(f'oneshot_user_content: {oneshot_user_content}')
         logging.debug("*****")
 
-        ai_content = [session_context.system_content] + session_context.user_and_assistant_content
-        if oneshot_user_content:
-            ai_content = [session_context.system_content] + [{'role' : 'user', 'content' : oneshot_user_content}]
+        model = session_context.config['settings']['model']
+        metadata = self.models.metadata(model)
+        token_limit = self.models.prompt_limit(model)
 
-        token_count = self.count_tokens(ai_content)
+        # Messages carry cached token counts, only a oneshot message has to be encoded here
+        with tracer.span('count_tokens'):
+            session_context.set_encoder(self.encoder_for(model))
+        if oneshot_user_content:
+            with tracer.span('count_tokens'), session_context.lock:
+                ai_content = session_context.api_messages([session_context.system_content, {'role' : 'user', 'content' : oneshot_user_content}])
+                token_count = session_context.count_tokens(session_context.system_content) + self.count_tokens(ai_content[1:], session_context.encoder)
+        else:
+            try:
+                window = ContextWindow.from_settings(session_context.config['settings'], self.config['settings'], token_limit)
+            except ValueError as e:
+                return {"status": "error", "code": "invalid_context_policy", "message": str(e)}
+            with tracer.span('context_window', policy=window.policy):
+                messages, token_count = window.select(session_context, partial(self.summarize, session_context))
+            with session_context.lock:
+                ai_content = session_context.api_messages([session_context.system_content] + messages)
 
-        if token_count > self.TOKEN_LIMIT:
-            err_msg = f"Token limit exceeded: {token_count} > {self.TOKEN_LIMIT}"
+        if token_count > token_limit:
+            err_msg = f"Token limit exceeded: {token_count} > {token_limit}"
             logging.error(err_msg)
             return {"status": "error", "code": "token_limit_exceeded", "message": err_msg}
 
@@ -63,25 +176,105 @@ class AIHandler:
 
         logging.debug(f"Getting AI response for {ai_content}")
 
-        max_completion_tokens=50000
-        if session_context.config['settings']['model'] == 'gpt-4o':
-            max_completion_tokens=16384
+        max_completion_tokens = metadata['max_completion_tokens']
+
+        # Identifies the request for the response cache and for coalescing identical requests in flight
+        request_key = ResponseCache.key(model, ai_content, {'max_completion_tokens': max_completion_tokens})
+
+        cache_key = None
+        if self.response_cache is not None and cache != 'bypass':
+            cache_key = request_key
+            if cache != 'refresh' and (cached := self.response_cache.get(cache_key)) is not None:
+                logging.debug(f"Response cache hit {cache_key}")
+                return {"status": "success", "data": cached, "cached": True}
+
+        params = {}
+        if stream:
+            # Have the last chunk carry the token usage
+            params["stream_options"] = {"include_usage": True}
+
+        def create():
+            return self.create_completion(
+                token_count,
+                model=model,
+                messages=ai_content,
+                #temperature=0,
+                max_completion_tokens=max_completion_tokens,
+                stream=stream,
+                **params,
+            )
+
         try:
-            return {
-                "status": "success",
-                "data": self.client.chat.completions.create(
-                    model=session_context.config['settings']['model'],
-                    messages=ai_content,
-                    #temperature=0,
-                    max_completion_tokens=max_completion_tokens,
-                ),
-            }
+            if stream:
+                # A stream belongs to one client, only complete responses are shared
+                return {"status": "success", "data": create(), "cache_key": cache_key}
+            response = self.inflight.do(request_key, lambda: compact_response(create()), timeout=self.inflight_timeout)
+            if cache_key is not None:
+                self.response_cache.put(cache_key, response)
+            return {"status": "success", "data": response}
+        except SingleFlightTimeout as e:
+            logging.error(f"❌ {e}")
+            return {"status": "error", "code": "timeout", "message": str(e)}
         except openai.AuthenticationError as e:
             logging.error(f"❌ OpenAI API authentication error: {e}")
             return {"status": "error", "code": "auth_error", "message": "Invalid OpenAI API key. Check your API key settings."}
+        except openai.RateLimitError as e:
+            logging.error(f"❌ OpenAI API rate limit: {e}")
+            return {"status": "error", "code": "rate_limited", "message": str(e)}
         except openai.OpenAIError as e:
             logging.error(f"❌ OpenAI API request failed: {e}")
             return {"status": "error", "code": "api_error", "message": str(e)}
 
+    def create_completion(self, token_count, **kwargs):
+        """
+        chat.completions.create, paced and retried by the rate limiter when enabled.  The time
+        until the response (the first chunk of a stream) and the token usage are recorded.
+        """
+        if self.keep_warm is not None:
+            self.keep_warm.touch()
+        model = kwargs['model']
+        metrics.inc('upstream_requests_total', model=model)
+        start = time.perf_counter()
+        try:
+            with tracer.span('upstream', model=model):
+                if self.rate_limiter is None:
+                    completion = self.client.chat.completions.create(**kwargs)
+                else:
+                    # The limiter does the retrying, it needs to see every 429 and its headers
+                    client = self.client.with_options(max_retries=0)
+                    completion = self.rate_limiter.call(model, token_count,
+                                                        lambda: client.chat.completions.with_raw_response.create(**kwargs))
+        except Exception:
+            metrics.inc('upstream_errors_total', model=model)
+            raise
+        metrics.observe('upstream_seconds', time.perf_counter() - start, model=model)
+        if not kwargs.get('stream'):
+            self.record_usage(model, compact_usage(completion.usage))
+        return completion
+
+    def record_usage(self, model, usage):
+        """Count the tokens of a completion, usage as returned by compact_usage."""
+        if usage is not None:
+            metrics.inc('prompt_tokens_total', usage['prompt_tokens'], model=model)
+            metrics.inc('completion_tokens_total', usage['completion_tokens'], model=model)
+
+    def summarize(self, session_context, previous_summary, messages):
+        """Summary text of messages (following previous_summary), None if the request failed."""
+        conversation = "\n\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        if previous_summary:
+            conversation = f"Summary so far:\n{previous_summary}\n\nContinued conversation:\n{conversation}"
+        messages = [
+            {'role': 'system', 'content': SUMMARY_SYSTEM_CONTENT},
+            {'role': 'user', 'content': conversation},
+        ]
+        try:
+            completion = self.create_completion(self.count_tokens(messages, session_context.encoder),
+                                                model=session_context.config['settings']['model'], messages=messages)
+            return completion.choices[0].message.content
+        except openai.OpenAIError as e:
+            logging.error(f"❌ Summarizing {session_context.sid} failed: {e}")
+            return None
+
     def list_models(self):
-        return openai.models.list()
+        """Model ids from the catalog, fetched from the API only if it has never been."""
+        return self.models.ids() or self.models.refresh()
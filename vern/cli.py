@@ -9,19 +9,39 @@ def parse_args():
     parser.add_argument('--use-s', type=str, nargs=1, help='Use an existing session')
     parser.add_argument('--rm-s', type=str, nargs=1, help='Remove an existing session')
     parser.add_argument('--list-s', action='store_true', help='List existing sessions')
+    parser.add_argument('--filter', type=str, help='Only list sessions whose name or system contains this text')
+    parser.add_argument('--offset', type=int, default=0, help='Skip this many sessions when listing')
+    parser.add_argument('--limit', type=int, help='List at most this many sessions')
+    parser.add_argument('--rebuild-catalog', action='store_true', help='Rebuild the session list from the session directories')
     parser.add_argument('--system', type=str, nargs='+', help='Give the role system content')
     parser.add_argument('-i', '--interactive', action='store_true', help='Drop to interactive prompt')
     parser.add_argument('--no-markdown', action='store_true', help='Display response as raw markdown')
+    parser.add_argument('--stream', action='store_true', help='Print the response as it is generated')
     parser.add_argument('-s', '--save-responses', action='store_true', help='Save all responses as text', default=config.save_responses)
     parser.add_argument('--stdin', action='store_true', help='Read input from stdin and send to server')
     parser.add_argument("--list-m", action='store_true', help='List available models')
+    parser.add_argument("--batch", type=str, help='Run the prompts of a JSONL file')
+    parser.add_argument("--out", type=str, help='JSONL file for --batch results, default <batch>.out.jsonl')
+    parser.add_argument("--concurrency", type=int, help='Prompts of a --batch run at once')
+    parser.add_argument("--stats", action='store_true', help='Show server statistics')
+    parser.add_argument("--profile", choices=['cprofile', 'sample', 'stop', 'status'], help='Start profiling the server, or stop it and write the results to its dpath/profiles')
+    parser.add_argument("--profile-requests", type=int, help='Stop profiling after this many requests')
+    parser.add_argument("--profile-seconds", type=float, help='Stop profiling after this many seconds')
+    parser.add_argument("--profile-memory", action='store_true', help='Also trace memory allocations, per session load too')
+    parser.add_argument("--trace", type=str, help='Write the server\'s recent request spans to this file as Chrome trace JSON')
+    parser.add_argument("--trace-clear", action='store_true', help='Empty the server\'s span buffer after --trace')
     parser.add_argument("--model", type=str, help='Specify model to use')
     parser.add_argument("--list-sys", action='store_true', help='List predefined systems')
     parser.add_argument("--use-sys", type=str, help='Use a predefined roles')
     parser.add_argument("--init", action='store_true')
     parser.add_argument("--exit", action='store_true')
     parser.add_argument("--oneshot", action='store_true', help='Use system role from session and don\'t send whole converation, just said command line query as oneshot')
+    parser.add_argument("--no-cache", action='store_true', help='Don\'t use the server\'s response cache for this query')
+    parser.add_argument("--refresh-cache", action='store_true', help='Ask the AI again and replace the cached response')
     parser.add_argument("--reset", action='store_true', help='Reset the session')
+    parser.add_argument("--context-policy", choices=['none', 'sliding', 'pin', 'summary'], help='How the session\'s history is cut to fit the token budget')
+    parser.add_argument("--context-budget", type=int, help='Tokens of history sent with a query')
+    parser.add_argument("--pin-turns", type=int, help='Turns always sent with the pin context policy')
     parser.add_argument("--archive-conversation", action='store_true', help='Reset the session')
     parser.add_argument("--edit", action='store_true', help='Open vim')
     parser.add_argument("--add-system", "--add-sys", type=str, nargs='+', help='Add a system')
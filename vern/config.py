@@ -10,3 +10,4 @@ path = f'{HOME}/.config/vern-dev/'
 dpath = f'{HOME}/.local/share/vern-dev/'
 save_responses = True
 server_info_file = join(path, 'server_info.txt')
+config_cache_file = join(path, 'config_cache.json')
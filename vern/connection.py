@@ -0,0 +1,209 @@
+import itertools
+import logging
+import queue
+import socket
+import struct
+import threading
+
+from protocol import FrameTooLargeError, create_request, encode_request, parse_response
+from utils import FrameReader, receive_exact_bytes, receive_length
+
+# A multiplexed connection starts with a plain 'mux' request.  Once the server acks it, every
+# frame in either direction is prefixed with the request id it belongs to:
+#
+#   rid (4 bytes, big endian) | length (4 bytes, big endian) | payload
+#
+MUX_HEADER = struct.Struct('>II')
+
+
+def pack_mux_frame(rid, payload):
+    return MUX_HEADER.pack(rid, len(payload)) + payload
+
+
+def check_mux_frame(rid, length, max_frame_size):
+    if max_frame_size is not None and length > max_frame_size:
+        raise FrameTooLargeError(f"Request of {length} bytes exceeds the maximum frame size of {max_frame_size}", rid)
+
+
+def recv_mux_frame(sock, max_frame_size=None):
+    """Read one multiplexed frame, returns (rid, payload)."""
+    rid, length = MUX_HEADER.unpack(receive_exact_bytes(sock, MUX_HEADER.size))
+    check_mux_frame(rid, length, max_frame_size)
+    return rid, receive_exact_bytes(sock, length)
+
+
+async def recv_exact_async(loop, sock, num_bytes):
+    received_data = bytearray(num_bytes)
+    view = memoryview(received_data)
+    received = 0
+    while received < num_bytes:
+        n = await loop.sock_recv_into(sock, view[received:])
+        if n == 0:
+            raise RuntimeError("Connection closed unexpectedly")
+        received += n
+    return received_data
+
+
+async def recv_mux_frame_async(loop, sock, max_frame_size=None):
+    """Async counterpart of recv_mux_frame for non-blocking sockets."""
+    rid, length = MUX_HEADER.unpack(await recv_exact_async(loop, sock, MUX_HEADER.size))
+    check_mux_frame(rid, length, max_frame_size)
+    return rid, await recv_exact_async(loop, sock, length)
+
+
+class MuxRefusedError(Exception):
+    """The server does not support multiplexed connections."""
+
+
+class MuxChannel:
+    """
+    Socket stand-in handed to the server's command handlers for one request on a
+    multiplexed connection.  Every frame written through it is tagged with the request id.
+    """
+
+    def __init__(self, send_frame, rid):
+        self.send_frame = send_frame
+        self.rid = rid
+
+    def sendall(self, data):
+        self.send_frame(self.rid.to_bytes(4, byteorder='big') + data)
+
+
+def connect(addresses):
+    """Connect to the first reachable address, unix socket paths are str, TCP ones (host, port)."""
+    for address in addresses:
+        try:
+            if isinstance(address, str):
+                client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    client_socket.connect(address)
+                except OSError:
+                    client_socket.close()
+                    raise
+                return client_socket
+
+            client_socket = socket.create_connection(address)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return client_socket
+        except OSError as e:
+            if address is addresses[-1]:
+                raise
+            logging.debug(f"Could not connect to {address!r}: {e}")
+
+
+class SocketRequest:
+    """
+    A single request on its own connection, the socket is closed with the request.
+    Frames are returned as memoryviews valid until the next recv_frame.
+    """
+
+    def __init__(self, addresses, req):
+        self.client_socket = connect(addresses)
+        self.reader = FrameReader(self.client_socket)
+        logging.debug(f"Sending {req}")
+        self.client_socket.sendall(encode_request(req))
+
+    def recv_frame(self):
+        l = self.reader.read_length()
+        logging.debug(f'Receive length of response {l}')
+        return self.reader.read_exact(l)
+
+    def close(self):
+        self.client_socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MuxRequest:
+    """One in-flight request on a MuxConnection, frames for it are read from its own queue."""
+
+    def __init__(self, connection, rid, frames):
+        self.connection = connection
+        self.rid = rid
+        self.frames = frames
+
+    def recv_frame(self, timeout=None):
+        data = self.frames.get(timeout=timeout)
+        if data is None:
+            raise RuntimeError("Connection closed unexpectedly")
+        return data
+
+    def close(self):
+        self.connection.release(self.rid)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MuxConnection:
+    """
+    Long-lived connection to the server carrying many requests at once.  Requests can be
+    pipelined from several threads, a reader thread routes each response frame to the
+    request it belongs to, so responses may arrive in any order.
+    """
+
+    def __init__(self, addresses, sid=None):
+        self.client_socket = connect(addresses)
+        self.client_socket.sendall(encode_request(create_request(sid, 'mux')))
+        response = parse_response(receive_exact_bytes(self.client_socket, receive_length(self.client_socket)))
+        if response['status'] != 'success':
+            self.client_socket.close()
+            raise MuxRefusedError(f"Server refused multiplexed connection: {response['data']}")
+
+        self.send_lock = threading.Lock()
+        self.requests_lock = threading.Lock()
+        self.requests = {}
+        self.rids = itertools.count(1)
+        self.closed = False
+
+        self.reader_thread = threading.Thread(target=self.reader_thread_func, daemon=True)
+        self.reader_thread.start()
+
+    def request(self, req):
+        """Send req and return a MuxRequest to read its response frames from."""
+        frames = queue.Queue()
+        with self.requests_lock:
+            if self.closed:
+                raise RuntimeError("Connection closed unexpectedly")
+            rid = next(self.rids)
+            self.requests[rid] = frames
+
+        logging.debug(f"Sending rid={rid} {req}")
+        with self.send_lock:
+            self.client_socket.sendall(pack_mux_frame(rid, req.encode()))
+        return MuxRequest(self, rid, frames)
+
+    def release(self, rid):
+        """Forget a finished request, any frames still arriving for it are dropped."""
+        with self.requests_lock:
+            self.requests.pop(rid, None)
+
+    def reader_thread_func(self):
+        try:
+            while True:
+                rid, payload = recv_mux_frame(self.client_socket)
+                with self.requests_lock:
+                    frames = self.requests.get(rid)
+                if frames is not None:
+                    frames.put(payload)
+        except (RuntimeError, OSError) as e:
+            logging.debug(f"Multiplexed connection closed: {e}")
+        finally:
+            with self.requests_lock:
+                self.closed = True
+                for frames in self.requests.values():
+                    frames.put(None)
+
+    def close(self):
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.client_socket.close()
@@ -0,0 +1,106 @@
+import logging
+
+# none:    send the whole conversation, requests fail once it passes the token limit
+# sliding: send the newest messages that fit in the budget
+# pin:     always send the first pin_turns turns, then the newest messages that fit
+# summary: fold older messages into a summary (summary.json in the session dir) sent ahead
+#          of the newest messages
+POLICIES = ('none', 'sliding', 'pin', 'summary')
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+class ContextWindow:
+    """Picks the part of a session's conversation sent with a query, the full conversation stays on disk."""
+
+    def __init__(self, policy='none', budget=30000, pin_turns=1):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown context policy '{policy}', use one of {', '.join(POLICIES)}")
+        self.policy = policy
+        self.budget = budget
+        self.pin_turns = pin_turns
+
+    @classmethod
+    def from_settings(cls, session_settings, server_settings, token_limit):
+        """Window for a session, its own settings win over the server's, the budget never exceeds token_limit."""
+        def setting(key, default):
+            return session_settings.get(key, server_settings.get(key, default))
+
+        budget = min(setting('context_budget', None) or token_limit, token_limit)
+        return cls(setting('context_policy', 'none'), budget, setting('context_pin_turns', 1))
+
+    def newest(self, session_context, messages, budget):
+        """The newest messages within budget tokens (always at least the last one), and their token count."""
+        count = 0
+        start = len(messages)
+        while start > 0:
+            tokens = session_context.count_tokens(messages[start - 1])
+            if count + tokens > budget and start < len(messages):
+                break
+            count += tokens
+            start -= 1
+
+        # Don't open the window with an answer to a question that was cut off
+        while start < len(messages) - 1 and messages[start]['role'] == 'assistant':
+            count -= session_context.count_tokens(messages[start])
+            start += 1
+        return messages[start:], count
+
+    def select(self, session_context, summarize=None):
+        """
+        Return the messages to send after the system content and the token count including
+        the system content.  summarize(previous_summary, messages) returns the text of a new
+        summary, or None if that failed.
+        """
+        if self.policy == 'summary' and summarize is not None:
+            self.update_summary(session_context, summarize)
+
+        with session_context.lock:
+            messages = session_context.user_and_assistant_content
+            system_tokens = session_context.count_tokens(session_context.system_content)
+
+            if self.policy == 'none':
+                return list(messages), session_context.token_count
+
+            if self.policy == 'pin':
+                head = messages[:2 * self.pin_turns]
+                head_tokens = sum(session_context.count_tokens(m) for m in head)
+                tail, tail_tokens = self.newest(session_context, messages[len(head):], self.budget - system_tokens - head_tokens)
+                return head + tail, system_tokens + head_tokens + tail_tokens
+
+            head, head_tokens, messages = [], 0, messages
+            if self.policy == 'summary' and session_context.summary:
+                head = [session_context.summary['message']]
+                head_tokens = session_context.count_tokens(head[0])
+                messages = messages[session_context.summary['upto']:]
+            tail, tail_tokens = self.newest(session_context, messages, self.budget - system_tokens - head_tokens)
+            return head + tail, system_tokens + head_tokens + tail_tokens
+
+    def update_summary(self, session_context, summarize):
+        """Fold older messages into the summary once the unsummarized ones no longer fit the budget."""
+        with session_context.lock:
+            summary = session_context.summary
+            upto = summary['upto'] if summary else 0
+            messages = session_context.user_and_assistant_content[upto:]
+            fixed_tokens = session_context.count_tokens(session_context.system_content)
+            if summary:
+                fixed_tokens += session_context.count_tokens(summary['message'])
+            if fixed_tokens + sum(session_context.count_tokens(m) for m in messages) <= self.budget:
+                return
+
+            # Keep the newest messages in half the budget, the summary has to fit in the rest
+            tail, _ = self.newest(session_context, messages, self.budget // 2 - fixed_tokens)
+            older = messages[:len(messages) - len(tail)]
+            previous = summary['message']['content'].removeprefix(SUMMARY_PREFIX) if summary else None
+
+        if not older:
+            return
+
+        # The upstream call runs without the session lock, the flusher needs it meanwhile
+        logging.info(f"Summarizing {len(older)} messages of {session_context.sid}")
+        if (text := summarize(previous, older)) is None:
+            return
+        session_context.set_summary({
+            'upto': upto + len(older),
+            'message': {'role': 'system', 'content': SUMMARY_PREFIX + text},
+        })
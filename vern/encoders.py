@@ -0,0 +1,108 @@
+import logging
+import os
+import threading
+import time
+
+
+class ApproxEncoding:
+    """Stand-in while a tokenizer is loading or unavailable: about one token per 4 characters."""
+
+    name = 'approx'
+    approximate = True
+
+    def encode(self, text):
+        return range((len(text) + 3) // 4)
+
+
+APPROX = ApproxEncoding()
+
+
+class EncoderCache:
+    """
+    tiktoken encoders by model, loaded on a background thread so that neither server start-up
+    nor a request waits for tiktoken to import or read its BPE files.  Those are cached in
+    cache_dir (TIKTOKEN_CACHE_DIR), a directory seeded with scripts/seed_tiktoken_cache.py
+    works offline.  Until a model's encoder is loaded, or when it can't be, get() returns APPROX
+    and loading is retried after retry_interval seconds.
+    """
+
+    def __init__(self, cache_dir=None, retry_interval=300, tokenizer_for=None):
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ['TIKTOKEN_CACHE_DIR'] = cache_dir
+        self.cache_dir = cache_dir
+        self.tokenizer_for = tokenizer_for  # model -> tiktoken encoding name, or None to ask tiktoken
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.encoders = {}  # model -> encoder
+        self.failed = {}  # model -> monotonic time of the last failed load
+        self.pending = []
+        self.thread = None
+        self.ready = threading.Event()
+        self.ready_at = None  # monotonic time the first models queued were loaded (or failed)
+        self.load_time = None
+
+    def load(self, model_name):
+        import tiktoken
+        if self.tokenizer_for is not None and (encoding_name := self.tokenizer_for(model_name)):
+            return tiktoken.get_encoding(encoding_name)
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            logging.warning(f"Unknown model '{model_name}', falling back to cl100k_base tokenizer.")
+            return tiktoken.get_encoding("cl100k_base")
+
+    def warm(self, *model_names):
+        """Queue model_names for loading, starting the loader thread when it isn't running."""
+        with self.lock:
+            for model_name in model_names:
+                if model_name not in self.encoders and model_name not in self.pending:
+                    if time.monotonic() - self.failed.get(model_name, -self.retry_interval) >= self.retry_interval:
+                        self.pending.append(model_name)
+            if self.pending and (self.thread is None or not self.thread.is_alive()):
+                self.thread = threading.Thread(target=self.loader_thread_func, name='vern-encoders', daemon=True)
+                self.thread.start()
+
+    def loader_thread_func(self):
+        started = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    if self.load_time is None:
+                        self.ready_at = time.monotonic()
+                        self.load_time = self.ready_at - started
+                    self.ready.set()
+                    return
+                model_name = self.pending[0]
+            try:
+                encoder = self.load(model_name)
+                logging.info(f"Loaded {encoder.name} tokenizer for {model_name}")
+            except Exception as e:
+                encoder = None
+                logging.warning(f"Could not load the tokenizer for {model_name}, token counts are approximate: {e}")
+            with self.lock:
+                self.pending.remove(model_name)
+                if encoder is not None:
+                    self.encoders[model_name] = encoder
+                    self.failed.pop(model_name, None)
+                else:
+                    self.failed[model_name] = time.monotonic()
+
+    def get(self, model_name):
+        """Encoder for model_name if loaded, else APPROX (and the encoder is loaded in the background)."""
+        encoder = self.encoders.get(model_name)
+        if encoder is None:
+            self.warm(model_name)
+            return APPROX
+        return encoder
+
+    def stats(self):
+        with self.lock:
+            return {
+                'loaded': {model_name: encoder.name for model_name, encoder in self.encoders.items()},
+                'pending': list(self.pending),
+                'failed': list(self.failed),
+                'load_time': round(self.load_time, 3) if self.load_time is not None else None,
+                'cache_dir': self.cache_dir,
+            }
@@ -0,0 +1,95 @@
+import logging
+import threading
+import time
+
+import httpx
+
+
+class PoolStats:
+    """
+    Connection pool statistics from httpcore trace events: requests sent, connections
+    opened for them (the rest reused a pooled connection) and time spent setting those up.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()  # Trace events of a request arrive on its thread
+        self.requests = 0
+        self.connections = 0
+        self.connect_time = 0.0
+
+    def trace(self, event_name, info):
+        name = event_name.split('.', 1)[1]
+        if name in ('connect_tcp.started', 'start_tls.started'):
+            self.local.started = time.monotonic()
+        elif name in ('connect_tcp.complete', 'start_tls.complete'):
+            with self.lock:
+                self.connect_time += time.monotonic() - self.local.started
+                if name == 'connect_tcp.complete':
+                    self.connections += 1
+        elif name == 'send_request_headers.started':
+            with self.lock:
+                self.requests += 1
+
+    def add_trace(self, request):
+        request.extensions['trace'] = self.trace
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'connections': self.connections,
+                'reuse_rate': round(1 - self.connections / self.requests, 3) if self.requests else None,
+                'avg_connect_ms': round(1000 * self.connect_time / self.connections, 1) if self.connections else None,
+            }
+
+
+def build_http_client(openai_config, max_workers, pool_stats):
+    """httpx client for the OpenAI SDK, sized for max_workers concurrent handlers by default."""
+    http2 = openai_config.get('http2', False)
+    if http2:
+        try:
+            import h2  # noqa: F401, httpx needs it for HTTP/2
+        except ImportError:
+            logging.warning("openai.http2 needs the h2 package (pip install httpx[http2]), using HTTP/1.1")
+            http2 = False
+
+    max_connections = openai_config.get('max_connections', max_workers)
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=max_connections,
+                            max_keepalive_connections=openai_config.get('max_keepalive_connections', max_connections),
+                            keepalive_expiry=openai_config.get('keepalive_expiry', 60)),
+        timeout=httpx.Timeout(openai_config.get('read_timeout', 600), connect=openai_config.get('connect_timeout', 5)),
+        http2=http2,
+        event_hooks={'request': [pool_stats.add_trace]},
+    )
+
+
+class KeepWarm:
+    """Calls ping() whenever nothing used the connection pool for interval seconds."""
+
+    def __init__(self, ping, interval):
+        self.ping = ping
+        self.interval = interval
+        self.last_used = time.monotonic()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.keep_warm_thread_func, name='vern-keep-warm', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def keep_warm_thread_func(self):
+        while not self.stop_event.wait(max(0.0, self.last_used + self.interval - time.monotonic())):
+            if time.monotonic() - self.last_used < self.interval:
+                continue
+            try:
+                self.ping()
+            except Exception as e:
+                logging.debug(f"Keep-warm ping failed: {e}")
+            self.touch()
@@ -0,0 +1,189 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in seconds, sqrt(2) apart from 0.5 ms to about 100 minutes,
+# quantiles are interpolated within a bucket so they are off by at most that factor
+BUCKETS = tuple(0.0005 * 2 ** (i / 2) for i in range(48))
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Counts of observations per bucket, their number and sum."""
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # The last one counts values past the last bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            if n and cumulative + n >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - cumulative) / n
+            cumulative += n
+        return BUCKETS[-1]
+
+    def summary(self):
+        summary = {'count': self.count, 'sum': round(self.sum, 6)}
+        for q in QUANTILES:
+            value = self.quantile(q)
+            summary[f'p{round(q * 100)}'] = round(value, 6) if value is not None else None
+        return summary
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def escape_label_value(value):
+    """A label value as the Prometheus text format wants it, with backslash, quote and newline escaped."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def label_name(key):
+    """Key of a labelled value in snapshot(): the label values joined by ','."""
+    return ",".join(str(value) for _, value in key)
+
+
+class Metrics:
+    """
+    Counters, histograms (in seconds) and gauges, each optionally labelled, e.g. per command
+    or model.  Updating one takes a lock and a dict lookup so instrumentation can stay on.
+    Gauges are functions called when the metrics are read.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # name -> {label key: value}
+        self.histograms = {}  # name -> {label key: Histogram}
+        self.gauges = {}  # name -> function returning a number
+
+    def inc(self, name, value=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = label_key(labels)
+        with self.lock:
+            histograms = self.histograms.setdefault(name, {})
+            if (histogram := histograms.get(key)) is None:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the time spent in the with block, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def read_gauges(self):
+        gauges = {}
+        for name, fn in list(self.gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception as e:
+                logging.debug(f"Gauge {name} failed: {e}")
+        return gauges
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """
+        All metrics as plain values: unlabelled ones directly, labelled ones by label_name.
+        Histograms as count, sum and p50/p95/p99.
+        """
+        def by_label(values, convert):
+            if list(values) == [()]:
+                return convert(values[()])
+            return {label_name(key): convert(value) for key, value in values.items()}
+
+        with self.lock:
+            snapshot = {
+                'counters': {name: by_label(values, lambda v: v) for name, values in self.counters.items()},
+                'histograms': {name: by_label(values, Histogram.summary) for name, values in self.histograms.items()},
+            }
+        snapshot['gauges'] = self.read_gauges()
+        return snapshot
+
+    def prometheus(self, prefix='vern_'):
+        """The metrics in the Prometheus text exposition format."""
+        def labels_text(key, extra=()):
+            pairs = [f'{name}="{escape_label_value(value)}"' for name, value in key + tuple(extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        with self.lock:
+            for name, values in sorted(self.counters.items()):
+                lines.append(f"# TYPE {prefix}{name} counter")
+                lines.extend(f"{prefix}{name}{labels_text(key)} {value}" for key, value in values.items())
+            for name, values in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                for key, histogram in values.items():
+                    cumulative = 0
+                    for bound, n in zip(BUCKETS, histogram.counts):
+                        cumulative += n
+                        lines.append(f"{prefix}{name}_bucket{labels_text(key, [('le', f'{bound:.6g}')])} {cumulative}")
+                    lines.append(f"{prefix}{name}_bucket{labels_text(key, [('le', '+Inf')])} {histogram.count}")
+                    lines.append(f"{prefix}{name}_sum{labels_text(key)} {histogram.sum}")
+                    lines.append(f"{prefix}{name}_count{labels_text(key)} {histogram.count}")
+        for name, value in sorted(self.read_gauges().items()):
+            lines.append(f"# TYPE {prefix}{name} gauge")
+            lines.append(f"{prefix}{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def serve_prometheus(registry, host, port):
+    """Serve registry.prometheus() at http://host:port/metrics from a daemon thread, returns the server."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='vern-metrics', daemon=True).start()
+    logging.info(f"Serving metrics at http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+# Registry of the server process
+metrics = Metrics()
@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from utils import atomic_write
+
+# Used for models without an entry below: together the 30000 token prompts and 50000 token
+# completions vern has always allowed
+DEFAULT_METADATA = {'context_limit': 80000, 'max_completion_tokens': 50000, 'tokenizer': None}
+
+# Metadata by model id prefix, the longest matching prefix wins (gpt-4o-2024-08-06 is a
+# gpt-4o).  context_limit counts prompt and completion tokens, tokenizer is a tiktoken
+# encoding name (None: ask tiktoken for the model's)
+KNOWN_MODELS = {
+    'gpt-3.5-turbo': {'context_limit': 16385, 'max_completion_tokens': 4096, 'tokenizer': 'cl100k_base'},
+    'gpt-4': {'context_limit': 8192, 'max_completion_tokens': 4096, 'tokenizer': 'cl100k_base'},
+    'gpt-4-turbo': {'context_limit': 128000, 'max_completion_tokens': 4096, 'tokenizer': 'cl100k_base'},
+    'gpt-4o': {'context_limit': 128000, 'max_completion_tokens': 16384, 'tokenizer': 'o200k_base'},
+    'gpt-4o-mini': {'context_limit': 128000, 'max_completion_tokens': 16384, 'tokenizer': 'o200k_base'},
+    'gpt-4.1': {'context_limit': 1047576, 'max_completion_tokens': 32768, 'tokenizer': 'o200k_base'},
+    'o1': {'context_limit': 200000, 'max_completion_tokens': 100000, 'tokenizer': 'o200k_base'},
+    'o3': {'context_limit': 200000, 'max_completion_tokens': 100000, 'tokenizer': 'o200k_base'},
+    'o3-mini': {'context_limit': 200000, 'max_completion_tokens': 100000, 'tokenizer': 'o200k_base'},
+    'o4-mini': {'context_limit': 200000, 'max_completion_tokens': 100000, 'tokenizer': 'o200k_base'},
+}
+
+
+class ModelCatalog:
+    """
+    The models the API offers, fetched with fetch() (a list of model ids), kept in memory and
+    in path (models.json under dpath) and refreshed from a background thread every ttl
+    seconds, so list-m and use-model don't wait for the API.  metadata() gives a model's
+    context limit, completion limit and tokenizer, from KNOWN_MODELS and the 'models'
+    section of the config (overrides).
+    """
+
+    def __init__(self, path, fetch, ttl=86400, overrides=None):
+        self.path = path
+        self.fetch = fetch
+        self.ttl = ttl
+        self.overrides = overrides or {}
+        self.lock = threading.Lock()
+        self.models = []
+        self.fetched = None  # time.time() of the last successful fetch
+        self.errors = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def load(self):
+        """Read the persisted catalog, False if there is none."""
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logging.error(f"Failed to read model catalog {self.path}: {e}")
+            return False
+        with self.lock:
+            self.models = sorted(saved.get('models', []))
+            self.fetched = saved.get('fetched')
+        return True
+
+    def refresh(self):
+        """Fetch the model list and persist it, exceptions of fetch() are raised."""
+        try:
+            models = sorted(set(self.fetch()))
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            raise
+        with self.lock:
+            self.models = models
+            self.fetched = time.time()
+            data = json.dumps({'fetched': self.fetched, 'models': models}, indent=4)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        atomic_write(self.path, data)
+        logging.info(f"Model catalog refreshed, {len(models)} models")
+        return models
+
+    def age(self):
+        return time.time() - self.fetched if self.fetched is not None else None
+
+    def start(self):
+        """Load the persisted catalog and keep it refreshed in the background."""
+        self.load()
+        self.thread = threading.Thread(target=self.refresh_thread_func, name='vern-models', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def refresh_thread_func(self):
+        while True:
+            age = self.age()
+            delay = 0 if age is None or age >= self.ttl else self.ttl - age
+            if self.stop_event.wait(delay):
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.warning(f"Model catalog refresh failed: {e}")
+                # Retry after a minute rather than a whole ttl
+                if self.stop_event.wait(60):
+                    return
+
+    def ids(self):
+        with self.lock:
+            return list(self.models)
+
+    def is_known(self, model_name):
+        """True if the API offers model_name, or the list hasn't been fetched yet and it can't be checked."""
+        with self.lock:
+            return not self.models or model_name in self.models
+
+    def metadata(self, model_name):
+        """context_limit, max_completion_tokens and tokenizer of model_name."""
+        metadata = dict(DEFAULT_METADATA)
+        prefixes = [prefix for prefix in KNOWN_MODELS if model_name == prefix or model_name.startswith(prefix + '-')]
+        if prefixes:
+            metadata.update(KNOWN_MODELS[max(prefixes, key=len)])
+        metadata.update(self.overrides.get(model_name, {}))
+        return metadata
+
+    def prompt_limit(self, model_name):
+        """Tokens a prompt may have, leaving room for the longest completion."""
+        metadata = self.metadata(model_name)
+        return metadata['context_limit'] - metadata['max_completion_tokens']
+
+    def stats(self):
+        with self.lock:
+            return {
+                'models': len(self.models),
+                'age': round(self.age()) if self.fetched is not None else None,
+                'errors': self.errors,
+            }
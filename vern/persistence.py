@@ -0,0 +1,73 @@
+import atexit
+import logging
+import threading
+
+
+class SessionFlusher:
+    """
+    Write-behind for session state.  Sessions with write_behind on mark themselves dirty
+    instead of writing in the request path, one background thread writes them out every
+    interval seconds, or sooner once dirty_bytes of new content has piled up.
+    """
+
+    def __init__(self, interval=1.0, dirty_bytes=1024 * 1024):
+        self.interval = interval
+        self.dirty_bytes_threshold = dirty_bytes
+        self.cond = threading.Condition()
+        self.dirty = {}  # Sessions waiting to be flushed, in the order they were dirtied
+        self.dirty_bytes = 0
+        self.thread = None
+        self.flush_lock = threading.Lock()  # Held while a batch is written, so flush_all at exit waits for the flusher
+
+    def configure(self, interval=None, dirty_bytes=None):
+        with self.cond:
+            if interval is not None:
+                self.interval = interval
+            if dirty_bytes is not None:
+                self.dirty_bytes_threshold = dirty_bytes
+
+    def mark_dirty(self, session, nbytes=0):
+        with self.cond:
+            was_clean = not self.dirty
+            self.dirty[session] = True
+            self.dirty_bytes += nbytes
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.flusher_thread_func, name='vern-flusher', daemon=True)
+                self.thread.start()
+            # Wake the flusher to start the interval, or to flush right away past the threshold
+            if was_clean or self.dirty_bytes >= self.dirty_bytes_threshold:
+                self.cond.notify()
+
+    def discard(self, session):
+        """Forget a session that is going away without writing it."""
+        with self.cond:
+            self.dirty.pop(session, None)
+
+    def flusher_thread_func(self):
+        while True:
+            with self.cond:
+                while not self.dirty:
+                    self.cond.wait()
+                if self.dirty_bytes < self.dirty_bytes_threshold:
+                    self.cond.wait(self.interval)
+            self.flush_all()
+
+    def flush_all(self):
+        """Write out every dirty session, also called once at exit (after a flush in progress finishes)."""
+        with self.flush_lock:
+            with self.cond:
+                sessions = list(self.dirty)
+                self.dirty.clear()
+                self.dirty_bytes = 0
+
+            for session in sessions:
+                try:
+                    session.flush()
+                except Exception as e:
+                    logging.error(f"Failed to save {session}: {e}")
+
+
+flusher = SessionFlusher()
+
+# One exit hook for all sessions instead of one per SessionContext
+atexit.register(flusher.flush_all)
@@ -0,0 +1,155 @@
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+MODES = ('cprofile', 'sample')
+
+
+class Profiler:
+    """
+    Profiling of the running server, started and stopped with the 'profile' command.
+
+    cprofile profiles every thread (cProfile is interpreter-wide since Python 3.12) and writes
+    a pstats file, sample records the stacks of all threads every interval seconds and writes
+    them collapsed (one 'thread;caller;...;function count' line per stack, for flamegraph.pl
+    or speedscope).  A run stops after the given number of requests or seconds, or on stop().
+    With memory, tracemalloc runs alongside and a report of the allocation growth during the
+    run, and of each session loaded from disk, is written as well.  Files go to out_dir.
+    """
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.lock = threading.Lock()
+        self.run = None  # Options and state of the active run
+        self.last = None  # Result of the last finished run
+
+    def start(self, mode='cprofile', requests=None, seconds=None, memory=False, interval=0.005):
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode '{mode}', use one of {', '.join(MODES)}")
+        with self.lock:
+            if self.run is not None:
+                raise ValueError(f"A {self.run['mode']} run is already active, stop it first")
+            run = {'mode': mode, 'requests': requests, 'seconds': seconds, 'memory': memory,
+                   'started': time.time(), 'done': 0, 'session_loads': [], 'stop_event': threading.Event()}
+
+            if memory:
+                import tracemalloc
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                run['snapshot'] = tracemalloc.take_snapshot()
+            if mode == 'cprofile':
+                import cProfile
+                run['profile'] = cProfile.Profile()
+                run['profile'].enable()
+            else:
+                run['stacks'] = collections.Counter()
+                run['sampler'] = threading.Thread(target=self.sampler_thread_func, args=(run, interval), name='vern-sampler', daemon=True)
+                run['sampler'].start()
+            if seconds:
+                run['timer'] = threading.Timer(seconds, self.stop)
+                run['timer'].daemon = True
+                run['timer'].start()
+            self.run = run
+
+        logging.info(f"Profiling started: {mode}" + (f" for {requests} requests" if requests else "") + (f" for {seconds}s" if seconds else ""))
+        return self.status()
+
+    def sampler_thread_func(self, run, interval):
+        own_ident = threading.get_ident()
+        while not run['stop_event'].wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                run['stacks'][";".join(reversed(stack))] += 1
+
+    def request_done(self, cmd):
+        """Count a finished request against the run's request limit."""
+        run = self.run
+        if run is None or not run['requests'] or cmd == 'profile':
+            return
+        with self.lock:
+            run['done'] += 1
+            done = run['done'] >= run['requests']
+        if done:
+            self.stop()
+
+    def measure_load(self, sid):
+        """Context manager recording the memory a session load allocates, while a memory run is active."""
+        if self.run is None or not self.run['memory']:
+            return nullcontext()
+        return self._measure_load(self.run, sid)
+
+    @contextmanager
+    def _measure_load(self, run, sid):
+        import tracemalloc
+        before = tracemalloc.get_traced_memory()[0]
+        yield
+        run['session_loads'].append((sid, tracemalloc.get_traced_memory()[0] - before))
+
+    def stop(self):
+        """Finish the active run and write its files, returns the result (None if no run was active)."""
+        with self.lock:
+            run, self.run = self.run, None
+        if run is None:
+            return None
+        run['stop_event'].set()
+        if run.get('timer'):
+            run['timer'].cancel()
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(run['started']))
+        files = []
+        if run['mode'] == 'cprofile':
+            run['profile'].disable()
+        # Before the profile is written, so its allocations don't show up in the report
+        memory_report = self.write_memory_report(run, os.path.join(self.out_dir, f"memory-{stamp}.txt")) if run['memory'] else None
+        if run['mode'] == 'cprofile':
+            path = os.path.join(self.out_dir, f"cprofile-{stamp}.pstats")
+            run['profile'].dump_stats(path)
+            files.append(path)
+        else:
+            run['sampler'].join()
+            path = os.path.join(self.out_dir, f"sample-{stamp}.collapsed")
+            with open(path, 'w') as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in run['stacks'].most_common())
+            files.append(path)
+        if memory_report:
+            files.append(memory_report)
+
+        self.last = {'mode': run['mode'], 'seconds': round(time.time() - run['started'], 3), 'requests': run['done'], 'files': files}
+        logging.info(f"Profiling finished, wrote {', '.join(files)}")
+        return self.last
+
+    def write_memory_report(self, run, path):
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "*/cProfile.py"),
+        ])
+        tracemalloc.stop()
+        stats = snapshot.compare_to(run['snapshot'], 'lineno')
+        with open(path, 'w') as f:
+            f.write(f"Allocation growth during the run, top 30 of {len(stats)} lines\n")
+            f.writelines(f"{stat}\n" for stat in stats[:30])
+            f.write(f"\nSession loads: {len(run['session_loads'])}\n")
+            f.writelines(f"{sid}: {nbytes / 1024:.1f} KiB\n" for sid, nbytes in run['session_loads'])
+        return path
+
+    def status(self):
+        run = self.run
+        if run is None:
+            return {'active': False, 'last': self.last}
+        return {'active': True, 'mode': run['mode'], 'requests': run['requests'], 'done': run['done'],
+                'seconds': run['seconds'], 'elapsed': round(time.time() - run['started'], 3), 'memory': run['memory'],
+                'last': self.last}
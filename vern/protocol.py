@@ -4,14 +4,18 @@ import json
 import logging
 import sys
 
+from metrics import metrics
+
 # Function to create a JSON request
-def create_request(sid, cmd, data=None, system=None, oneshot=False):
+def create_request(sid, cmd, data=None, system=None, oneshot=False, stream=False, cache=None):
     """
     Create a JSON request object for the server to consume.
 
     Args:
         cmd (str): The command type.
         text (str, optional): The text data associated with the command. Defaults to None.
+        stream (bool, optional): Ask for the AI response as streamed chunks. Defaults to False.
+        cache (str, optional): 'bypass' or 'refresh' the server's response cache. Defaults to None.
 
     Returns:
         str: JSON string representing the request.
@@ -22,6 +26,8 @@ def create_request(sid, cmd, data=None, system=None, oneshot=False):
         "data": data,
         "system": system,
         "oneshot": oneshot,
+        "stream": stream,
+        "cache": cache,
     }
     return json.dumps(request_data)
 
@@ -31,12 +37,18 @@ def parse_request(json_str):
     Parse a JSON request object.
 
     Args:
-        json_str (str): JSON string representing the request.
+        json_str (str | bytes-like): JSON string representing the request.
 
     Returns:
         dict: Dictionary containing the parsed request data.
+
+    Raises:
+        ValueError: The payload is not valid UTF-8 JSON, or not a JSON object.
     """
-    return json.loads(json_str)
+    request = json.loads(json_str)
+    if not isinstance(request, dict):
+        raise ValueError(f"Request must be a JSON object, got {type(request).__name__}")
+    return request
 
 def create_response(sid, status, cmd, data=None):
     """
@@ -62,13 +74,16 @@ def parse_response(json_str):
     Parse a JSON response object.
 
     Args:
-        json_str (str): JSON string representing the response.
+        json_str (str | bytes-like): JSON string representing the response, or its UTF-8 bytes.
+            A memoryview is decoded to a str first (json.loads doesn't take one), so it is copied once.
 
     Returns:
         dict: Dictionary containing the parsed response data.
     """
 
     """ Parse a JSON response and handle empty input gracefully """
+    if isinstance(json_str, memoryview):
+        json_str = str(json_str, "utf-8")
     if not json_str or json_str.strip() == "":
         logging.error("Received an empty response from server")
         return {"status": "error", "cmd": "invalid", "data": "Empty response from server"}
@@ -78,24 +93,162 @@ def parse_response(json_str):
         logging.error(f"Invalid JSON received: {json_str}")
         return {"status": "error", "cmd": "invalid", "data": "Malformed response from server"}
 
-def recv_json(sock):
+# Framed requests start with this magic, followed by the same 4-byte big endian length prefix
+# responses use.  Anything else is a bare JSON request from an older client.
+REQUEST_MAGIC = b"VRN1"
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+class FrameTooLargeError(ValueError):
+    """A frame announced a length above the configured maximum."""
+
+    def __init__(self, message, rid=None):
+        super().__init__(message)
+        self.rid = rid  # Request id of the frame on multiplexed connections
+
+def encode_request(req):
+    """
+    Frame a JSON request string for sending.
+
+    Args:
+        req (str): JSON string from create_request.
+
+    Returns:
+        bytes: Magic, length prefix and payload.
+    """
+    payload = req.encode()
+    return REQUEST_MAGIC + len(payload).to_bytes(4, byteorder="big") + payload
+
+def recv_into_exact(sock, view):
     """
-    Receive JSON data from the socket.
+    Fill view from the socket.
 
     Args:
         sock (socket.socket): The socket object.
+        view (memoryview): Writable buffer to fill completely.
+
+    Returns:
+        int: Number of bytes received, less than len(view) only if the peer closed the connection.
+    """
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            break
+        received += n
+    return received
+
+def recv_request(sock, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+    """
+    Receive one request, either framed or a bare JSON request from an older client.
+
+    Args:
+        sock (socket.socket): The socket object.
+        max_frame_size (int, optional): Largest accepted request payload in bytes.
+
+    Returns:
+        dict: The parsed JSON data, None if the connection closed before a request arrived.
+    """
+    header = bytearray(8)
+    view = memoryview(header)
+    received = recv_into_exact(sock, view[:4])
+    if header[:4] != REQUEST_MAGIC:
+        if received == 0:
+            return None
+        return recv_json(sock, bytes(header[:received]))
+
+    if recv_into_exact(sock, view[4:]) < 4:
+        raise RuntimeError("Connection closed unexpectedly")
+    length = int.from_bytes(header[4:], byteorder="big")
+    if length > max_frame_size:
+        raise FrameTooLargeError(f"Request of {length} bytes exceeds the maximum frame size of {max_frame_size}")
+
+    payload = bytearray(length)
+    if recv_into_exact(sock, memoryview(payload)) < length:
+        raise RuntimeError("Connection closed unexpectedly")
+    metrics.inc('bytes_in_total', 8 + length)
+    return json.loads(payload)
+
+async def recv_request_async(loop, sock, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+    """
+    Async counterpart of recv_request for non-blocking sockets.
+
+    Args:
+        loop (asyncio.AbstractEventLoop): The running event loop.
+        sock (socket.socket): The non-blocking socket object.
+        max_frame_size (int, optional): Largest accepted request payload in bytes.
+
+    Returns:
+        dict: The parsed JSON data, None if the connection closed before a request arrived.
+    """
+    async def recv_into_exact_async(view):
+        received = 0
+        while received < len(view):
+            n = await loop.sock_recv_into(sock, view[received:])
+            if n == 0:
+                break
+            received += n
+        return received
+
+    header = bytearray(8)
+    view = memoryview(header)
+    received = await recv_into_exact_async(view[:4])
+    if header[:4] != REQUEST_MAGIC:
+        if received == 0:
+            return None
+        return await recv_json_async(loop, sock, bytes(header[:received]))
+
+    if await recv_into_exact_async(view[4:]) < 4:
+        raise RuntimeError("Connection closed unexpectedly")
+    length = int.from_bytes(header[4:], byteorder="big")
+    if length > max_frame_size:
+        raise FrameTooLargeError(f"Request of {length} bytes exceeds the maximum frame size of {max_frame_size}")
+
+    payload = bytearray(length)
+    if await recv_into_exact_async(memoryview(payload)) < length:
+        raise RuntimeError("Connection closed unexpectedly")
+    metrics.inc('bytes_in_total', 8 + length)
+    return json.loads(payload)
+
+def recv_json(sock, json_data=b""):
+    """
+    Receive an unframed JSON request from the socket, as sent by older clients.
+
+    Args:
+        sock (socket.socket): The socket object.
+        json_data (bytes, optional): Bytes of the request already read from the socket.
 
     Returns:
         dict: The parsed JSON data.
     """
-    json_data = b""  # Initialize an empty bytes object to store received data
     while True:
+        try:
+            # Attempt to decode the bytes object as UTF-8 and parse it as JSON
+            return json.loads(json_data.decode("utf-8"))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            pass  # If decoding/parsing fails, continue receiving data
         chunk = sock.recv(1024)  # Receive data in chunks
         if not chunk:  # If no more data is received
             break  # Break the loop
         json_data += chunk  # Append the received chunk to the bytes object
+
+async def recv_json_async(loop, sock, json_data=b""):
+    """
+    Receive an unframed JSON request from a non-blocking socket on an asyncio event loop.
+
+    Args:
+        loop (asyncio.AbstractEventLoop): The running event loop.
+        sock (socket.socket): The non-blocking socket object.
+        json_data (bytes, optional): Bytes of the request already read from the socket.
+
+    Returns:
+        dict: The parsed JSON data.
+    """
+    while True:
         try:
-            # Attempt to decode the bytes object as UTF-8 and parse it as JSON
             return json.loads(json_data.decode("utf-8"))
-        except json.JSONDecodeError:
-            continue  # If decoding/parsing fails, continue receiving data
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            pass
+        chunk = await loop.sock_recv(sock, 1024)
+        if not chunk:
+            break
+        json_data += chunk
@@ -0,0 +1,167 @@
+import logging
+import random
+import re
+import threading
+import time
+
+import openai
+
+
+class TokenBucket:
+    """Holds up to capacity units refilled at capacity per period seconds, may go into debt."""
+
+    def __init__(self, capacity, period=60.0):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """Take amount, return the seconds to wait until the bucket is out of debt."""
+        self.refill(now)
+        self.level -= amount
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def limit(self, remaining, now):
+        """Don't count on more than the server says is left."""
+        self.refill(now)
+        self.level = min(self.level, remaining)
+
+
+def parse_duration(value):
+    """Seconds in a rate limit reset header such as '1s', '6m0s' or '20ms'."""
+    seconds = 0.0
+    for number, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value):
+        seconds += float(number) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return seconds
+
+
+def retry_after(headers):
+    """Seconds the server asks us to wait, from retry-after-ms or retry-after, else None."""
+    try:
+        if (value := headers.get('retry-after-ms')) is not None:
+            return float(value) / 1000
+        if (value := headers.get('retry-after')) is not None:
+            return float(value)
+    except ValueError:
+        pass
+    return None
+
+
+class RateLimiter:
+    """
+    Paces upstream requests per model within requests-per-minute and tokens-per-minute
+    budgets.  A request is charged before it is sent with the tokens counted for its prompt,
+    and settled with the real usage afterwards.  The buckets follow the x-ratelimit-*
+    response headers, 429s and server errors are retried after Retry-After or a jittered
+    exponential backoff.
+    """
+
+    RETRIED_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+    def __init__(self, limits=None, rpm=500, tpm=200000, max_retries=5, backoff_base=1.0, backoff_max=60.0):
+        self.limits = limits or {}
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        self.buckets = {}  # model -> (requests bucket, tokens bucket)
+        self.blocked_until = {}  # model -> monotonic time set by Retry-After
+        self.waited = 0.0
+        self.retries = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(limits=config.get('models'), rpm=config.get('rpm', 500), tpm=config.get('tpm', 200000),
+                   max_retries=config.get('max_retries', 5), backoff_base=config.get('backoff_base', 1.0),
+                   backoff_max=config.get('backoff_max', 60.0))
+
+    def model_buckets(self, model):
+        if model not in self.buckets:
+            limits = self.limits.get(model, {})
+            self.buckets[model] = (TokenBucket(limits.get('rpm', self.rpm)), TokenBucket(limits.get('tpm', self.tpm)))
+        return self.buckets[model]
+
+    def acquire(self, model, tokens):
+        """Charge a request of tokens and wait until the budgets allow it."""
+        with self.lock:
+            now = time.monotonic()
+            requests_bucket, tokens_bucket = self.model_buckets(model)
+            delay = max(requests_bucket.reserve(1, now), tokens_bucket.reserve(tokens, now),
+                        self.blocked_until.get(model, now) - now)
+            self.waited += delay
+        if delay > 0:
+            logging.info(f"Rate limit for {model}, waiting {delay:.2f}s")
+            time.sleep(delay)
+
+    def settle(self, model, charged, used):
+        """Correct the tokens charged up front by the real usage."""
+        with self.lock:
+            self.model_buckets(model)[1].level -= used - charged
+
+    def update(self, model, headers):
+        """Follow the budgets the server reports in its x-ratelimit-* headers."""
+        with self.lock:
+            now = time.monotonic()
+            requests_bucket, tokens_bucket = self.model_buckets(model)
+            for kind, bucket in (('requests', requests_bucket), ('tokens', tokens_bucket)):
+                try:
+                    if (remaining := headers.get(f'x-ratelimit-remaining-{kind}')) is None:
+                        continue
+                    bucket.limit(int(remaining), now)
+                    # Exhausted, nothing goes through before the server resets the budget
+                    if int(remaining) <= 0 and (reset := headers.get(f'x-ratelimit-reset-{kind}')) is not None:
+                        self.blocked_until[model] = max(self.blocked_until.get(model, now), now + parse_duration(reset))
+                except ValueError:
+                    pass
+
+    def backoff(self, attempt):
+        return min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def call(self, model, tokens, request):
+        """
+        Run request() within the budgets and return its parsed result, request must return a
+        raw response (the SDK's with_raw_response) so the rate limit headers can be read.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(model, tokens)
+            try:
+                raw_response = request()
+            except self.RETRIED_ERRORS as e:
+                self.settle(model, tokens, 0)  # Charged again on the retry
+                if attempt == self.max_retries:
+                    raise
+                delay = None
+                if (response := getattr(e, 'response', None)) is not None:
+                    self.update(model, response.headers)
+                    if (delay := retry_after(response.headers)) is not None and isinstance(e, openai.RateLimitError):
+                        with self.lock:
+                            self.blocked_until[model] = time.monotonic() + delay
+                if delay is None:
+                    delay = self.backoff(attempt)
+                with self.lock:
+                    self.retries += 1
+                logging.warning(f"{type(e).__name__} from {model}, retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+
+            self.update(model, raw_response.headers)
+            result = raw_response.parse()
+            if (usage := getattr(result, 'usage', None)) is not None:
+                self.settle(model, tokens, usage.total_tokens)
+            return result
+
+    def stats(self):
+        with self.lock:
+            return {
+                'waited': round(self.waited, 3),
+                'retries': self.retries,
+                'models': {model: {'requests': round(requests_bucket.level, 1), 'tokens': round(tokens_bucket.level)}
+                           for model, (requests_bucket, tokens_bucket) in self.buckets.items()},
+            }
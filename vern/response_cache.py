@@ -0,0 +1,146 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from utils import atomic_write
+
+
+class ResponseCache:
+    """
+    AI responses by request key, in a memory LRU of max_entries in front of a disk tier of
+    one file per response under path.  Entries expire after ttl seconds; past max_disk_bytes
+    the least recently written files are removed.
+    """
+
+    def __init__(self, path, max_entries=256, ttl=86400, max_disk_bytes=100 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # key -> (expires, response), least recently used first
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self.disk_bytes = sum(size for _, _, size in self.disk_entries())
+
+    @staticmethod
+    def key(model, messages, params):
+        """Hash of everything that determines the response."""
+        request = json.dumps({'model': model, 'messages': messages, 'params': params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def file_path(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.json")
+
+    def disk_entries(self):
+        """(mtime, path, size) of every file in the disk tier."""
+        entries = []
+        for subdir in os.listdir(self.path):
+            subdir_path = os.path.join(self.path, subdir)
+            if not os.path.isdir(subdir_path):
+                continue
+            for f in os.listdir(subdir_path):
+                file_path = os.path.join(subdir_path, f)
+                try:
+                    st = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, file_path, st.st_size))
+        return entries
+
+    def get(self, key):
+        """Cached response for key or None."""
+        now = time.time()
+        with self.lock:
+            if (entry := self.memory.get(key)) is not None:
+                if entry[0] > now:
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.memory[key]
+
+        try:
+            with open(self.file_path(key), "r") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            entry = None
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Error reading cached response {key}: {e}")
+            entry = None
+
+        with self.lock:
+            if entry is None or entry['expires'] <= now:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self.remember(key, entry['expires'], entry['response'])
+            return entry['response']
+
+    def put(self, key, response):
+        expires = time.time() + self.ttl
+        data = json.dumps({'expires': expires, 'response': response})
+        file_path = self.file_path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        try:
+            old_size = os.path.getsize(file_path)
+        except FileNotFoundError:
+            old_size = 0
+        atomic_write(file_path, data)
+
+        with self.lock:
+            self.stores += 1
+            self.remember(key, expires, response)
+            self.disk_bytes += len(data) - old_size
+            over_budget = self.disk_bytes > self.max_disk_bytes
+        if over_budget:
+            self.evict_disk()
+
+    def remember(self, key, expires, response):
+        """Put an entry in the memory tier, called with the lock held."""
+        self.memory[key] = (expires, response)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def evict_disk(self):
+        """Remove expired files, then the oldest ones until the disk tier is under 90% of its budget."""
+        now = time.time()
+        entries = sorted(self.disk_entries())
+        total = sum(size for _, _, size in entries)
+        removed = 0
+        for mtime, file_path, size in entries:
+            if total <= self.max_disk_bytes * 0.9 and mtime + self.ttl > now:
+                continue
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+
+        with self.lock:
+            self.disk_bytes = total
+            self.evictions += removed
+        logging.debug(f"Evicted {removed} cached responses")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.memory),
+                'disk_bytes': self.disk_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'evictions': self.evictions,
+            }
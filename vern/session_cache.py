@@ -0,0 +1,118 @@
+import logging
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from persistence import flusher
+
+
+class SessionCache:
+    """
+    Resident SessionContexts, bounded by count (max_sessions) and by the size of their
+    content (max_bytes).  Past either limit the least recently used sessions are flushed
+    to disk and dropped, they are loaded again from their directory on the next request.
+    Pinned sessions, the ones a request is working on, are never evicted.
+    """
+
+    def __init__(self, max_sessions=256, max_bytes=64 * 1024 * 1024):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.sessions = OrderedDict()  # sid -> SessionContext, least recently used first
+        self.pins = Counter()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, sid):
+        with self.lock:
+            return sid in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def items(self):
+        with self.lock:
+            return list(self.sessions.items())
+
+    def get(self, sid):
+        """Return the resident session for sid or None, counts as a hit or a miss."""
+        with self.lock:
+            session_context = self.sessions.get(sid)
+            if session_context is None:
+                self.misses += 1
+                return None
+            self.sessions.move_to_end(sid)
+            self.hits += 1
+            return session_context
+
+    def peek(self, sid):
+        """Return the resident session for sid or None, without touching the LRU order or counters."""
+        with self.lock:
+            return self.sessions.get(sid)
+
+    def add(self, sid, session_context):
+        """Make session_context resident, returns the session already cached for sid if another request won the race."""
+        with self.lock:
+            if (existing := self.sessions.get(sid)) is not None:
+                self.sessions.move_to_end(sid)
+                return existing
+            self.sessions[sid] = session_context
+            self.evict()
+            return session_context
+
+    def pop(self, sid):
+        with self.lock:
+            return self.sessions.pop(sid, None)
+
+    @contextmanager
+    def pinned(self, sid):
+        """Keep sid resident while the block runs."""
+        with self.lock:
+            self.pins[sid] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.pins[sid] -= 1
+                if not self.pins[sid]:
+                    del self.pins[sid]
+                self.evict()
+
+    def content_bytes(self):
+        return sum(session_context.content_bytes for session_context in self.sessions.values())
+
+    def evict(self):
+        """Drop least recently used, unpinned sessions until the cache is within its limits."""
+        with self.lock:
+            total_bytes = self.content_bytes()
+            for sid in list(self.sessions):
+                if len(self.sessions) <= self.max_sessions and total_bytes <= self.max_bytes:
+                    break
+                if sid in self.pins:
+                    continue
+                session_context = self.sessions.pop(sid)
+                # Written out before it is gone, so a reload sees everything
+                flusher.discard(session_context)
+                try:
+                    session_context.flush()
+                except Exception as e:
+                    logging.error(f"Failed to save session {sid} on eviction: {e}")
+                    self.sessions[sid] = session_context
+                    self.sessions.move_to_end(sid, last=False)
+                    continue
+                total_bytes -= session_context.content_bytes
+                self.evictions += 1
+                logging.debug(f"Evicted session {sid}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'sessions': len(self.sessions),
+                'max_sessions': self.max_sessions,
+                'bytes': self.content_bytes(),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,134 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+from persistence import flusher
+from utils import atomic_write
+
+# Characters of the system content kept for list-s
+SYSTEM_PREVIEW_LENGTH = 70
+
+
+def sort_key(sid):
+    """Numbers first, then case-insensitive names, unique per sid."""
+    return (not sid.isdigit(), sid if sid.isdigit() else sid.lower(), sid)
+
+
+class SessionCatalog:
+    """
+    One entry per session in dpath (sid, truncated system content, model, message count,
+    last use and content size), kept in dpath/catalog.json and in sid order in memory.
+    The server updates it as sessions change, so list-s doesn't have to read every
+    session directory.  catalog.json is always written by the write-behind flusher, so a
+    command costs no more than marking the catalog dirty, whatever the session's storage.
+    """
+
+    def __init__(self, dpath):
+        self.dpath = dpath
+        self.path = os.path.join(dpath, "catalog.json")
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # One writer of catalog.json at a time (flusher, rebuild, exit)
+        self.entries = {}
+        self.order = []  # sids sorted by sort_key
+
+    def __str__(self):
+        return "session catalog"
+
+    def load(self):
+        """Load catalog.json, returns False if it is missing or unreadable and needs a rebuild."""
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Error reading {self.path}: {e}")
+            return False
+
+        with self.lock:
+            self.entries = {entry['sid']: entry for entry in entries}
+            self.order = sorted(self.entries, key=sort_key)
+        return True
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                data = json.dumps([self.entries[sid] for sid in self.order])
+            atomic_write(self.path, data)
+
+    def save(self):
+        flusher.mark_dirty(self)
+
+    @staticmethod
+    def make_entry(session_context, last_used):
+        system_content = session_context.system_content['content'].strip()
+        if len(system_content) > SYSTEM_PREVIEW_LENGTH:
+            system_content = system_content[:SYSTEM_PREVIEW_LENGTH] + "..."
+
+        return {
+            'sid': session_context.sid,
+            'system': system_content,
+            'model': session_context.config['settings'].get('model'),
+            'messages': len(session_context.user_and_assistant_content),
+            'last_used': last_used,
+            'size': session_context.content_bytes,
+        }
+
+    def update(self, session_context):
+        """Record the current state of session_context."""
+        entry = self.make_entry(session_context, time.time())
+        with self.lock:
+            if entry['sid'] not in self.entries:
+                bisect.insort(self.order, entry['sid'], key=sort_key)
+            self.entries[entry['sid']] = entry
+        self.save()
+
+    def remove(self, sid):
+        with self.lock:
+            if self.entries.pop(sid, None) is None:
+                return
+            del self.order[bisect.bisect_left(self.order, sort_key(sid), key=sort_key)]
+        self.save()
+
+    def list(self, filter=None, offset=0, limit=None):
+        """Entries in sid order, optionally only those whose sid or system content contains filter."""
+        with self.lock:
+            if filter:
+                needle = filter.lower()
+                sids = [sid for sid in self.order
+                        if needle in sid.lower() or needle in self.entries[sid]['system'].lower()]
+            else:
+                sids = self.order
+            end = None if limit is None else offset + limit
+            return [self.entries[sid] for sid in sids[offset:end]], len(sids)
+
+    def rebuild(self, load_session):
+        """Recreate the catalog from the session directories, load_session(sid) returns a SessionContext."""
+        entries = {}
+        for f in os.listdir(self.dpath):
+            session_path = os.path.join(self.dpath, f)
+            if not (f.startswith("session-") and os.path.isdir(session_path)):
+                continue
+            if not (os.path.isfile(os.path.join(session_path, "system.json")) and
+                    os.path.isfile(os.path.join(session_path, "conversation.json"))):
+                continue
+
+            sid = f.removeprefix("session-")
+            try:
+                session_context = load_session(sid)
+                last_used = max(os.path.getmtime(os.path.join(session_path, name)) for name in os.listdir(session_path))
+            except Exception as e:
+                logging.error(f"Error reading session-{sid}: {e}")
+                continue
+            entries[sid] = self.make_entry(session_context, last_used)
+
+        with self.lock:
+            self.entries = entries
+            self.order = sorted(entries, key=sort_key)
+
+        logging.info(f"Rebuilt session catalog with {len(entries)} sessions")
+        self.flush()
+        return len(entries)
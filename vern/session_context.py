@@ -1,11 +1,15 @@
-import atexit
+import copy
 import json
 import logging
 import os
 import pprint
 import shutil
+import threading
 
-from utils import load_config, save_config
+from metrics import metrics
+from persistence import flusher
+from tracing import tracer
+from utils import atomic_write, load_config, save_config
 
 class SessionContext:
     DEFAULT_SYSTEM_CONTENT = (
@@ -41,6 +45,11 @@ class SessionContext:
             counter += 1
             trash_path = os.path.join(trash_dir, f"{base_name}-{counter}")
 
+        # ✅ Drop pending writes, they would recreate files in the moved directory
+        flusher.discard(self)
+        with self.flush_lock:
+            self.removed = True
+
         # ✅ Move session to trash
         shutil.move(self.session_dir, trash_path)
         logging.info(f"Moved session {sid} to trash as {os.path.basename(trash_path)}")
@@ -52,12 +61,30 @@ class SessionContext:
         if self.sid.startswith('ppid'):
             ppid=True
 
-        self.config = config
+        # A copy of its own, use-model and context-policy change this session's settings only
+        self.config = copy.deepcopy(config)
         if config is None:
             script_path = os.path.dirname(os.path.abspath(__file__))
             config_path = os.path.join(script_path, "config.yaml")
             self.config = load_config(config_path)
 
+        # 'json' rewrites conversation.json on every message, 'journal' appends each message to
+        # conversation.jsonl and folds it into conversation.json every journal_compact_every records
+        self.storage = self.config['settings'].get('storage', 'json')
+        self.journal_compact_every = self.config['settings'].get('journal_compact_every', 100)
+        self.journal_records = 0
+
+        # With write_behind, changes are written by the background flusher instead of in the
+        # request path; fsync makes every write durable before it counts as done
+        self.write_behind = self.config['settings'].get('write_behind', False)
+        self.fsync = self.config['settings'].get('fsync', False)
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.dirty = set()  # Parts to rewrite: 'system', 'conversation', 'config'
+        self.pending_records = []
+        self.pending_oneshots = []
+        self.removed = False
+
         self.session_dir = os.path.join(self.config['settings']['dpath'], f'session-{self.sid}')
         if ppid:
             self.session_dir = os.path.join(self.config['settings']['dpath'], '.ppid', f'session-{self.sid}')
@@ -65,7 +92,12 @@ class SessionContext:
         # File paths
         self.system_file = os.path.join(self.session_dir, "system.json")
         self.conversation_file = os.path.join(self.session_dir, "conversation.json")
+        self.journal_file = os.path.join(self.session_dir, "conversation.jsonl")
         self.config_file = os.path.join(self.session_dir, "config.yaml")
+        self.summary_file = os.path.join(self.session_dir, "summary.json")
+
+        # Summary of the first summary['upto'] messages, kept by the 'summary' context policy
+        self.summary = None
 
         # Load existing session or initialize new one
         if self.session_exists(self.config['settings']['dpath'], sid):
@@ -81,8 +113,16 @@ class SessionContext:
             self.user_and_assistant_content = []  # Initialize empty conversation history
             self.save_session()  # Ensure initial system message is saved
 
-        # Register exit handler to save session
-        atexit.register(self.save_session)
+        # Messages carry their token count per encoding name under 'tokens', token_count is
+        # the total for the system content and the conversation under the current encoder
+        self.encoder = None
+        self.token_count = 0
+
+        # Size of the resident content, kept up to date so the session cache can budget memory
+        self.content_bytes = len(self.system_content['content']) + sum(len(m['content']) for m in self.user_and_assistant_content)
+
+    def __str__(self):
+        return f"session {self.sid}"
 
     def load_session(self):
         """Load system message and conversation from files."""
@@ -92,29 +132,166 @@ class SessionContext:
         with open(self.conversation_file, "r") as f:
             self.user_and_assistant_content = json.load(f)
 
+        # Replay any journal tail on top of the snapshot, whatever the storage mode, so
+        # switching modes doesn't lose messages
+        if os.path.exists(self.journal_file):
+            self.replay_journal()
+
         self.config = load_config(self.config_file)
 
+        if os.path.exists(self.summary_file):
+            with open(self.summary_file, "r") as f:
+                self.summary = json.load(f)
+
+    def replay_journal(self):
+        """Apply conversation.jsonl records to the conversation loaded from the snapshot."""
+        with open(self.journal_file, "rb") as f:
+            lines = f.readlines()
+
+        offset = 0
+        for n, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                if n == len(lines) - 1:
+                    # Cut it off, the next append would otherwise continue the partial line
+                    logging.warning(f"Truncating torn last record in {self.journal_file}")
+                    os.truncate(self.journal_file, offset)
+                    lines.pop()
+                    break
+                raise
+            offset += len(line)
+
+            if record['op'] == 'add':
+                # Records already folded into the snapshot by an interrupted compaction
+                if record['seq'] < len(self.user_and_assistant_content):
+                    continue
+                self.user_and_assistant_content.append(record['message'])
+            elif record['op'] == 'reset':
+                self.user_and_assistant_content = []
+
+        if lines and not lines[-1].endswith(b"\n"):
+            # A whole record that lost its newline, end it before anything is appended
+            with open(self.journal_file, "ab") as f:
+                f.write(b"\n")
+        self.journal_records = len(lines)
+
+    def persist(self, *parts, record=None, nbytes=0):
+        """Mark parts of the session (and a journal record) for writing, then write them now or leave them to the flusher."""
+        with self.lock:
+            self.dirty.update(parts)
+            if record is not None:
+                self.pending_records.append(record)
+        self.schedule_flush(nbytes)
+
+    def schedule_flush(self, nbytes=0):
+        # Never called with self.lock held, flush() takes flush_lock before self.lock
+        if self.write_behind:
+            flusher.mark_dirty(self, nbytes)
+        else:
+            self.flush()
+
+    def flush(self):
+        """Write everything persist() marked, pending journal records in a single append."""
+        with self.flush_lock:
+            with self.lock:
+                dirty, self.dirty = self.dirty, set()
+                records, self.pending_records = self.pending_records, []
+                oneshots, self.pending_oneshots = self.pending_oneshots, []
+                system = json.dumps(self.system_content, indent=4) if 'system' in dirty else None
+                conversation = json.dumps(self.user_and_assistant_content, indent=4) if 'conversation' in dirty else None
+                config = copy.deepcopy(self.config) if 'config' in dirty else None
+
+            if self.removed or not (dirty or records or oneshots):
+                return
+
+            with metrics.timer('session_flush_seconds'), tracer.span('session_flush', sid=self.sid):
+                if system is not None:
+                    atomic_write(self.system_file, system, self.fsync)
+                if records:
+                    self.append_journal(records)
+                if conversation is not None:
+                    self.save_conversation(conversation)
+                if config is not None:
+                    save_config(config, self.config_file, self.fsync)
+                for ai_text_response in oneshots:
+                    self.write_oneshot(ai_text_response)
+
+    def append_journal(self, records):
+        with open(self.journal_file, "a") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        with self.lock:
+            self.journal_records += len(records)
+
+    def save_conversation(self, conversation):
+        """Write the conversation snapshot, which makes the journal redundant."""
+        atomic_write(self.conversation_file, conversation, self.fsync)
+        if self.journal_records or os.path.exists(self.journal_file):
+            open(self.journal_file, "w").close()
+            with self.lock:
+                self.journal_records = 0
+
     def save_session(self):
         """Save the system message and conversation together."""
-        with open(self.system_file, "w") as f:
-            json.dump(self.system_content, f, indent=4)
-
-        with open(self.conversation_file, "w") as f:
-            json.dump(self.user_and_assistant_content, f, indent=4)
-
-        save_config(self.config, self.config_file)
+        with self.lock:
+            self.dirty.update(('system', 'conversation', 'config'))
+        self.flush()
+
+    def count_tokens(self, message):
+        """Token count of message under the current encoder, computed once and cached in the message."""
+        if getattr(self.encoder, 'approximate', False):
+            return len(self.encoder.encode(message['content']))  # Cheap, and not worth saving
+        tokens = message.setdefault('tokens', {})
+        if self.encoder.name not in tokens:
+            tokens[self.encoder.name] = len(self.encoder.encode(message['content']))
+        return tokens[self.encoder.name]
+
+    def set_encoder(self, encoder):
+        """Count tokens with encoder from now on, messages not yet counted with it are counted once here."""
+        with self.lock:
+            if self.encoder is not None and self.encoder.name == encoder.name:
+                return
+            self.encoder = encoder
+
+            missing = [m for m in [self.system_content] + self.user_and_assistant_content if encoder.name not in m.get('tokens', {})]
+            self.token_count = self.count_tokens(self.system_content) + sum(self.count_tokens(m) for m in self.user_and_assistant_content)
+            if not missing or getattr(encoder, 'approximate', False):
+                return
+            logging.info(f"Counted {encoder.name} tokens of {len(missing)} messages in {self.sid}")
+            self.dirty.add('conversation')
+            if self.system_content in missing:
+                self.dirty.add('system')
+        self.schedule_flush()
+
+    def api_messages(self, messages):
+        """Messages as sent to the API, without the cached token counts."""
+        return [{'role': m['role'], 'content': m['content']} for m in messages]
+
+    def add_message(self, message):
+        with self.lock:
+            if self.encoder is not None:
+                self.token_count += self.count_tokens(message)
+            self.user_and_assistant_content.append(message)
+            self.content_bytes += len(message['content'])
+            if self.storage != 'journal':
+                self.dirty.add('conversation')
+            else:
+                # Queue the record under the same lock as the append so seq order is kept
+                self.pending_records.append({'op': 'add', 'seq': len(self.user_and_assistant_content) - 1, 'message': message})
+                if self.journal_records + len(self.pending_records) >= self.journal_compact_every:
+                    self.dirty.add('conversation')  # Compact
+        self.schedule_flush(len(message['content']))
 
     def add_user_content(self, content):
         """Add a new message to the conversation and save session."""
-        message = {'role': 'user', "content": content}
-        self.user_and_assistant_content.append(message)
-        self.save_session()
+        self.add_message({'role': 'user', "content": content})
 
     def add_assistant_content(self, content):
         """Add a new message to the conversation and save session."""
-        message = {'role': 'assistant', "content": content}
-        self.user_and_assistant_content.append(message)
-        self.save_session()
+        self.add_message({'role': 'assistant', "content": content})
 
     def get_user_and_assistant_content(self):
         """Retrieve all user-assistant messages, preserving order."""
@@ -122,14 +299,25 @@ class SessionContext:
 
     def set_system_content(self, new_system_content):
         """Update the system message and save session."""
-        self.system_content = {'role': 'system', 'content': new_system_content}
-        self.save_session()
+        with self.lock:
+            self.content_bytes += len(new_system_content) - len(self.system_content['content'])
+            if self.encoder is not None:
+                self.token_count -= self.count_tokens(self.system_content)
+            self.system_content = {'role': 'system', 'content': new_system_content}
+            if self.encoder is not None:
+                self.token_count += self.count_tokens(self.system_content)
+        self.persist('system', nbytes=len(new_system_content))
 
     def get_system_content(self):
         return self.system_content['content']
 
     def add_oneshot_content(self, ai_text_response):
         """Save AI response as a one-shot file in session_dir/oneshot-X.json."""
+        with self.lock:
+            self.pending_oneshots.append(ai_text_response)
+        self.schedule_flush(len(ai_text_response))
+
+    def write_oneshot(self, ai_text_response):
         base_name = "oneshot"
         counter = 1
         oneshot_path = os.path.join(self.session_dir, f"{base_name}-{counter}.json")
@@ -147,12 +335,44 @@ class SessionContext:
 
     def set_model(self, model):
         self.config['settings']['model'] = model
-        self.save_session()
+        self.persist('config')
+
+    def set_context(self, policy=None, budget=None, pin_turns=None):
+        """Set the session's context policy settings, None leaves a setting unchanged."""
+        for key, value in (('context_policy', policy), ('context_budget', budget), ('context_pin_turns', pin_turns)):
+            if value is not None:
+                self.config['settings'][key] = value
+        self.persist('config')
+
+    def set_summary(self, summary):
+        """Store the summary of the first summary['upto'] messages, written right away as it is costly to redo."""
+        with self.lock:
+            if self.removed or summary['upto'] > len(self.user_and_assistant_content):
+                return  # The session was removed or reset meanwhile
+            self.summary = summary
+            data = json.dumps(summary, indent=4)
+        atomic_write(self.summary_file, data, self.fsync)
+
+    def clear_summary(self):
+        with self.lock:
+            self.summary = None
+        if os.path.exists(self.summary_file):
+            os.remove(self.summary_file)
 
     def reset(self):
         logging.info(f'Resetting {self.sid}')
-        self.user_and_assistant_content = []
-        self.save_session()
+        with self.lock:
+            self.user_and_assistant_content = []
+            self.content_bytes = len(self.system_content['content'])
+            if self.encoder is not None:
+                self.token_count = self.count_tokens(self.system_content)
+            self.dirty.add('conversation')
+            # Journal the reset ahead of the snapshot so a crash before the journal is
+            # truncated can't revive the old messages
+            if self.storage == 'journal':
+                self.pending_records.append({'op': 'reset'})
+        self.clear_summary()
+        self.schedule_flush()
 
     def archive_conversation(self):
         base_name = "conversation"
@@ -162,6 +382,13 @@ class SessionContext:
         # Construct full path to original file
         conv_path = os.path.join(self.session_dir, f"{base_name}{ext}")
 
+        # Write out pending changes and fold the journal into conversation.json so the
+        # archive is complete
+        if os.path.exists(conv_path):
+            with self.lock:
+                self.dirty.add('conversation')
+            self.flush()
+
         # Ensure conversation.json exists
         if not os.path.exists(conv_path):
             print(f"No {base_name}{ext} found to archive.")
@@ -179,5 +406,10 @@ class SessionContext:
         os.rename(conv_path, archive_path)
         print(f"Archived to {archive_path}")
 
-        self.user_and_assistant_content = []
+        with self.lock:
+            self.user_and_assistant_content = []
+            self.content_bytes = len(self.system_content['content'])
+            if self.encoder is not None:
+                self.token_count = self.count_tokens(self.system_content)
+        self.clear_summary()
         self.save_session()
@@ -0,0 +1,59 @@
+import threading
+
+
+class SingleFlightTimeout(Exception):
+    """Waited too long for the call in flight with the same key."""
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces identical calls in flight: the first call for a key runs, calls for the same
+    key arriving meanwhile wait for it and get its result, or its exception raised again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, timeout=None):
+        """Return fn(), or the result of the fn running for key already, waiting at most timeout seconds for it."""
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = Call()
+                self.leaders += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+            return call.result
+
+        if not call.done.wait(timeout):
+            raise SingleFlightTimeout(f"No result after {timeout} seconds from the identical request in flight")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {'in_flight': len(self.calls), 'calls': self.leaders, 'coalesced': self.coalesced}
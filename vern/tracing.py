@@ -0,0 +1,113 @@
+import collections
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class Tracer:
+    """
+    Spans of the phases of each request (receiving it, loading the session, counting
+    tokens, the upstream call, saving, sending), kept in a ring buffer of the last capacity
+    spans and exported as Chrome trace JSON (chrome://tracing, ui.perfetto.dev).
+
+    Spans within a request() are tagged with its sid and cmd.  A request taking longer than
+    slow_ms is logged with the time of each of its phases.
+    """
+
+    def __init__(self, enabled=True, capacity=10000, slow_ms=None):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.spans = collections.deque(maxlen=capacity)  # (name, start ns, duration ns, thread id, args)
+        self.local = threading.local()  # Tags and spans of the request running on the thread
+        self.thread_names = {}
+
+    def configure(self, enabled=None, capacity=None, slow_ms=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if capacity is not None and capacity != self.spans.maxlen:
+            self.spans = collections.deque(self.spans, maxlen=capacity)
+        if slow_ms is not None:
+            self.slow_ms = slow_ms or None
+
+    def record(self, name, start, duration, args, thread=None):
+        thread = thread or threading.current_thread()
+        self.thread_names[thread.ident] = thread.name
+        span = (name, start, duration, thread.ident, args)
+        self.spans.append(span)  # deque.append is atomic, no lock needed
+        if (request_spans := getattr(self.local, 'request_spans', None)) is not None:
+            request_spans.append(span)
+
+    @contextmanager
+    def _span(self, name, args):
+        tags = getattr(self.local, 'tags', None)
+        if tags:
+            args = {**tags, **args}
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter_ns() - start, args)
+
+    def add(self, name, start, duration, thread=None, **args):
+        """Record a phase timed before the request was known (on thread, the current one by default), tagged like span()."""
+        if not self.enabled:
+            return
+        tags = getattr(self.local, 'tags', None)
+        if tags:
+            args = {**tags, **args}
+        self.record(name, start, duration, args, thread)
+
+    def span(self, name, **args):
+        """Context manager timing a phase, does nothing while tracing is off."""
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, args)
+
+    @contextmanager
+    def _request(self, sid, cmd):
+        self.local.tags = {'sid': sid, 'cmd': cmd}
+        self.local.request_spans = []
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter_ns() - start
+            request_spans = self.local.request_spans
+            self.local.tags = None
+            self.local.request_spans = None
+            self.record('request', start, duration, {'sid': sid, 'cmd': cmd})
+            if self.slow_ms is not None and duration / 1e6 >= self.slow_ms:
+                self.log_slow(sid, cmd, duration, request_spans)
+
+    def request(self, sid, cmd):
+        """Context manager around a whole request, the spans within it are tagged with sid and cmd."""
+        if not self.enabled:
+            return nullcontext()
+        return self._request(sid, cmd)
+
+    def log_slow(self, sid, cmd, duration, request_spans):
+        phases = collections.defaultdict(int)
+        for name, _, span_duration, _, _ in request_spans:
+            phases[name] += span_duration
+        breakdown = ", ".join(f"{name} {ns / 1e6:.1f}" for name, ns in phases.items())
+        logging.warning(f"Slow request {cmd} for {sid}: {duration / 1e6:.1f} ms ({breakdown})")
+
+    def chrome_trace(self, clear=False):
+        """The buffered spans as a Chrome trace event dict, optionally emptying the buffer."""
+        spans = list(self.spans)
+        if clear:
+            self.spans.clear()
+        pid = os.getpid()
+        # A copy, handler threads starting meanwhile add names
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in dict(self.thread_names).items()]
+        for name, start, duration, tid, args in spans:
+            events.append({'name': name, 'cat': 'vern', 'ph': 'X', 'ts': start / 1000, 'dur': duration / 1000,
+                           'pid': pid, 'tid': tid, 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+# Tracer of the server process, set up from the 'tracing' config section
+tracer = Tracer()
@@ -2,41 +2,87 @@ import config
 import json
 import logging
 import os
-import subprocess
+import protocol
 import socket
 import sys
 import time
-import yaml
+
+# Read once at import, os.umask can only be read by setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def receive_exact_into(connection, view):
+    """Fill the writable buffer view from the connection, raise if it closes first."""
+    if protocol.recv_into_exact(connection, view) < len(view):
+        raise RuntimeError("Connection closed unexpectedly")
 
 def receive_exact_bytes(connection, num_bytes):
-    received_data = b""
-    while len(received_data) < num_bytes:
-        chunk = connection.recv(num_bytes - len(received_data))
-        if not chunk:
-            raise RuntimeError("Connection closed unexpectedly")
-        received_data += chunk
+    """Receive exactly num_bytes into a buffer of its own, returned as a bytearray."""
+    received_data = bytearray(num_bytes)
+    receive_exact_into(connection, memoryview(received_data))
     return received_data
 
 def receive_length(connection):
-    length_bytes = connection.recv(4)
-    return int.from_bytes(length_bytes, byteorder='big')
+    return int.from_bytes(receive_exact_bytes(connection, 4), byteorder='big')
+
+class FrameReader:
+    """
+    Reads length-prefixed frames from a connection into one reusable buffer.
+
+    The memoryview returned by read_exact and read_frame points into that buffer and is
+    only valid until the next read, decode it (parse_response takes it and decodes it to a str)
+    before reading on.
+    """
+
+    def __init__(self, connection, initial_size=64 * 1024):
+        self.connection = connection
+        self.buffer = bytearray(initial_size)
+
+    def read_exact(self, num_bytes):
+        if num_bytes > len(self.buffer):
+            self.buffer = bytearray(max(num_bytes, 2 * len(self.buffer)))
+        view = memoryview(self.buffer)[:num_bytes]
+        receive_exact_into(self.connection, view)
+        return view
+
+    def read_length(self):
+        return int.from_bytes(self.read_exact(4), byteorder='big')
+
+    def read_frame(self):
+        return self.read_exact(self.read_length())
 
 def read_server_info(file_path):
+    """Returns the address info the server advertised, or None if there is none."""
     try:
         with open(file_path, "r") as f:
             data = json.load(f)
             host = data.get("host")
             port = data.get("port")
 
-            if not host or not isinstance(port, int):
+            if not host or not (port is None or isinstance(port, int)):
                 raise ValueError("Invalid host or port values in JSON file.")
 
-            return host, port
-    except (FileNotFoundError, json.JSONDecodeError, ValueError) as e:
+            return data
+    except FileNotFoundError:
+        return None
+    except (json.JSONDecodeError, ValueError) as e:
         logging.error(f"Failed to read {file_path}: {e}")
-        sys.exit(1)
+        return None
+
+def unix_socket_address(name, dpath):
+    """Resolve a unix_socket config value: '@name' is abstract, relative paths are under dpath."""
+    if name.startswith('@'):
+        return '\0' + name[1:]
+    return os.path.join(dpath, os.path.expanduser(name))
+
+def unix_socket_name(address):
+    """Inverse of unix_socket_address, for logs and server_info."""
+    if address.startswith('\0'):
+        return '@' + address[1:]
+    return address
 
 def open_vim():
+    import subprocess
     timestamp = time.strftime("%Y%m%d-%H%M%S")
     filename = f"prompt-{timestamp}.txt"
     subprocess.run(['vim', filename])
@@ -48,10 +94,13 @@ def find_available_port():
         temp_socket.bind(('localhost', 0))
         return temp_socket.getsockname()[1]
 
-def write_server_info_to_file(host, port):
+def write_server_info_to_file(host, port, unix_socket=None):
     os.makedirs(config.path, exist_ok=True)
     with open(config.server_info_file, 'w') as f:
-        json.dump({'host' : host, 'port' : port}, f, indent=4)
+        server_info = {'host' : host, 'port' : port}
+        if unix_socket:
+            server_info['unix'] = unix_socket
+        json.dump(server_info, f, indent=4)
 
 def send_response(client_socket, response):
     client_socket.sendall(len(response).to_bytes(4, 'big'))
@@ -75,7 +124,7 @@ def send_command(req, host, port, filename=None, save=False):
             logging.error(f"An unexpected error occurred: {e}")
 
         logging.debug(f"Sending {req}")
-        client_socket.sendall(req.encode())
+        client_socket.sendall(protocol.encode_request(req))
 
         l = receive_length(client_socket)
         logging.debug(f'Receive length of response {l}')
@@ -85,6 +134,7 @@ def send_command(req, host, port, filename=None, save=False):
 
 def load_config(config_path, overrides=None):
     """Load YAML config and allow overrides via a dictionary."""
+    import yaml  # Only the server and config changes pay for it, see load_config_cached
     with open(config_path, "r") as f:
         config = yaml.safe_load(f)
 
@@ -100,16 +150,70 @@ def load_config(config_path, overrides=None):
 
     return config
 
-def save_config(config, config_path):
+def load_config_cached(config_path, cache_path=None):
+    """
+    load_config for the client: the parsed config is kept as JSON in cache_path and used
+    for as long as config_path has the same mtime and size, so yaml is not imported.
+    """
+    cache_path = cache_path or config.config_cache_file
+    st = os.stat(config_path)
+    stamp = [config_path, st.st_mtime_ns, st.st_size]
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        if cached.get('stamp') == stamp:
+            return cached['config']
+    except (OSError, ValueError):
+        pass
+
+    loaded = load_config(config_path)
+    try:
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        atomic_write(cache_path, json.dumps({'stamp': stamp, 'config': loaded}))
+    except (OSError, TypeError) as e:
+        logging.debug(f"Could not cache config in {cache_path}: {e}")
+    return loaded
+
+def atomic_write(path, data, fsync=False):
+    """
+    Replace path with data (str) so readers see either the old or the new file, never a partial one.
+    Each call writes its own temp file, so concurrent writers of the same path don't collide.
+    With fsync the new file and the rename are on disk when this returns.
+    """
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix='.tmp', dir=os.path.dirname(path) or '.')
+    try:
+        os.fchmod(fd, 0o666 & ~UMASK)  # mkstemp creates 0600, keep the permissions open() would give
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    if fsync:
+        dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+def save_config(config, config_path, fsync=False):
     """
     Save the configuration dictionary to a YAML file.
 
     :param config: Dictionary containing configuration key-value pairs.
     :param config_path: Path to the YAML file where the config will be saved.
+    :param fsync: Wait for the file to reach the disk.
     """
+    import yaml
     try:
-        with open(config_path, 'w') as file:
-            yaml.dump(config, file, default_flow_style=False)
+        atomic_write(config_path, yaml.dump(config, default_flow_style=False), fsync)
         print(f"Configuration saved to {config_path}")
     except Exception as e:
         print(f"An error occurred while saving the configuration: {e}")
@@ -1,54 +1,68 @@
 #!/usr/bin/env python3
 
-import argparse
+import config
 import json
 import logging
 import os
-import pickle
-import readline
 import sys
-import socket
-import shutil
 import time
-import utils
-import uuid
 
+from connection import MuxConnection, MuxRefusedError, SocketRequest
 from protocol import create_request, parse_response
-from utils import receive_exact_bytes, receive_length, read_server_info, open_vim, load_config
-from history import load_history, save_history
+from utils import read_server_info, open_vim, load_config_cached, unix_socket_address
 
-from colorama import init, Fore, Style
-from rich.console import Console
-from rich.markdown import Markdown
+# rich, colorama and readline are imported where they are used, most invocations are a
+# single query that needs none of them (or only rich, once the response is in)
+console = None
+
+def get_console():
+    global console
+    if console is None:
+        from rich.console import Console
+        console = Console()
+    return console
 
 class Client:
-    def __init__(self, sid=None, config=None, no_markdown=False, save_responses=False):
+    def __init__(self, sid=None, config=None, no_markdown=False, save_responses=False, stream=None):
 
         self.sid = sid if sid else f'ppid-{os.getppid()}'
         self.no_markdown = no_markdown
         self.save_responses = save_responses
         self.response_count = 0  # Counter for responses
-        self.client_socket = None
+        self.connection = None
+        self.request_stream = None
+        self.addresses = None
         self.oneshot = False
+        self.cache = None  # 'bypass' or 'refresh' the server's response cache
 
-        self.systems = self.load_systems()
+        self._systems = None
 
         if config is None:
             script_path = os.path.dirname(os.path.abspath(__file__))
             config_path = os.path.join(script_path, "config.yaml")
-            self.config = load_config(config_path)
+            self.config = load_config_cached(config_path)
         else:
             self.config = config
 
         self.host = self.config['network']['host']
         self.port = self.config['network']['port']
-
-        init()
+        self.stream = stream if stream is not None else self.config['settings'].get('stream', False)
+        # Keep one multiplexed connection open for all requests of this process
+        self.persistent = self.config['network'].get('persistent', False)
 
         #self.client_tmp_dir = self.create_client_tmp_dir()
 
+    @property
+    def systems(self):
+        """Predefined systems, systems.json is only read by the commands that use them."""
+        if self._systems is None:
+            self._systems = self.load_systems()
+        return self._systems
+
     def handle_response(self, response_data):
         if response_data.get("status") == "error":
+            from colorama import init, Fore, Style
+            init()
             print(Fore.RED + Style.BRIGHT)
             print("=== ERROR RESPONSE ===")
             print("Command:", json.dumps(response_data.get("cmd"), indent=2))
@@ -59,6 +73,7 @@ class Client:
         return False
 
     def create_client_tmp_dir(self, base="/var/tmp/"):
+        import uuid
         ppid = os.getppid()
         unique_id = uuid.uuid4().hex  # Generates a 32-char hex string
         dir_path = os.path.join(base, f"vern-client-{ppid}")
@@ -68,6 +83,7 @@ class Client:
         return dir_path
 
     def load_history(self):
+        from history import load_history
         load_history(self.history_file)
 
     def server_exit(self):
@@ -89,45 +105,64 @@ class Client:
         self.history_file = os.path.join(self.config['settings']['dpath'], f"history-{self.sid}.txt")
 
     def do_user_content(self, msg):
-        req = create_request(self.sid, 'query', msg, oneshot=self.oneshot)
+        req = create_request(self.sid, 'query', msg, oneshot=self.oneshot, stream=self.stream, cache=self.cache)
         json_data = self.send_command(req)
         logging.debug(f"Got response {json_data}")
         self.handle_response(json_data)
 
-    def send_command(self, req, filename=None, save=False):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as self.client_socket:
-            try:
-                self.client_socket.connect((self.host, self.port))
-            except ConnectionRefusedError as e:
-                if e.errno == 111:
-                    logging.error("No vern server detected")
-                    sys.exit(1)
-                else:
-                    raise
-            except Exception as e:
-                logging.error(f"An unexpected error occurred: {e}")
-
-            logging.debug(f"Sending {req}")
-            self.client_socket.sendall(req.encode())
+    def server_addresses(self):
+        """Addresses to try in order: the server's unix socket if it advertises one, then TCP."""
+        if self.addresses is None:
+            self.addresses = []
+            server_info = read_server_info(config.server_info_file)
+            # Only trust the advertised socket if it belongs to the server we are configured for
+            if server_info and server_info.get('unix') and server_info.get('port') in (None, self.port):
+                self.addresses.append(unix_socket_address(server_info['unix'], self.config['settings']['dpath']))
+            self.addresses.append((self.host, self.port))
+        return self.addresses
+
+    def open_request(self, req):
+        """Send req on the persistent connection when enabled, else on a connection of its own."""
+        try:
+            if self.connection is not None and self.connection.closed:
+                self.connection = None
+
+            if self.persistent and self.connection is None:
+                try:
+                    self.connection = MuxConnection(self.server_addresses(), self.sid)
+                except MuxRefusedError as e:
+                    logging.debug(f"{e}, using a connection per request")
+                    self.persistent = False
+
+            if self.connection is not None:
+                return self.connection.request(req)
+            return SocketRequest(self.server_addresses(), req)
+
+        except ConnectionRefusedError as e:
+            if e.errno == 111:
+                logging.error("No vern server detected")
+                sys.exit(1)
+            else:
+                raise
 
-            l = receive_length(self.client_socket)
-            logging.debug(f'Receive length of response {l}')
-            data = receive_exact_bytes(self.client_socket, l)
-            logging.debug(data)
+    def send_command(self, req, filename=None, save=False):
+        with self.open_request(req) as self.request_stream:
+            data = self.request_stream.recv_frame()
 
             json_data = parse_response(data)
+            logging.debug(json_data)
             #if self.handle_response(json_data):
             #    sys.exit(0)
             status = json_data['status']
             data = json_data['data']
             cmd = json_data['cmd']
 
-            if json_data['cmd'] == 'airesponsetofollow':
-                logging.debug("Getting airesponse")
-                l = receive_length(self.client_socket)
-                response = receive_exact_bytes(self.client_socket, l)
-                response = pickle.loads(response)
-                lines = " ".join(choice.message.content for choice in response.choices)
+            if json_data['cmd'] == 'airesponse':
+                logging.debug("Got airesponse")
+                if 'choices' in data:
+                    lines = " ".join(choice['content'] for choice in data['choices'])
+                else:
+                    lines = data['content']
 
                 if self.no_markdown:
                     print(lines)
@@ -135,20 +170,63 @@ class Client:
                     self.response_count += 1
                     #color = "gray" if self.response_count % 2 == 0 else "white"
                     color="bright_white"
+                    from rich.markdown import Markdown
                     md = Markdown(lines)
-                    console.print(md, style=color)
+                    get_console().print(md, style=color)
 
-                if self.save_responses:
-                    response_filename = f"{self.config['settings']['dpath']}/responses-{self.sid}"
-                    with open(response_filename, 'a') as f:
-                        f.write(lines)
+                self.save_response_text(lines, filename, save)
 
-                if save:
-                    with open(filename, 'w') as f:
-                        f.write(lines)
+            elif json_data['cmd'] == 'airesponsestream':
+                logging.debug("Streaming airesponse")
+                lines, end_data = self.render_stream()
+                if end_data['status'] == 'error':
+                    return end_data
+
+                self.save_response_text(lines, filename, save)
 
             return json_data
 
+    def render_stream(self):
+        """Print streamed chunks as they arrive, return the full text and the closing frame."""
+        parts = []
+
+        def next_frame():
+            return parse_response(self.request_stream.recv_frame())
+
+        if self.no_markdown:
+            while (frame := next_frame())['cmd'] == 'airesponsechunk':
+                parts.append(frame['data'])
+                print(frame['data'], end='', flush=True)
+            print()
+            return "".join(parts), frame
+
+        from rich.live import Live
+        from rich.markdown import Markdown
+
+        self.response_count += 1
+        color = "bright_white"
+        refresh_interval = 0.1
+        last_refresh = 0
+        with Live(Markdown("", style=color), console=get_console(), refresh_per_second=1 / refresh_interval, vertical_overflow="visible") as live:
+            while (frame := next_frame())['cmd'] == 'airesponsechunk':
+                parts.append(frame['data'])
+                # Re-parsing the markdown is O(text), so don't do it on every token
+                if time.monotonic() - last_refresh >= refresh_interval:
+                    live.update(Markdown("".join(parts), style=color))
+                    last_refresh = time.monotonic()
+            live.update(Markdown("".join(parts), style=color))
+        return "".join(parts), frame
+
+    def save_response_text(self, lines, filename=None, save=False):
+        if self.save_responses:
+            response_filename = f"{self.config['settings']['dpath']}/responses-{self.sid}"
+            with open(response_filename, 'a') as f:
+                f.write(lines)
+
+        if save:
+            with open(filename, 'w') as f:
+                f.write(lines)
+
     def load_systems(self):
         """Load predefined systems from systems.json."""
         script_dir = os.path.dirname(os.path.abspath(__file__))  # Get script's directory
@@ -199,7 +277,7 @@ class Client:
 
     def use_s_query(self, sid, data):
         self.sid = sid
-        req = create_request(self.sid, 'use-s-query', data, oneshot=self.oneshot)
+        req = create_request(self.sid, 'use-s-query', data, oneshot=self.oneshot, stream=self.stream, cache=self.cache)
         json_data = self.send_command(req)
 
         if self.handle_response(json_data):
@@ -220,8 +298,17 @@ class Client:
         if self.handle_response(json_data):
             sys.exit(1)
 
-    def list_s(self):
-        req = create_request(self.sid, 'list-s')
+    def list_s(self, filter=None, offset=0, limit=None):
+        req = create_request(self.sid, 'list-s', {'filter': filter, 'offset': offset, 'limit': limit})
+        json_data = self.send_command(req)
+
+        if self.handle_response(json_data):
+            sys.exit(1)
+
+        print(json_data['data'])
+
+    def rebuild_catalog(self):
+        req = create_request(self.sid, 'rebuild-catalog')
         json_data = self.send_command(req)
 
         if self.handle_response(json_data):
@@ -252,7 +339,7 @@ class Client:
 
     def use_sys(self, system, query):
         system_content = self.get_system(system)
-        req = create_request(self.sid, 'use-sys', query, system=system_content, oneshot=self.oneshot)
+        req = create_request(self.sid, 'use-sys', query, system=system_content, oneshot=self.oneshot, stream=self.stream, cache=self.cache)
         json_data = self.send_command(req)
 
         if self.handle_response(json_data):
@@ -267,6 +354,103 @@ class Client:
 
         print(json_data['data'])
 
+    def set_context(self, policy=None, budget=None, pin_turns=None):
+        req = create_request(self.sid, 'context-policy', {'policy': policy, 'budget': budget, 'pin_turns': pin_turns})
+        json_data = self.send_command(req)
+
+        if self.handle_response(json_data):
+            sys.exit(1)
+
+    def batch(self, in_path, out_path, concurrency=None):
+        """
+        Run the prompts of a JSONL file through the server, one JSON object per line with
+        'prompt' (or 'body') and optional 'sid', 'system', 'model' and 'oneshot'.  Results are
+        appended to out_path as they complete, a rerun skips the lines that succeeded already.
+        """
+        items = []
+        ids = {}  # Input lines in the backlog format carry a request_id, kept in the results
+        with open(in_path, "r") as f:
+            for index, line in enumerate(f):
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                item = {'index': index, 'prompt': entry.get('prompt', entry.get('body'))}
+                for key in ('sid', 'system', 'model', 'oneshot'):
+                    if entry.get(key) is not None:
+                        item[key] = entry[key]
+                items.append(item)
+                if entry.get('request_id') is not None:
+                    ids[index] = entry['request_id']
+
+        done = set()
+        if os.path.exists(out_path):
+            with open(out_path, "r") as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Torn line of an interrupted run
+                    if result.get('status') == 'success':
+                        done.add(result['index'])
+
+        pending = [item for item in items if item['index'] not in done]
+        if not pending:
+            print(f"All {len(items)} prompts of {in_path} are done")
+            return
+        if done:
+            print(f"Skipping {len(items) - len(pending)} prompts done already", file=sys.stderr)
+
+        req = create_request(self.sid, 'batch', {'items': pending, 'concurrency': concurrency})
+        with self.open_request(req) as request_stream, open(out_path, "a") as out:
+            completed = 0
+            while True:
+                json_data = parse_response(request_stream.recv_frame())
+                if self.handle_response(json_data):
+                    sys.exit(1)
+                if json_data['cmd'] == 'batchend':
+                    break
+
+                result = json_data['data']
+                if result['index'] in ids:
+                    result['request_id'] = ids[result['index']]
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+                completed += 1
+                print(f"[{completed}/{len(pending)}] {result['index']} {result['status']}", file=sys.stderr)
+
+        print(f"{json_data['data']['success']} succeeded, {json_data['data']['error']} failed, results in {out_path}")
+
+    def stats(self):
+        req = create_request(self.sid, 'stats')
+        json_data = self.send_command(req)
+
+        if self.handle_response(json_data):
+            sys.exit(1)
+
+        print(json.dumps(json_data['data'], indent=2))
+
+    def profile(self, action, mode=None, requests=None, seconds=None, memory=False):
+        """Start, stop or show a profiling run of the server, its files are written to the server's dpath/profiles."""
+        req = create_request(self.sid, 'profile', {'action': action, 'mode': mode, 'requests': requests, 'seconds': seconds, 'memory': memory})
+        json_data = self.send_command(req)
+
+        if self.handle_response(json_data):
+            sys.exit(1)
+
+        print(json.dumps(json_data['data'], indent=2))
+
+    def trace(self, out_path, clear=False):
+        """Write the server's buffered request spans to out_path as Chrome trace JSON."""
+        req = create_request(self.sid, 'trace', {'clear': clear})
+        json_data = self.send_command(req)
+
+        if self.handle_response(json_data):
+            sys.exit(1)
+
+        with open(out_path, 'w') as f:
+            json.dump(json_data['data'], f)
+        print(f"{len(json_data['data']['traceEvents'])} trace events written to {out_path}, open in ui.perfetto.dev or chrome://tracing")
+
     def use_model(self, model):
         req = create_request(self.sid, 'use-model', model)
         json_data = self.send_command(req)
@@ -288,6 +472,8 @@ class Client:
 
     def go_interactive(self):
         """Interactive client mode for sending messages to the server."""
+        import readline
+        from history import save_history
         try:
             while True:
                 input_text = input("vern> ").strip()
@@ -414,21 +600,25 @@ if __name__ == "__main__":
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    console = Console()
-    #init(autoreset=True)
-    init()
-
     sid = args.use_s[0] if args.use_s else None
-    client = Client(sid=sid, no_markdown=args.no_markdown, save_responses=args.save_responses)
+    client = Client(sid=sid, no_markdown=args.no_markdown, save_responses=args.save_responses, stream=True if args.stream else None)
 
     if args.oneshot:
         client.oneshot=True
 
+    if args.no_cache:
+        client.cache = 'bypass'
+    elif args.refresh_cache:
+        client.cache = 'refresh'
+
     if args.rm_s:
         client.rm_s(args.rm_s[0])
         sys.exit(0)
     elif args.list_s:
-        client.list_s()
+        client.list_s(args.filter, args.offset, args.limit)
+        sys.exit(0)
+    elif args.rebuild_catalog:
+        client.rebuild_catalog()
         sys.exit(0)
     elif args.list_sys:
         client.list_sys()
@@ -436,6 +626,21 @@ if __name__ == "__main__":
     elif args.list_m:
         client.list_models()
         sys.exit(0)
+    elif args.batch:
+        client.batch(args.batch, args.out or f"{os.path.splitext(args.batch)[0]}.out.jsonl", args.concurrency)
+        sys.exit(0)
+    elif args.stats:
+        client.stats()
+        sys.exit(0)
+    elif args.profile:
+        if args.profile in ('stop', 'status'):
+            client.profile(args.profile)
+        else:
+            client.profile('start', args.profile, args.profile_requests, args.profile_seconds, args.profile_memory)
+        sys.exit(0)
+    elif args.trace:
+        client.trace(args.trace, clear=args.trace_clear)
+        sys.exit(0)
     elif args.new_s:
         system = " ".join(args.system) if args.system else None
         if args.use_sys:
@@ -455,6 +660,9 @@ if __name__ == "__main__":
     elif args.reset:
         client.do_reset()
         sys.exit(0)
+    elif args.context_policy or args.context_budget or args.pin_turns:
+        client.set_context(args.context_policy, args.context_budget, args.pin_turns)
+        sys.exit(0)
     elif args.interactive:
         client.load_history()
         client.go_interactive()
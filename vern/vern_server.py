@@ -1,13 +1,12 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import atexit
-import json
+import copy
 import logging
+import openai
 import os
-import pickle
-import random
-import re
 import select
 import socket
 import sys
@@ -15,21 +14,45 @@ import shutil
 import tempfile
 import threading
 import time
-import yaml
+import uuid
 
+from concurrent.futures import ThreadPoolExecutor, wait
+from connection import MuxChannel, recv_mux_frame, recv_mux_frame_async
+from context_window import POLICIES
 from daemonize import Daemonize
 from functools import partial
-from protocol import create_response, recv_json
+from metrics import metrics, serve_prometheus
+from tracing import tracer
+from persistence import flusher
+from profiling import Profiler
+from protocol import DEFAULT_MAX_FRAME_SIZE, FrameTooLargeError, create_response, parse_request, recv_request, recv_request_async
+from session_cache import SessionCache
+from session_catalog import SessionCatalog
 from session_context import SessionContext
-from ai_handler import AIHandler
-from utils import find_available_port, write_server_info_to_file, load_config
+from ai_handler import AIHandler, compact_usage
+from utils import write_server_info_to_file, load_config, unix_socket_address, unix_socket_name
+
+# Commands run_command knows, any other cmd is counted in the metrics as 'invalid' so clients
+# can't create labels at will
+COMMANDS = {'archive-conversation', 'batch', 'context-policy', 'exit', 'init-ppid-session', 'list-m', 'list-s', 'new-s',
+            'profile', 'query', 'rebuild-catalog', 'reset', 'rm-s', 'stats', 'system', 'trace', 'use-model',
+            'use-s-query', 'use-s-system', 'use-sys'}
+
+# Commands after which the session's catalog entry is refreshed
+CATALOG_COMMANDS = {'new-s', 'query', 'system', 'use-s-query', 'use-s-system', 'use-sys', 'use-model', 'reset', 'archive-conversation'}
+
+# Seconds a handler thread waits for the event loop to write one frame of a multiplexed response
+MUX_SEND_TIMEOUT = 60
 
 
 class CommandListener():
 
-    def __init__(self, config):
+    def __init__(self, config, startup=None):
 
         self.config = config
+        # Monotonic times of the start-up phases, from main() to accepting connections and
+        # the tokenizers being loaded, see startup_report
+        self.startup = startup if startup is not None else {'start': time.monotonic()}
         logging.debug(self.config)
 
         self.running = False
@@ -37,15 +60,79 @@ class CommandListener():
 
         logging.info(f"Using model {config['settings']['model']}")
 
-        self.session_contexts = {}
+        # Idle sessions past either limit are saved and dropped from memory, and loaded
+        # again from dpath when a request needs them
+        self.session_contexts = SessionCache(max_sessions=self.config['settings'].get('session_cache_size', 256),
+                                             max_bytes=self.config['settings'].get('session_cache_bytes', 64 * 1024 * 1024))
         self.sessions = {}
-        self.supported_models = ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo", "gpt-4o"]
+
+        # list-s is answered from dpath/catalog.json, rebuilt from the session directories
+        # when it is missing
+        self.catalog = SessionCatalog(self.config['settings']['dpath'])
         os.makedirs(self.config['settings']['dpath'], exist_ok=True)
 
         self.temp_dir = tempfile.mkdtemp(prefix="vern-", dir="/var/tmp/")
         logging.info(f"Using temporary directory: {self.temp_dir}")
 
+        # 'threaded' starts a thread per connection, 'asyncio' accepts and parses requests on an
+        # event loop and runs the commands on a bounded pool of handler threads
+        self.server_mode = self.config['network'].get('server_mode', 'threaded')
+        self.executor = ThreadPoolExecutor(max_workers=self.config['network'].get('max_workers', 8), thread_name_prefix='vern-handler')
+        self.loop = None
+        self.stop_event = None
+        self.mux_sockets = set()
+
+        # Requests announcing a larger payload are rejected before it is read
+        self.max_frame_size = self.config['network'].get('max_frame_size', DEFAULT_MAX_FRAME_SIZE)
+
+        # Listen on TCP, a unix domain socket (path relative to dpath, or '@name' for the
+        # Linux abstract namespace), or both
+        self.tcp_enabled = self.config['network'].get('tcp', True)
+        self.unix_address = None
+        if self.config['network'].get('unix_socket'):
+            self.unix_address = unix_socket_address(self.config['network']['unix_socket'], self.config['settings']['dpath'])
+
+        # Sessions with write_behind, and the catalog, are saved by a background flusher every
+        # flush_interval seconds, or once flush_dirty_bytes of new content is waiting
+        flusher.configure(interval=self.config['settings'].get('flush_interval'),
+                          dirty_bytes=self.config['settings'].get('flush_dirty_bytes'))
+
+        if not self.catalog.load():
+            self.catalog.rebuild(self.load_catalog_session)
+
+        # Gauges read when the metrics are, counters and histograms are updated as requests go
+        self.active_requests = 0
+        self.active_lock = threading.Lock()
+        self.metrics_server = None
+        metrics.gauge('active_requests', lambda: self.active_requests)
+        metrics.gauge('threads', threading.active_count)
+        metrics.gauge('session_cache_sessions', lambda: len(self.session_contexts))
+        metrics.gauge('session_cache_bytes', lambda: self.session_contexts.stats()['bytes'])
+
+        # Spans of the phases of each request in a ring buffer, dumped by the 'trace' command;
+        # requests slower than slow_request_ms are logged with their phases
+        tracing_config = self.config.get('tracing', {})
+        tracer.configure(enabled=tracing_config.get('enabled', True), capacity=tracing_config.get('capacity', 10000),
+                         slow_ms=tracing_config.get('slow_request_ms', 0))
+
+        # Profiling runs started by the 'profile' command write their files to dpath/profiles
+        self.profiler = Profiler(os.path.join(self.config['settings']['dpath'], 'profiles'))
+
         atexit.register(self.cleanup)
+        self.startup['listener'] = time.monotonic()
+
+    def startup_report(self):
+        """Milliseconds from start to the end of each start-up phase."""
+        report = {name: round(1000 * (t - self.startup['start']), 1) for name, t in self.startup.items() if name != 'start'}
+        if self.ai_handler.encoders.ready_at is not None:
+            report['encoders_ready'] = round(1000 * (self.ai_handler.encoders.ready_at - self.startup['start']), 1)
+        return report
+
+    def accept_ready(self):
+        """The listeners are up: report the start-up time, then load tokenizers and models in the background."""
+        self.startup['accept_ready'] = time.monotonic()
+        logging.info("Accepting connections, start-up (ms): " + ", ".join(f"{name} {ms}" for name, ms in self.startup_report().items()))
+        self.ai_handler.start_background()
 
     def cleanup(self):
         """Remove the temporary directory on server shutdown."""
@@ -68,14 +155,10 @@ class CommandListener():
     def send_response(self, client_socket, response):
         """Send a JSON response to the client."""
         response_bytes = response.encode()
-        client_socket.sendall(len(response_bytes).to_bytes(4, byteorder='big'))
-        client_socket.sendall(response_bytes)
-
-    def send_obj(self, client_socket, obj):
-        """Send a serialized object to the client."""
-        obj_bytes = pickle.dumps(obj)
-        client_socket.sendall(len(obj_bytes).to_bytes(4, byteorder='big'))
-        client_socket.sendall(obj_bytes)
+        # One write per frame so small streamed chunks aren't held back by Nagle
+        with tracer.span('send', bytes=len(response_bytes)):
+            client_socket.sendall(len(response_bytes).to_bytes(4, byteorder='big') + response_bytes)
+        metrics.inc('bytes_out_total', 4 + len(response_bytes))
 
     def is_server_running(self):
         return self.server_thread.is_alive()
@@ -86,37 +169,186 @@ class CommandListener():
     def does_session_dir_exist(self, sid):
         return SessionContext.session_exists(self.config['settings']['dpath'], sid)
 
-    def do_ai_query(self, client_socket, session_context, data, oneshot=False):
+    def do_ai_query(self, client_socket, session_context, data, oneshot=False, stream=False, cache=None):
 
         if not oneshot:
-            session_context.add_user_content(data)
-            d_airesponse = self.ai_handler.get_airesponse(session_context)  # Get AI response
+            with tracer.span('save_message'):
+                session_context.add_user_content(data)
+            d_airesponse = self.ai_handler.get_airesponse(session_context, stream=stream, cache=cache)  # Get AI response
         else:
-            d_airesponse = self.ai_handler.get_airesponse(session_context, oneshot_user_content=data)  # Get AI response
+            d_airesponse = self.ai_handler.get_airesponse(session_context, oneshot_user_content=data, stream=stream, cache=cache)  # Get AI response
 
         if d_airesponse['status'] == 'error':
             logging.error(f"AI Error: {d_airesponse['message']}")
             self.send_response(client_socket, create_response(session_context.sid, 'error', d_airesponse['code'], d_airesponse['message']))
             return
 
-        ai_text_response = d_airesponse['data'].choices[0].message.content
+        if stream and d_airesponse.get('cached'):
+            # A cached response is streamed as a single chunk
+            cached = d_airesponse['data']
+            self.send_response(client_socket, create_response(session_context.sid, 'success', 'airesponsestream', 'not_applicable'))
+            self.send_response(client_socket, create_response(session_context.sid, 'success', 'airesponsechunk', cached['content']))
+            ai_text_response = cached['content']
+            end_data = {'finish_reason': cached['finish_reason'], 'model': cached['model'], 'usage': cached['usage']}
+        elif stream:
+            with tracer.span('stream'):
+                streamed = self.stream_airesponse(client_socket, session_context, d_airesponse['data'])
+            if streamed is None:
+                return
+            ai_text_response, end_data = streamed
+            if d_airesponse.get('cache_key') is not None:
+                self.ai_handler.response_cache.put(d_airesponse['cache_key'], {'content': ai_text_response, **end_data})
+        else:
+            ai_text_response = d_airesponse['data']['content']
 
         # Save response in session history
-        if oneshot:
-            session_context.add_oneshot_content(ai_text_response)
+        with tracer.span('save_message'):
+            if oneshot:
+                session_context.add_oneshot_content(ai_text_response)
+            else:
+                session_context.add_assistant_content(ai_text_response)
+
+        # Sent after saving, so the client's next request sees this response in the history
+        if stream:
+            self.send_response(client_socket, create_response(session_context.sid, 'success', 'airesponseend', end_data))
         else:
-            session_context.add_assistant_content(ai_text_response)
+            self.send_response(client_socket, create_response(session_context.sid, 'success', 'airesponse', d_airesponse['data']))
+
+    def stream_airesponse(self, client_socket, session_context, completion_stream):
+        """Forward completion deltas to the client as they arrive, return the assembled text and the 'airesponseend' data."""
+        self.send_response(client_socket, create_response(session_context.sid, 'success', 'airesponsestream', 'not_applicable'))
+
+        parts = []
+        finish_reason = None
+        model = None
+        usage = None
+        try:
+            for chunk in completion_stream:
+                model = chunk.model
+                if chunk.usage:
+                    usage = compact_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    parts.append(choice.delta.content)
+                    self.send_response(client_socket, create_response(session_context.sid, 'success', 'airesponsechunk', choice.delta.content))
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+        except openai.OpenAIError as e:
+            logging.error(f"❌ OpenAI API stream failed: {e}")
+            self.send_response(client_socket, create_response(session_context.sid, 'error', 'api_error', str(e)))
+            return None
+
+        self.ai_handler.record_usage(session_context.config['settings']['model'], usage)
+        # Same fields as an 'airesponse' frame, minus the content the client already has
+        return "".join(parts), {'finish_reason': finish_reason, 'model': model, 'usage': usage}
+
+    def run_batch(self, client_socket, json_data):
+        """
+        Run a batch of prompts, items sharing a sid one after another in input order, the rest
+        concurrently.  Each result is sent as a 'batchresult' frame as soon as it is done, with
+        the item's index, followed by one 'batchend' frame.
+        """
+        items = json_data['data']['items']
+        max_concurrency = self.config['network'].get('batch_max_concurrency', 32)
+        concurrency = max(1, min(json_data['data'].get('concurrency') or 4, max_concurrency))
+
+        # Items without a sid are independent, each one is a group of its own
+        groups = {}
+        for item in items:
+            groups.setdefault(item.get('sid') or f"\0{item['index']}", []).append(item)
+
+        send_lock = threading.Lock()
+        cancelled = threading.Event()
+        counts = {'success': 0, 'error': 0}
+
+        def run_group(group):
+            for item in group:
+                if cancelled.is_set():
+                    return
+                result = self.run_batch_item(item)
+                with send_lock:
+                    counts[result['status']] += 1
+                    try:
+                        self.send_response(client_socket, create_response(item.get('sid') or -1, 'success', 'batchresult', result))
+                    except OSError:
+                        cancelled.set()  # Client went away
+
+        logging.info(f"Running batch of {len(items)} prompts in {len(groups)} groups, {concurrency} at a time")
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='vern-batch') as executor:
+            for future in [executor.submit(run_group, group) for group in groups.values()]:
+                future.result()
+
+        if not cancelled.is_set():
+            self.send_response(client_socket, create_response(json_data['sid'], 'success', 'batchend', counts))
+
+    def run_batch_item(self, item):
+        """Query the AI for one batch item, returns its result."""
+        result = {'index': item['index']}
+        sid = item.get('sid')
+        session_context = None
+        try:
+            oneshot = item.get('oneshot', False) or sid is None
+            with self.session_contexts.pinned(sid):
+                session_context = self.batch_session(item)
+                if not oneshot:
+                    session_context.add_user_content(item['prompt'])
+                    d_airesponse = self.ai_handler.get_airesponse(session_context)
+                else:
+                    d_airesponse = self.ai_handler.get_airesponse(session_context, oneshot_user_content=item['prompt'])
+
+                if d_airesponse['status'] == 'error':
+                    result.update(status='error', code=d_airesponse['code'], message=d_airesponse['message'])
+                    return result
 
-        self.send_response(client_socket, create_response(session_context.sid, 'success', 'airesponsetofollow', 'not_applicable'))
-        self.send_obj(client_socket, d_airesponse['data'])
+                if oneshot:
+                    session_context.add_oneshot_content(d_airesponse['data']['content'])
+                else:
+                    session_context.add_assistant_content(d_airesponse['data']['content'])
+                if sid is not None:
+                    self.update_catalog({'sid': sid, 'cmd': 'query'})
+
+            result.update(status='success', **d_airesponse['data'])
+        except Exception as e:
+            logging.error(f"Batch item {item['index']} failed: {e}")
+            result.update(status='error', code='server_error', message=str(e))
+        finally:
+            if sid is None and session_context is not None:
+                shutil.rmtree(session_context.session_dir, ignore_errors=True)
+        return result
+
+    def batch_session(self, item):
+        """
+        Session for a batch item: its sid's, created if needed, or a throwaway one in the temp
+        dir that run_batch_item removes once the item is done.
+        """
+        sid = item.get('sid')
+        if sid is None:
+            config = copy.deepcopy(self.config)
+            config['settings']['dpath'] = os.path.join(self.temp_dir, 'batch')
+            config['settings']['write_behind'] = False  # The temp dir is gone before the exit flush
+            # A sid of its own, an existing directory would be loaded with another item's system and history
+            session_context = SessionContext(f"batch-{uuid.uuid4().hex}", config, system_content=item.get('system'))
+        elif (session_context := self.session_contexts.get(sid)) is None:
+            if self.does_session_dir_exist(sid):
+                session_context = SessionContext(sid, self.config)
+            else:
+                session_context = SessionContext(sid, self.config, system_content=item.get('system'))
+            session_context = self.session_contexts.add(sid, session_context)
+
+        if item.get('model') and item['model'] != session_context.config['settings']['model']:
+            session_context.set_model(item['model'])
+        return session_context
 
     def find_session_for_client(self, client_socket, sid):
-        if self.is_session_active(sid):
-            session_context = self.session_contexts[sid]
+        if (session_context := self.session_contexts.get(sid)) is not None:
+            pass
 
         elif self.does_session_dir_exist(sid):
-            session_context = SessionContext(sid)
-            self.session_contexts[sid] = session_context
+            with tracer.span('load_session'), self.profiler.measure_load(sid):
+                session_context = SessionContext(sid, self.config)
+            session_context = self.session_contexts.add(sid, session_context)
 
         else:
             logging.error(f"Session session-{sid} does not exist")
@@ -125,226 +357,512 @@ class CommandListener():
         return session_context
 
     def handle_client(self, client_socket):
-        """Handles client requests and executes the appropriate commands."""
+        """Handles a single client connection: reads one request and executes it."""
         with client_socket:
+            start = time.perf_counter_ns()
             try:
-                json_data = recv_json(client_socket)
-
-                logging.debug(f"Received: {json_data}")
-
-                if json_data['cmd'] == 'init-ppid-session':
-                    """Initialize the session and save it"""
-
-                    # check if this session has been initialized
-                    if json_data['sid'] in self.session_contexts:
-                        logging.info(f'Session {json_data['sid']} exists')
-                        session_context = self.session_contexts[json_data['sid']]
-                        self.send_response(client_socket, create_response(json_data['sid'], 'success', 'none', 'none'))
-                    else:
-                        session_context = SessionContext(json_data['sid'], self.config, ppid=True)
-                        self.session_contexts[json_data['sid']] = session_context
-                        self.send_response(client_socket, create_response(json_data['sid'], 'success', 'none', 'none'))
-                        logging.info(f'Session {json_data['sid']} initialized')
-
-                elif json_data['cmd'] == 'exit':
-                    self.send_response(client_socket, create_response(json_data['sid'], 'success', 'none', 'none'))
-                    logging.info(f'Exiting')
-                    self.running = False
-
-                elif json_data['cmd'] == 'query':
-                    """Handle AI queries and responses"""
-                    logging.debug(f"Processing query: {json_data['data']}")
-
-                    if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
-                        return
+                json_data = recv_request(client_socket, self.max_frame_size)
+            except FrameTooLargeError as e:
+                tracer.add(*self.received(start))
+                logging.error(f"Rejected request: {e}")
+                self.send_response(client_socket, create_response(-1, 'error', 'frame_too_large', str(e)))
+                return
+            except Exception as e:
+                tracer.add(*self.received(start))
+                logging.error(f"Error receiving request: {e}")
+                self.send_response(client_socket, create_response(-1, 'error', 'server_error', str(e)))
+                return
+            received = self.received(start)
 
-                    self.do_ai_query(client_socket, session_context, json_data['data'], oneshot=json_data['oneshot'])
+            if json_data and json_data.get('cmd') == 'mux':
+                self.serve_mux(client_socket, json_data)
+                return
 
-                elif json_data['cmd'] == 'new-s':
-                    """Handle new session creation"""
+            self.handle_request(client_socket, json_data, received)
 
-                    logging.debug(f"New session session-{json_data['sid']} requested")
+    def received(self, start):
+        """The recv_request span of a request read since start, recorded by handle_request once it is tagged."""
+        return 'recv_request', start, time.perf_counter_ns() - start, threading.current_thread()
 
-                    if self.is_session_active(json_data['sid']) or self.does_session_dir_exist(json_data['sid']):
-                        logging.error(f"Session session-{json_data['sid']} already exists")
-                        self.send_nack(json_data['sid'], client_socket, f"Session session-{json_data['sid']} already exists")
-                    else:
-                        session_context = SessionContext(json_data['sid'], system_content=json_data['system'])
-                        self.session_contexts[json_data['sid']] = session_context
-                        logging.info(f"Startet new session @ {session_context.session_dir}")
+    def serve_mux(self, client_socket, json_data):
+        """Serve pipelined requests on one connection until the client closes it."""
+        self.send_ack(json_data['sid'], client_socket)
+        self.mux_sockets.add(client_socket)
 
-                        self.send_ack(json_data['sid'], client_socket)
+        send_lock = threading.Lock()
 
-                elif json_data['cmd'] == 'system':
+        def send_frame(data):
+            with send_lock:
+                client_socket.sendall(data)
 
-                    logging.debug(f"New system for session-{json_data['sid']} requested")
+        pending = []
+        try:
+            while self.running:
+                try:
+                    rid, payload = recv_mux_frame(client_socket, self.max_frame_size)
+                except FrameTooLargeError as e:
+                    logging.error(f"Rejected request: {e}")
+                    self.send_response(MuxChannel(send_frame, e.rid), create_response(-1, 'error', 'frame_too_large', str(e)))
+                    break
+                except (RuntimeError, OSError):
+                    break
+                metrics.inc('bytes_in_total', 8 + len(payload))
+                try:
+                    json_data = parse_request(payload)
+                except ValueError as e:
+                    # The framing is intact, answer this request and keep serving the others
+                    logging.error(f"Malformed request: {e}")
+                    self.send_response(MuxChannel(send_frame, rid), create_response(-1, 'error', 'invalid_request', str(e)))
+                    continue
+                pending = [f for f in pending if not f.done()]
+                pending.append(self.executor.submit(self.handle_request, MuxChannel(send_frame, rid), json_data))
+            wait(pending)
+        finally:
+            self.mux_sockets.discard(client_socket)
+
+    def handle_request(self, client_socket, json_data, received=None):
+        """Executes the command in json_data and sends the response(s) to client_socket, received is its recv_request span."""
+        cmd = json_data.get('cmd') if json_data else None
+        label = cmd if isinstance(cmd, str) and cmd in COMMANDS else 'invalid'
+        with self.active_lock:
+            self.active_requests += 1
+        sid = json_data.get('sid') if json_data else None
+        try:
+            # The request's session must not be evicted while the command is working on it
+            with tracer.request(sid, cmd), metrics.timer('command_seconds', cmd=label), self.session_contexts.pinned(sid):
+                if received is not None:
+                    tracer.add(*received)
+                self.run_command(client_socket, json_data)
+                if json_data:
+                    self.update_catalog(json_data)
+        finally:
+            with self.active_lock:
+                self.active_requests -= 1
+            metrics.inc('commands_total', cmd=label)
+            self.profiler.request_done(cmd)
+
+    def update_catalog(self, json_data):
+        """Bring the catalog entry of the request's session up to date after a command changed it."""
+        sid = json_data.get('sid')
+        if not isinstance(sid, str) or sid.startswith('ppid'):
+            return
+        try:
+            if json_data['cmd'] == 'rm-s':
+                self.catalog.remove(sid)
+            elif json_data['cmd'] in CATALOG_COMMANDS and (session_context := self.session_contexts.peek(sid)) is not None:
+                self.catalog.update(session_context)
+        except Exception as e:
+            logging.error(f"Error updating the session catalog for {sid}: {e}")
 
-                    if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
-                        return
+    def load_catalog_session(self, sid):
+        """Resident session for sid, or a read-only load of it that stays out of the cache."""
+        if (session_context := self.session_contexts.peek(sid)) is not None:
+            return session_context
+        return SessionContext(sid, self.config)
 
-                    session_context.set_system_content(json_data['system'])
+    def run_command(self, client_socket, json_data):
+        try:
+            logging.debug(f"Received: {json_data}")
 
+            if json_data['cmd'] == 'init-ppid-session':
+                """Initialize the session and save it"""
 
-                elif json_data['cmd'] == 'use-s-query':
-                    """Handle using an existing session query"""
+                # check if this session has been initialized
+                if self.session_contexts.get(json_data['sid']) is not None:
+                    logging.info(f'Session {json_data['sid']} exists')
+                    self.send_response(client_socket, create_response(json_data['sid'], 'success', 'none', 'none'))
+                else:
+                    self.session_contexts.add(json_data['sid'], SessionContext(json_data['sid'], self.config, ppid=True))
+                    self.send_response(client_socket, create_response(json_data['sid'], 'success', 'none', 'none'))
+                    logging.info(f'Session {json_data['sid']} initialized')
 
-                    if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
-                        return
+            elif json_data['cmd'] == 'exit':
+                self.send_response(client_socket, create_response(json_data['sid'], 'success', 'none', 'none'))
+                logging.info(f'Exiting')
+                self.stop()
 
-                    self.do_ai_query(client_socket, session_context, json_data['data'], oneshot=json_data['oneshot'])
+            elif json_data['cmd'] == 'query':
+                """Handle AI queries and responses"""
+                logging.debug(f"Processing query: {json_data['data']}")
 
-                elif json_data['cmd'] == 'use-s-system':
-                    """Handle using an existing session system"""
+                if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
+                    return
 
-                    if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
-                        return
+                self.do_ai_query(client_socket, session_context, json_data['data'], oneshot=json_data['oneshot'], stream=json_data.get('stream', False), cache=json_data.get('cache'))
 
-                    session_context.set_system_content(json_data['system'])
-                    self.send_ack(json_data['sid'], client_socket)
+            elif json_data['cmd'] == 'new-s':
+                """Handle new session creation"""
 
-                elif json_data['cmd'] == 'use-sys':
+                logging.debug(f"New session session-{json_data['sid']} requested")
 
-                    if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
-                        return
+                if self.is_session_active(json_data['sid']) or self.does_session_dir_exist(json_data['sid']):
+                    logging.error(f"Session session-{json_data['sid']} already exists")
+                    self.send_nack(json_data['sid'], client_socket, f"Session session-{json_data['sid']} already exists")
+                else:
+                    session_context = SessionContext(json_data['sid'], self.config, system_content=json_data['system'])
+                    self.session_contexts.add(json_data['sid'], session_context)
+                    logging.info(f"Startet new session @ {session_context.session_dir}")
 
-                    session_context.set_system_content(json_data['system'])
-                    if json_data['data'] is not None:
-                        self.do_ai_query(client_socket, session_context, json_data['data'], oneshot=json_data['oneshot'])
                     self.send_ack(json_data['sid'], client_socket)
 
-                elif json_data['cmd'] == 'rm-s':
-                    """Moves a session to the temp dir's 'trash' instead of deleting it."""
-
-                    session_context = self.find_session_for_client(client_socket, json_data['sid'])
-                    if session_context is None:
-                        return
-                    session_context.remove_session(self.temp_dir, self.config['settings']['dpath'], json_data['sid'])
-                    if json_data['sid'] in self.session_contexts:
-                        del self.session_contexts[json_data['sid']]
-                    self.send_ack(json_data['sid'], client_socket)
+            elif json_data['cmd'] == 'system':
 
-                elif json_data['cmd'] == 'archive-conversation':
-                    """Moves a session to the temp dir's 'trash' instead of deleting it."""
+                logging.debug(f"New system for session-{json_data['sid']} requested")
 
-                    session_context = self.find_session_for_client(client_socket, json_data['sid'])
-                    if session_context is None:
-                        return
-                    session_context.archive_conversation()
-                    self.send_ack(json_data['sid'], client_socket)
+                if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
+                    return
 
-                elif json_data['cmd'] == 'list-s':
-                    """Lists all valid session directories in dpath, sorting numbers first, then alphabetically,
-                    and includes a truncated version of the system.json content (first 70 characters).
-                    """
-                    try:
-                        session_base = self.config['settings']['dpath']
-                        session_data = []
+                session_context.set_system_content(json_data['system'])
 
-                        for f in os.listdir(session_base):
-                            session_path = os.path.join(session_base, f)
-                            if os.path.isdir(session_path) and f.startswith("session-"):
-                                system_json = os.path.join(session_path, "system.json")
-                                conversation_json = os.path.join(session_path, "conversation.json")
 
-                                if os.path.isfile(system_json) and os.path.isfile(conversation_json):
-                                    sid = re.sub(r"^session-", "", f)  # Extract SID
+            elif json_data['cmd'] == 'use-s-query':
+                """Handle using an existing session query"""
 
-                                    # Read system.json content
-                                    try:
-                                        with open(system_json, 'r', encoding='utf-8') as sys_file:
-                                            system_content = sys_file.read()
-                                            system_content = json.loads(system_content).get("content", "").strip()
-                                            if len(system_content) > 70:
-                                                system_content = system_content[:70] + "..."
-                                    except Exception as read_error:
-                                        logging.error(f"Error reading system.json for session-{sid}: {read_error}")
-                                        system_content = "Error reading system.json."
+                if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
+                    return
 
-                                    session_data.append((sid, system_content))
+                self.do_ai_query(client_socket, session_context, json_data['data'], oneshot=json_data['oneshot'], stream=json_data.get('stream', False), cache=json_data.get('cache'))
 
-                        # ✅ Sort: Numbers first, then alphabetically
-                        def sort_key(item):
-                            name = item[0]
-                            return (not name.isdigit(), name if name.isdigit() else name.lower())  # Numbers first, then case-insensitive names
+            elif json_data['cmd'] == 'use-s-system':
+                """Handle using an existing session system"""
 
-                        session_data.sort(key=sort_key)
+                if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
+                    return
 
-                        if session_data:
-                            response_data = "\n".join(
-                                [f"session-{sid} {system_content}" for sid, system_content in session_data]
-                            )
-                        else:
-                            response_data = "No valid sessions found."
+                session_context.set_system_content(json_data['system'])
+                self.send_ack(json_data['sid'], client_socket)
 
-                        self.send_response(client_socket, create_response(-1, "success", "list-s", response_data))
+            elif json_data['cmd'] == 'use-sys':
 
-                    except Exception as e:
-                        logging.error(f"Error listing session directories: {e}")
-                        self.send_response(client_socket, create_response(-1, "error", "list-s", f"Error: {e}"))
+                if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
+                    return
 
+                session_context.set_system_content(json_data['system'])
+                if json_data['data'] is not None:
+                    self.do_ai_query(client_socket, session_context, json_data['data'], oneshot=json_data['oneshot'], stream=json_data.get('stream', False), cache=json_data.get('cache'))
+                self.send_ack(json_data['sid'], client_socket)
 
-                elif json_data['cmd'] == 'list-m':
+            elif json_data['cmd'] == 'rm-s':
+                """Moves a session to the temp dir's 'trash' instead of deleting it."""
 
-                    try:
-                        models = self.ai_handler.list_models()
-                        model_ids = [model.id for model in models.data]
-                        response_data = " ".join(model_ids)
-                        self.send_response(client_socket, create_response(-1, "success", "list-m", response_data))
+                session_context = self.find_session_for_client(client_socket, json_data['sid'])
+                if session_context is None:
+                    return
+                session_context.remove_session(self.temp_dir, self.config['settings']['dpath'], json_data['sid'])
+                self.session_contexts.pop(json_data['sid'])
+                self.send_ack(json_data['sid'], client_socket)
 
-                        logging.debug(model_ids)
+            elif json_data['cmd'] == 'archive-conversation':
+                """Moves a session to the temp dir's 'trash' instead of deleting it."""
 
+                session_context = self.find_session_for_client(client_socket, json_data['sid'])
+                if session_context is None:
+                    return
+                session_context.archive_conversation()
+                self.send_ack(json_data['sid'], client_socket)
 
-                    except Exception as e:
-                        self.send_response(client_socket, create_response(-1, "error", "list-m-failed", str(e)))
+            elif json_data['cmd'] == 'list-s':
+                """Lists sessions from the catalog, numbers first, then alphabetically, with a truncated
+                version of the system content (first 70 characters). data may hold a filter, offset and limit.
+                """
+                try:
+                    options = json_data['data'] if isinstance(json_data.get('data'), dict) else {}
+                    entries, total = self.catalog.list(options.get('filter'), options.get('offset', 0), options.get('limit'))
 
-                elif json_data['cmd'] == 'use-model':
-                    if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
-                        return
+                    if entries:
+                        response_data = "\n".join([f"session-{entry['sid']} {entry['system']}" for entry in entries])
+                    elif total:
+                        response_data = f"No sessions past offset {options.get('offset', 0)} of {total}."
+                    else:
+                        response_data = "No valid sessions found."
+
+                    self.send_response(client_socket, create_response(-1, "success", "list-s", response_data))
+
+                except Exception as e:
+                    logging.error(f"Error listing sessions: {e}")
+                    self.send_response(client_socket, create_response(-1, "error", "list-s", f"Error: {e}"))
+
+            elif json_data['cmd'] == 'rebuild-catalog':
+                count = self.catalog.rebuild(self.load_catalog_session)
+                self.send_response(client_socket, create_response(-1, "success", "rebuild-catalog", f"Catalog rebuilt with {count} sessions"))
+
+            elif json_data['cmd'] == 'list-m':
+
+                try:
+                    model_ids = self.ai_handler.list_models()
+                    response_data = " ".join(model_ids)
+                    self.send_response(client_socket, create_response(-1, "success", "list-m", response_data))
+
+                    logging.debug(model_ids)
+
+
+                except Exception as e:
+                    self.send_response(client_socket, create_response(-1, "error", "list-m-failed", str(e)))
+
+            elif json_data['cmd'] == 'use-model':
+                if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
+                    return
+
+                if not self.ai_handler.models.is_known(json_data['data']):
+                    self.send_response(client_socket, create_response(json_data['sid'], 'error', 'unknown_model',
+                                                                      f"Unknown model {json_data['data']}, see --list-m"))
+                    return
+
+                session_context.set_model(json_data['data'])
+                self.send_ack(json_data['sid'], client_socket)
+
+            elif json_data['cmd'] == 'context-policy':
+                if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
+                    return
+
+                options = json_data['data']
+                if options.get('policy') is not None and options['policy'] not in POLICIES:
+                    self.send_nack(json_data['sid'], client_socket, f"Unknown context policy '{options['policy']}', use one of {', '.join(POLICIES)}")
+                    return
+                session_context.set_context(options.get('policy'), options.get('budget'), options.get('pin_turns'))
+                self.send_ack(json_data['sid'], client_socket)
+
+            elif json_data['cmd'] == 'batch':
+                self.run_batch(client_socket, json_data)
+
+            elif json_data['cmd'] == 'stats':
+                stats = {'session_cache': self.session_contexts.stats(), 'inflight': self.ai_handler.inflight.stats(),
+                         'http': self.ai_handler.pool_stats.stats(), 'encoders': self.ai_handler.encoders.stats(),
+                         'models': self.ai_handler.models.stats(),
+                         'startup': self.startup_report(), 'metrics': metrics.snapshot()}
+                if self.ai_handler.rate_limiter is not None:
+                    stats['rate_limiter'] = self.ai_handler.rate_limiter.stats()
+                if self.ai_handler.response_cache is not None:
+                    stats['response_cache'] = self.ai_handler.response_cache.stats()
+                self.send_response(client_socket, create_response(-1, "success", "stats", stats))
+
+            elif json_data['cmd'] == 'profile':
+                options = json_data.get('data') or {}
+                try:
+                    if options.get('action') == 'start':
+                        result = self.profiler.start(options.get('mode', 'cprofile'), requests=options.get('requests'),
+                                                     seconds=options.get('seconds'), memory=options.get('memory', False))
+                    elif options.get('action') == 'stop':
+                        result = self.profiler.stop() or self.profiler.status()
+                    else:
+                        result = self.profiler.status()
+                except ValueError as e:
+                    self.send_response(client_socket, create_response(-1, "error", "invalid_profile", str(e)))
+                    return
+                self.send_response(client_socket, create_response(-1, "success", "profile", result))
 
-                    session_context.set_model(json_data['data'])
-                    self.send_ack(json_data['sid'], client_socket)
+            elif json_data['cmd'] == 'trace':
+                options = json_data.get('data') or {}
+                self.send_response(client_socket, create_response(-1, "success", "trace", tracer.chrome_trace(clear=options.get('clear', False))))
 
-                elif json_data['cmd'] == 'reset':
+            elif json_data['cmd'] == 'reset':
 
-                    if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
-                        return
+                if (session_context := self.find_session_for_client(client_socket, json_data['sid'])) is None:
+                    return
 
-                    session_context.reset()
-                    self.send_ack(json_data['sid'], client_socket)
+                session_context.reset()
+                self.send_ack(json_data['sid'], client_socket)
 
-                else:
-                    logging.error(f"Invalid command: {json_data['cmd']}")
-                    self.send_nack(json_data['sid'], client_socket, "Invalid command")
+            else:
+                logging.error(f"Invalid command: {json_data['cmd']}")
+                self.send_nack(json_data['sid'], client_socket, "Invalid command")
 
-            except Exception as e:
-                logging.error(f"Unhandled error: {e}")
-                self.send_response(client_socket, create_response(-1, 'error', 'server_error', str(e)))
-                import traceback
-                print(traceback.format_exc())
+        except Exception as e:
+            logging.error(f"Unhandled error: {e}")
+            self.send_response(client_socket, create_response(-1, 'error', 'server_error', str(e)))
+            import traceback
+            print(traceback.format_exc())
 
 
     def start(self):
         self.running = True
-        self.server_thread = threading.Thread(target=self.server_thread_func, daemon=False)
+        if self.server_mode == 'asyncio':
+            self.server_thread = threading.Thread(target=self.server_async_func, daemon=False)
+        else:
+            self.server_thread = threading.Thread(target=self.server_thread_func, daemon=False)
         self.server_thread.start()
-        write_server_info_to_file(self.config['network']['host'], self.config['network']['port'])
 
-    def server_thread_func(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+        # Prometheus text exposition of the metrics on a local port
+        metrics_config = self.config.get('metrics', {})
+        if metrics_config.get('prometheus_port'):
+            self.metrics_server = serve_prometheus(metrics, metrics_config.get('prometheus_host', '127.0.0.1'), metrics_config['prometheus_port'])
+
+        write_server_info_to_file(self.config['network']['host'],
+                                  self.config['network']['port'] if self.tcp_enabled else None,
+                                  self.config['network'].get('unix_socket') and unix_socket_name(self.unix_address))
+
+    def open_server_sockets(self):
+        """Bind the TCP and/or unix domain listeners enabled in the config."""
+        server_sockets = []
+
+        if self.tcp_enabled:
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             server_socket.bind((self.config['network']['host'], self.config['network']['port']))
             server_socket.listen()
+            server_sockets.append(server_socket)
+            logging.info(f"Vern server listening on {self.config['network']['host']}:{self.config['network']['port']} ({self.server_mode})")
+
+        if self.unix_address:
+            server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            abstract = self.unix_address.startswith('\0')
+            if not abstract and os.path.exists(self.unix_address):
+                os.unlink(self.unix_address)  # Stale socket from a previous run
+            server_socket.bind(self.unix_address)
+            if not abstract:
+                os.chmod(self.unix_address, 0o600)
+            server_socket.listen()
+            server_sockets.append(server_socket)
+            logging.info(f"Vern server listening on unix:{unix_socket_name(self.unix_address)} ({self.server_mode})")
+
+        self.accept_ready()
+        return server_sockets
 
-            logging.info(f"Vern server listening on {self.config['network']['host']}:{self.config['network']['port']}")
+    def close_server_sockets(self, server_sockets):
+        for server_socket in server_sockets:
+            server_socket.close()
+        if self.unix_address and not self.unix_address.startswith('\0'):
+            try:
+                os.unlink(self.unix_address)
+            except FileNotFoundError:
+                pass
+
+    def setup_client_socket(self, client_socket):
+        if client_socket.family in (socket.AF_INET, socket.AF_INET6):
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def server_thread_func(self):
+        server_sockets = self.open_server_sockets()
+        try:
             while self.running:
-                readable, _, _ = select.select([server_socket], [], [], 0.1)
+                readable, _, _ = select.select(server_sockets, [], [], 0.1)
                 for sock in readable:
-                    if sock == server_socket:
-                        client_socket, _ = server_socket.accept()
-                        threading.Thread(target=self.handle_client, args=(client_socket,), daemon=False).start()
+                    client_socket, _ = sock.accept()
+                    self.setup_client_socket(client_socket)
+                    threading.Thread(target=self.handle_client, args=(client_socket,), daemon=False).start()
+        finally:
+            self.close_server_sockets(server_sockets)
+
+        self.executor.shutdown(wait=False)
+
+    def server_async_func(self):
+        asyncio.run(self.serve_async())
+
+    async def serve_async(self):
+        """Accept connections and read requests on an event loop, run commands on the executor."""
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        if not self.running:
+            self.stop_event.set()
+
+        server_sockets = self.open_server_sockets()
+        try:
+            accept_tasks = []
+            for server_socket in server_sockets:
+                server_socket.setblocking(False)
+                accept_tasks.append(asyncio.create_task(self.accept_async(server_socket)))
+            await self.stop_event.wait()
+            for accept_task in accept_tasks:
+                accept_task.cancel()
+        finally:
+            self.close_server_sockets(server_sockets)
+
+        self.executor.shutdown(wait=False)
+
+    async def accept_async(self, server_socket):
+        while self.running:
+            client_socket, _ = await self.loop.sock_accept(server_socket)
+            self.setup_client_socket(client_socket)
+            self.loop.create_task(self.handle_client_async(client_socket))
+
+    async def handle_client_async(self, client_socket):
+        """Async counterpart of handle_client: the request is parsed on the loop, executed in the pool."""
+        start = time.perf_counter_ns()
+        try:
+            json_data = await recv_request_async(self.loop, client_socket, self.max_frame_size)
+        except Exception as e:
+            tracer.add(*self.received(start))
+            logging.error(f"Error receiving request: {e}")
+            code = 'frame_too_large' if isinstance(e, FrameTooLargeError) else 'server_error'
+            response = create_response(-1, 'error', code, str(e)).encode()
+            try:
+                await self.loop.sock_sendall(client_socket, len(response).to_bytes(4, byteorder='big') + response)
+            except OSError:
+                pass
+            client_socket.close()
+            return
+        received = self.received(start)
+
+        if json_data and json_data.get('cmd') == 'mux':
+            try:
+                await self.serve_mux_async(client_socket, json_data)
+            finally:
+                client_socket.close()
+            return
+
+        # Commands use blocking sendall, hand them a blocking socket
+        client_socket.setblocking(True)
+        try:
+            await self.loop.run_in_executor(self.executor, self.handle_request, client_socket, json_data, received)
+        finally:
+            client_socket.close()
+
+    async def serve_mux_async(self, client_socket, json_data):
+        """Async counterpart of serve_mux, frames are read on the loop and written through it."""
+        send_lock = asyncio.Lock()
+
+        async def send_frame_async(data):
+            async with send_lock:
+                await self.loop.sock_sendall(client_socket, data)
+
+        def send_frame(data):
+            # Called from handler threads, don't hang them if the loop goes away mid-write
+            asyncio.run_coroutine_threadsafe(send_frame_async(data), self.loop).result(timeout=MUX_SEND_TIMEOUT)
+
+        ack = create_response(json_data['sid'], 'success', 'ack', 'operation successful').encode()
+        await send_frame_async(len(ack).to_bytes(4, byteorder='big') + ack)
+        self.mux_sockets.add(client_socket)
+
+        pending = set()
+        try:
+            while self.running:
+                try:
+                    rid, payload = await recv_mux_frame_async(self.loop, client_socket, self.max_frame_size)
+                except FrameTooLargeError as e:
+                    logging.error(f"Rejected request: {e}")
+                    response = create_response(-1, 'error', 'frame_too_large', str(e)).encode()
+                    await send_frame_async(e.rid.to_bytes(4, byteorder='big') + len(response).to_bytes(4, byteorder='big') + response)
+                    break
+                except (RuntimeError, OSError):
+                    break
+                metrics.inc('bytes_in_total', 8 + len(payload))
+                try:
+                    json_data = parse_request(payload)
+                except ValueError as e:
+                    logging.error(f"Malformed request: {e}")
+                    response = create_response(-1, 'error', 'invalid_request', str(e)).encode()
+                    await send_frame_async(rid.to_bytes(4, byteorder='big') + len(response).to_bytes(4, byteorder='big') + response)
+                    continue
+                task = self.loop.run_in_executor(self.executor, self.handle_request, MuxChannel(send_frame, rid), json_data)
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            self.mux_sockets.discard(client_socket)
 
     def stop(self):
         self.running = False
+        self.ai_handler.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        # Wake up connections blocked waiting for their next multiplexed request
+        for client_socket in list(self.mux_sockets):
+            try:
+                client_socket.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
 
     def dump(self):
         """ Print all active session contexts. """
@@ -372,15 +890,16 @@ def show_all_threads():
     for thread in threads:
         print(f"Thread Name: {thread.name}, ID: {thread.ident}, Daemon: {thread.daemon}")
 
-def main_daemon(config, args):
+def main_daemon(config, args, startup):
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(asctime)s - %(levelname)s - L%(lineno)d - %(message)s', filename=os.path.join(config['settings']['dpath'], 'vern.log'))
     logging.info('Starting CommandListener')
-    command_listener = CommandListener(config)
+    command_listener = CommandListener(config, startup)
     command_listener.start()
     while command_listener.running:
         time.sleep(.1)
 
 def main(argv = sys.argv[1:], config=None):
+    startup = {'start': time.monotonic()}
     parser = argparse.ArgumentParser(description='Listen for commands from client')
     parser.add_argument('-d', '--debug', action='store_true', help='Print debug messages')
     parser.add_argument('-i', '--interactive', action='store_true', help='Interactive mode')
@@ -393,16 +912,17 @@ def main(argv = sys.argv[1:], config=None):
     if config is None:
         config_path = args.config or os.path.join(script_path, "config.yaml")
         config = load_config(config_path)
+    startup['config'] = time.monotonic()
 
     if args.daemon:
         pid = os.path.join(config['settings']['dpath'], "vern.pid")
-        daemon = Daemonize(app="vern_server_daemon", pid=pid, action=partial(main_daemon, config, args))
+        daemon = Daemonize(app="vern_server_daemon", pid=pid, action=partial(main_daemon, config, args, startup))
         daemon.start()
         sys.exit(0)
 
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(asctime)s - %(levelname)s - L%(lineno)d - %(message)s')
 
-    command_listener = CommandListener(config)
+    command_listener = CommandListener(config, startup)
     command_listener.start()
 
     if not args.interactive: